@@ -24,6 +24,11 @@ class ConfigAppModel(BaseModel):
     DEBUG: bool
     ROOT_PATH: Optional[str] = ""
     CACHE: str
+    JOB_WORKERS: int = 2
+    ROUTER_THREADS: int = 8
+    COALESCE_TTL: int = 3600
+    JOB_RETENTION: int = 604800
+    PROCESS_WORKERS: int = 2
 
 
 @lru_cache
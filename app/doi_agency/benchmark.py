@@ -0,0 +1,156 @@
+"""Offline throughput benchmarks of the DataCite harvest functions.
+
+Each benchmark runs against a MockDataCite served on localhost and reports
+records per second, requests by endpoint (including injected 429s) and peak
+Python memory measured with tracemalloc. Run with
+
+    python -m app.doi_agency.benchmark --records 5000 --latency 0.02
+
+and compare the JSON written with --output between revisions.
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from logging import getLogger
+from typing import Callable
+
+from app.doi_agency import client, datacite, pipeline, ratelimit
+from app.doi_agency.mock_datacite import LocalTransport, MockDataCite, serve
+
+log = getLogger(__name__)
+
+PREFIX = "10.1234"
+
+
+def _doi_list(mock: MockDataCite) -> list[str]:
+    return mock.dois(PREFIX)
+
+
+BENCHMARKS = {
+    "get_doi_list_page": lambda mock, args: datacite.get_doi_list_page(
+        PREFIX, page_size=args.page_size, concurrency=args.concurrency),
+    "get_doi_list_cursor": lambda mock, args: datacite.get_doi_list_cursor(
+        PREFIX, page_size=args.page_size),
+    "get_doi_list_cursor_sparse": lambda mock, args: datacite.get_doi_list_cursor(
+        PREFIX, url_template=datacite.SPARSE_CURSOR_URL_TEMPLATE, page_size=args.page_size),
+    "get_doi_xml_list_cursor": lambda mock, args: datacite.get_doi_xml_list_cursor(
+        PREFIX, page_size=args.page_size, raw=True)[0],
+    "get_xml_list_datacite": lambda mock, args: datacite.get_xml_list_datacite(
+        _doi_list(mock)[:args.xml_records], raw=True),
+    "get_xml_list_datacite_concurrent": lambda mock, args: datacite.get_xml_list_datacite_concurrent(
+        _doi_list(mock)[:args.xml_records], concurrency=args.concurrency, raw=True),
+    "harvest_pipeline": lambda mock, args: [record for page in pipeline.harvest_pipeline(
+        PREFIX, page_size=args.page_size, raw=True) for record in page],
+}
+
+
+def run_benchmark(name: str, func: Callable, mock: MockDataCite, args) -> dict:
+    """Run one benchmark and return its measurements.
+
+    Args:
+        name (str): benchmark name
+        func (Callable): benchmark taking mock and args, returning the records
+        mock (MockDataCite): served API, its request counts are reset
+        args (argparse.Namespace): benchmark options
+
+    Returns:
+        dict with records, seconds, records_per_second, requests and peak_memory_mb
+    """
+    mock.reset_counts()
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    records = len(func(mock, args))
+    seconds = time.perf_counter() - start
+    peak = None
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return {
+        "name": name,
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_second": round(records / seconds, 1) if seconds else None,
+        "requests": dict(mock.counts),
+        "peak_memory_mb": None if peak is None else round(peak, 2),
+    }
+
+
+def run_benchmarks(args) -> list[dict]:
+    """Serve a MockDataCite and run the selected benchmarks against it.
+
+    Args:
+        args (argparse.Namespace): options, see main
+
+    Returns:
+        list[dict]: measurements per benchmark
+    """
+    mock = MockDataCite({PREFIX: args.records}, latency=args.latency,
+                        throttle_every=args.throttle_every)
+    server = serve(mock)
+    pool_size = max(client.POOL_SIZE, args.concurrency)
+    client.configure(pool_size=pool_size,
+                     transport=LocalTransport(f"http://127.0.0.1:{server.server_port}",
+                                              pool_size=pool_size))
+    ratelimit.configure(rate=args.rate, host_concurrency=max(ratelimit.HOST_CONCURRENCY, args.concurrency),
+                        backoff=0.01)
+    try:
+        results = []
+        for name in args.benchmark or BENCHMARKS:
+            result = run_benchmark(name, BENCHMARKS[name], mock, args)
+            log.info(f"{name}: {result}")
+            results.append(result)
+        return results
+    finally:
+        client.configure()
+        ratelimit.configure()
+        server.shutdown()
+        server.server_close()
+
+
+def format_results(results: list[dict]) -> str:
+    """Return measurements as a text table."""
+    lines = [f"{'benchmark':34} {'records':>8} {'seconds':>8} {'rec/s':>9} {'peak MB':>8}  requests"]
+    for r in results:
+        peak = "-" if r["peak_memory_mb"] is None else f"{r['peak_memory_mb']:.2f}"
+        requests = ", ".join(f"{k}={v}" for k, v in sorted(r["requests"].items()))
+        lines.append(f"{r['name']:34} {r['records']:>8} {r['seconds']:>8.3f} "
+                     f"{r['records_per_second'] or 0:>9.1f} {peak:>8}  {requests}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-b", "--benchmark", action="append", choices=list(BENCHMARKS),
+                        help="benchmark to run, may be repeated (default all)")
+    parser.add_argument("-n", "--records", type=int, default=2000,
+                        help="size of the synthetic prefix")
+    parser.add_argument("--xml-records", type=int, default=500,
+                        help="records fetched one by one by the get_xml_list_datacite benchmarks")
+    parser.add_argument("--page-size", type=int, default=1000, help="records per list page")
+    parser.add_argument("-j", "--concurrency", type=int, default=10, help="parallel requests")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--throttle-every", type=int, default=0,
+                        help="answer every n-th request with HTTP 429")
+    parser.add_argument("--rate", type=float, default=None, help="client rate limit, default none")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc, which slows down the runs")
+    parser.add_argument("-o", "--output", help="JSON file for the measurements")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,257 @@
+"""Client for long-lived Bolognese worker processes.
+
+Starting a bolognese-cli container per DOI costs far more than the conversion
+itself. BologneseWorker instead keeps a few worker processes running
+(bolognese_worker.rb in the bolognese-cli image, or any command speaking the
+same JSON lines protocol, such as fake_bolognese in tests) and streams DOIs to
+them in batches.
+"""
+
+import itertools
+import json
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Iterable, Iterator
+
+log = getLogger(__name__)
+
+DOCKER_IMAGE = "bolognese-cli"
+WORKER_SCRIPT = "/app/bolognese_worker.rb"
+CONCURRENCY = 2
+BATCH_SIZE = 50
+#seconds a worker process may take to answer one batch before it is restarted
+BATCH_TIMEOUT = 300
+
+
+def docker_command(docker_image: str = DOCKER_IMAGE, name: str | None = None) -> list[str]:
+    """Return the command running the worker script in the Bolognese image.
+
+    Args:
+        docker_image (str): image built from bolognese.dockerfile
+        name (str | None): container name, needed to kill the container, not just the docker client
+
+    Returns:
+        list[str]
+    """
+    options = [] if name is None else ["--name", name]
+    return ["docker", "run", "--rm", "-i", *options, "--entrypoint", "ruby", docker_image, WORKER_SCRIPT]
+
+
+class BologneseError(Exception):
+    """A DOI could not be converted, or a worker process failed."""
+
+
+class _Process:
+    """One worker process, used by one thread at a time.
+
+    With docker_image every process is a container with a name of its own,
+    command is then ignored.
+    """
+
+    def __init__(self, command: list[str], timeout: float | None = None, docker_image: str | None = None):
+        self.command = command
+        self.timeout = timeout
+        self.docker_image = docker_image
+        self._container = None
+        self._popen = None
+        self._lines = None
+        self._ids = itertools.count(1)
+
+    def _start(self) -> subprocess.Popen:
+        if self._popen is None or self._popen.poll() is not None:
+            command = self.command
+            if self.docker_image is not None:
+                self._container = f"bolognese-worker-{uuid.uuid4().hex[:12]}"
+                command = docker_command(self.docker_image, self._container)
+            log.info(f"Starting Bolognese worker: {' '.join(command)}")
+            self._popen = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           text=True, encoding="utf-8", bufsize=1)
+            #a reader thread per process, so reading an answer can time out
+            self._lines = queue.Queue()
+            threading.Thread(target=self._read, args=(self._popen.stdout, self._lines),
+                             name="bolognese-reader", daemon=True).start()
+        return self._popen
+
+    @staticmethod
+    def _read(stdout, lines: queue.Queue) -> None:
+        for line in stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def _request(self, dois: list[tuple[int, str]], to: str, responses: dict) -> str | None:
+        """Send (id, DOI) requests and add the answers to responses, return the error if the worker failed."""
+        try:
+            popen = self._start()
+            for i, doi in dois:
+                popen.stdin.write(json.dumps({"id": i, "doi": doi, "to": to}) + "\n")
+            popen.stdin.flush()
+
+            wanted = {i for i, _ in dois}
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            while wanted:
+                try:
+                    line = self._lines.get(timeout=None if deadline is None
+                                           else max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise BologneseError(f"Bolognese worker did not answer within {self.timeout} s")
+                if line is None:
+                    raise BologneseError(f"Bolognese worker exited with {popen.wait()}")
+                response = json.loads(line)
+                if response.get("id") is None and "error" in response:
+                    #an error not tied to a request, e.g. an unreadable one, no answer follows
+                    raise BologneseError(f"Bolognese worker failed: {response['error']}")
+                responses[response.get("id")] = response
+                wanted.discard(response.get("id"))
+        except (OSError, ValueError, BologneseError) as e:
+            return str(e)
+        return None
+
+    def convert(self, dois: list[str], to: str) -> list[tuple[str, str | None, str | None]]:
+        """Return (DOI, output, error) of every DOI in order.
+
+        When the process crashes or misses the deadline, the answers read so
+        far are kept and the unanswered DOIs are sent to a fresh process. A
+        DOI that is the first unanswered one of two failures in a row is
+        reported with the error, as the worker handles DOIs in order.
+        """
+        pending = [(next(self._ids), doi) for doi in dois]
+        ids = [i for i, _ in pending]
+        responses = {}
+        suspect = None
+        while pending:
+            error = self._request(pending, to, responses)
+            if error is None:
+                break
+            log.error(f"Bolognese worker failed, restarting: {error}")
+            self.kill()
+            pending = [(i, doi) for i, doi in pending if i not in responses]
+            if pending and pending[0][0] == suspect:
+                i, doi = pending.pop(0)
+                responses[i] = {"error": error}
+                suspect = None
+            elif pending:
+                suspect = pending[0][0]
+
+        return [(doi, responses[i].get("output"), responses[i].get("error"))
+                for i, doi in zip(ids, dois)]
+
+    def kill(self) -> None:
+        if self._popen is None:
+            return
+        if self._container is not None:
+            #killing the docker client leaves the container running
+            try:
+                subprocess.run(["docker", "kill", self._container], capture_output=True, timeout=30)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                log.error(f"Cannot kill Bolognese container {self._container}: {e}")
+            self._container = None
+        self._popen.kill()
+        self._popen.wait()
+        self._popen = None
+
+    def close(self) -> None:
+        if self._popen is None:
+            return
+        try:
+            self._popen.stdin.close()
+            self._popen.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self._popen.kill()
+        self._popen = None
+
+
+class BologneseWorker:
+    """Pool of long-lived Bolognese worker processes.
+
+    Processes are started on first use and restarted after a crash or when
+    they do not answer a batch within timeout seconds, the unanswered DOIs
+    of the batch are then retried. At most concurrency batches are
+    converted at the same time.
+
+    Args:
+        command (list[str]): worker command, default a named container per process, see docker_command
+        concurrency (int): number of worker processes
+        batch_size (int): DOIs sent to a worker at once
+        timeout (float | None): seconds per batch, None to wait forever
+    """
+
+    def __init__(self, command: list[str] | None = None,
+                 concurrency: int = CONCURRENCY,
+                 batch_size: int = BATCH_SIZE,
+                 timeout: float | None = BATCH_TIMEOUT):
+        self.command = command or docker_command()
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        docker_image = None if command else DOCKER_IMAGE
+        self._processes = [_Process(self.command, timeout, docker_image) for _ in range(self.concurrency)]
+        self._free = list(self._processes)
+        self._condition = threading.Condition()
+
+    def _convert_batch(self, dois: list[str], to: str) -> list[tuple[str, str | None, str | None]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._free)
+            process = self._free.pop()
+        try:
+            return process.convert(dois, to)
+        finally:
+            with self._condition:
+                self._free.append(process)
+                self._condition.notify()
+
+    def iter_convert(self, dois: Iterable[str], to: str = "datacite") -> Iterator[tuple[str, str | None, str | None]]:
+        """Yield (DOI, output, error) of every DOI in input order.
+
+        DOIs are read in batches, and at most concurrency batches are in
+        flight, so dois can be a generator of any length.
+
+        Args:
+            dois (Iterable[str]): DOIs or DOI URLs
+            to (str): Bolognese output format
+
+        Returns:
+            Iterator[tuple[str, str | None, str | None]]
+        """
+        dois = iter(dois)
+        batches = iter(lambda: list(itertools.islice(dois, self.batch_size)), [])
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="bolognese") as executor:
+            pending = []
+            for batch in batches:
+                pending.append(executor.submit(self._convert_batch, batch, to))
+                if len(pending) >= self.concurrency:
+                    yield from pending.pop(0).result()
+            for future in pending:
+                yield from future.result()
+
+    def convert(self, doi: str, to: str = "datacite") -> str:
+        """Return the conversion of a single DOI.
+
+        Args:
+            doi (str): DOI or DOI URL
+            to (str): Bolognese output format
+
+        Returns:
+            str
+
+        Raises:
+            BologneseError: if the DOI could not be converted
+        """
+        _, output, error = self._convert_batch([doi], to)[0]
+        if error is not None:
+            raise BologneseError(f"{doi}: {error}")
+        return output
+
+    def close(self) -> None:
+        """Stop all worker processes."""
+        for process in self._processes:
+            process.close()
+
+    def __enter__(self) -> "BologneseWorker":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,36 @@
+#!/usr/bin/env ruby
+# Long-lived Bolognese worker for app/doi_agency/bolognese.py.
+#
+# Reads one JSON request per line on stdin, {"id": 1, "doi": "https://doi.org/...", "to": "datacite"},
+# and writes one JSON response per line on stdout, {"id": 1, "doi": ..., "output": "...", "error": null},
+# so a single process serves any number of DOIs.
+
+require "json"
+require "bolognese"
+
+FORMATS = %w[datacite datacite_json crossref crosscite citeproc codemeta schema_org bibtex ris jats citation].freeze
+
+$stdout.sync = true
+
+$stdin.each_line do |line|
+  next if line.strip.empty?
+
+  response = {}
+  begin
+    request = JSON.parse(line)
+    response = { "id" => request["id"], "doi" => request["doi"] }
+    to = request.fetch("to", "datacite")
+    metadata = Bolognese::Metadata.new(input: request["doi"])
+    if !FORMATS.include?(to)
+      response["error"] = "unknown format #{to}"
+    elsif metadata.exists?
+      response["output"] = metadata.send(to)
+    else
+      response["error"] = "not found"
+    end
+  rescue StandardError => e
+    response["error"] = "#{e.class}: #{e.message}"
+  end
+
+  $stdout.puts(JSON.generate(response))
+end
@@ -0,0 +1,260 @@
+"""Shared HTTP client layer for DataCite API calls.
+
+All harvest functions go through the same pooled client, so connections to
+api.datacite.org are kept alive between calls. configure() changes pool size,
+timeouts and HTTP/2 for every caller, set_client() swaps in a stand-in.
+Requests are paced and retried by the shared limiter in ratelimit, and their
+latency, status, size and retries are recorded in metrics.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from logging import getLogger
+
+import httpx
+
+from app.doi_agency import metrics, ratelimit
+
+log = getLogger(__name__)
+
+POOL_SIZE = 10
+TIMEOUT = 60.0
+CONNECT_TIMEOUT = 10.0
+HTTP2 = False
+
+_settings = {
+    "pool_size": POOL_SIZE,
+    "timeout": TIMEOUT,
+    "connect_timeout": CONNECT_TIMEOUT,
+    "http2": HTTP2,
+    "transport": None,
+}
+_client = None
+_lock = threading.Lock()
+
+
+def configure(pool_size: int = POOL_SIZE,
+              timeout: float | None = TIMEOUT,
+              connect_timeout: float | None = CONNECT_TIMEOUT,
+              http2: bool = HTTP2,
+              transport: httpx.BaseTransport | None = None) -> None:
+    """Set options used by shared and new clients, closing the current client.
+
+    Args:
+        pool_size (int): max number of pooled (keep-alive) connections
+        timeout (float | None): read, write and pool timeout in seconds
+        connect_timeout (float | None): connect timeout in seconds
+        http2 (bool): use HTTP/2 if the h2 package is installed
+        transport (httpx.BaseTransport | None): transport replacing the network,
+            e.g. httpx.MockTransport in tests
+    """
+    _settings.update(pool_size=pool_size,
+                     timeout=timeout,
+                     connect_timeout=connect_timeout,
+                     http2=http2,
+                     transport=transport)
+    set_client(None)
+
+
+def _client_options(pool_size: int | None = None) -> dict:
+    """Return keyword arguments shared by sync and async clients."""
+    pool_size = pool_size or _settings["pool_size"]
+    http2 = _settings["http2"]
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log.warning("HTTP/2 requested but h2 is not installed, using HTTP/1.1")
+            http2 = False
+
+    options = {
+        "http2": http2,
+        "limits": httpx.Limits(max_connections=pool_size,
+                               max_keepalive_connections=pool_size),
+        "timeout": httpx.Timeout(_settings["timeout"],
+                                 connect=_settings["connect_timeout"]),
+    }
+    if _settings["transport"] is not None:
+        options["transport"] = _settings["transport"]
+
+    return options
+
+
+def get_client() -> httpx.Client:
+    """Return the shared client, creating it on first use.
+
+    Returns:
+        httpx.Client
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = httpx.Client(**_client_options())
+        return _client
+
+
+def set_client(client: httpx.Client | None) -> None:
+    """Replace the shared client. None closes it and a new one is created on next use.
+
+    Args:
+        client (httpx.Client | None): client used by all harvest functions
+    """
+    global _client
+    with _lock:
+        if _client is not None and _client is not client:
+            _client.close()
+        _client = client
+
+
+def new_async_client(pool_size: int | None = None,
+                     headers: dict | None = None) -> httpx.AsyncClient:
+    """Return a new async client with the shared options.
+
+    Async clients are bound to an event loop, so each run gets its own.
+
+    Args:
+        pool_size (int | None): max number of connections, defaults to the configured pool size
+        headers (dict | None): headers sent with every request
+
+    Returns:
+        httpx.AsyncClient
+    """
+    return httpx.AsyncClient(headers=headers, **_client_options(pool_size))
+
+
+def get(url: str, headers: dict | None = None) -> httpx.Response:
+    """GET url with the shared client, rate limited and retried.
+
+    Args:
+        url (str): URL to request
+        headers (dict | None): request headers
+
+    Returns:
+        httpx.Response
+
+    Raises:
+        httpx.HTTPStatusError: for an error status once retries are used up
+        httpx.TransportError: for a network error once retries are used up
+    """
+    limiter = ratelimit.get_limiter()
+    host = httpx.URL(url).host
+    name = metrics.endpoint(url)
+    attempt = 0
+    while True:
+        time.sleep(limiter.reserve())
+        start = time.perf_counter()
+        try:
+            with limiter.host_slot(host):
+                response = get_client().get(url, headers=headers)
+        except httpx.TransportError as e:
+            _record(name, start)
+            if attempt >= limiter.max_retries:
+                raise
+            delay = limiter.backoff_delay(attempt)
+            metrics.RETRIES.inc(endpoint=name, reason="transport")
+            log.warning(f"{e!r} for {url}, retry {attempt + 1} in {delay:.1f}s")
+        else:
+            _record(name, start, response)
+            delay = _retry_delay(limiter, response, attempt)
+            if delay is None:
+                return response
+
+        time.sleep(delay)
+        attempt += 1
+
+
+async def async_get(async_client: httpx.AsyncClient,
+                    url: str,
+                    headers: dict | None = None) -> httpx.Response:
+    """GET url with an async client, rate limited and retried like get().
+
+    Args:
+        async_client (httpx.AsyncClient): client from new_async_client
+        url (str): URL to request
+        headers (dict | None): request headers
+
+    Returns:
+        httpx.Response
+    """
+    limiter = ratelimit.get_limiter()
+    host = httpx.URL(url).host
+    name = metrics.endpoint(url)
+    attempt = 0
+    while True:
+        await asyncio.sleep(await limiter.async_reserve())
+        start = time.perf_counter()
+        try:
+            async with limiter.async_host_slot(host):
+                response = await async_client.get(url, headers=headers)
+        except httpx.TransportError as e:
+            _record(name, start)
+            if attempt >= limiter.max_retries:
+                raise
+            delay = limiter.backoff_delay(attempt)
+            metrics.RETRIES.inc(endpoint=name, reason="transport")
+            log.warning(f"{e!r} for {url}, retry {attempt + 1} in {delay:.1f}s")
+        else:
+            _record(name, start, response)
+            #a 429 or success updates the limiter state, which can be a locked file
+            if limiter.path is None:
+                delay = _retry_delay(limiter, response, attempt)
+            else:
+                delay = await asyncio.to_thread(_retry_delay, limiter, response, attempt)
+            if delay is None:
+                return response
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def _record(name: str, start: float, response: httpx.Response | None = None) -> None:
+    """Record latency, status and size of a request to endpoint name started at start."""
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=name)
+    if response is None:
+        metrics.REQUESTS.inc(endpoint=name, status="error")
+        return
+    metrics.REQUESTS.inc(endpoint=name, status=response.status_code)
+    metrics.RESPONSE_BYTES.inc(len(response.content), endpoint=name)
+
+
+def _retry_delay(limiter: ratelimit.RateLimiter,
+                 response: httpx.Response,
+                 attempt: int) -> float | None:
+    """Return seconds to wait before retrying response, or None if it is final.
+
+    Raises:
+        httpx.HTTPStatusError: for an error status that is not retried further
+    """
+    if response.status_code not in ratelimit.RETRY_STATUS:
+        limiter.success()
+        #304 only answers a conditional request, the caller reuses its copy
+        if response.status_code != httpx.codes.NOT_MODIFIED:
+            response.raise_for_status()
+        return None
+
+    retry_after = ratelimit.parse_retry_after(response.headers.get("Retry-After"))
+    if response.status_code == 429:
+        limiter.throttled(retry_after)
+
+    if attempt >= limiter.max_retries:
+        response.raise_for_status()
+
+    delay = limiter.backoff_delay(attempt, retry_after)
+    metrics.RETRIES.inc(endpoint=metrics.endpoint(response.url), reason=response.status_code)
+    log.warning(f"HTTP {response.status_code} for {response.url}, retry {attempt + 1} in {delay:.1f}s")
+    return delay
+
+
+def get_json(url: str, headers: dict | None = None) -> dict:
+    """GET url with the shared client and decode the JSON body.
+
+    Args:
+        url (str): URL to request
+        headers (dict | None): request headers
+
+    Returns:
+        dict
+    """
+    return json.loads(get(url, headers=headers).text)
@@ -1,7 +1,14 @@
 import argparse
+import atexit
+import asyncio
 import pathlib
 import json
 import base64
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import itertools
 import logging
 import sys
 import tempfile
@@ -9,9 +16,19 @@ import os
 import math
 #from packaging.version import Version
 import re
+import urllib.parse
 
 from lxml import etree as ET
-import requests
+
+if __package__ in (None, ""):
+    #allow running as a script: python app/doi_agency/datacite.py
+    sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+
+from app.doi_agency import client, metrics, ratelimit
+from app.doi_agency.bolognese import BologneseWorker
+from app.doi_agency.records import DataCiteRecord
+from app.doi_agency.store import RecordStore, is_store_path
+from app.doi_agency.xmlcache import XMLCache
 
 #import pytest
 
@@ -33,54 +50,86 @@ DEFAULT_HEADER = {
 PAGE_URL_TEMPLATE = "https://api.datacite.org/dois?prefix=%s&page[size]=%i&page[number]=%i"
 PAGE1_URL_TEMPLATE = "https://api.datacite.org/dois?prefix=%s&page[size]=1&page[number]=1"
 CURSOR_URL_TEMPLATE = "https://api.datacite.org/dois?prefix=%s&page[cursor]=1&page[size]=%i"
+#sparse fieldsets: list pages only carry the requested attributes
+SPARSE_CURSOR_URL_TEMPLATE = CURSOR_URL_TEMPLATE + "&fields[dois]=doi"
+XML_CURSOR_URL_TEMPLATE = CURSOR_URL_TEMPLATE + "&fields[dois]=doi,xml"
+UPDATED_CURSOR_URL_TEMPLATE = CURSOR_URL_TEMPLATE + "&fields[dois]=doi,updated"
+XML_UPDATED_CURSOR_URL_TEMPLATE = CURSOR_URL_TEMPLATE + "&fields[dois]=doi,updated,xml"
+#attributes of the list pages returned as record metadata, the XML is left out
+METADATA_FIELDS = ("doi", "titles", "creators", "publicationYear", "types", "created", "updated")
 #CURSOR_URL_TEMPLATE2 = "https://api.datacite.org/dois?provider-id=%s&page[cursor]=1&page[size]=%i"
 DOI_URL_TEMPLATE = "https://api.datacite.org/dois/%s"
-TIMEOUT=None
+PROVIDER_PREFIXES_URL_TEMPLATE = "https://api.datacite.org/prefixes?provider-id=%s&page[size]=1000"
+UPDATED_QUERY_TEMPLATE = "updated:[%s TO *]"
+STATE_FILE_TEMPLATE = "state-%s.json"
+#file names of list harvests, the position of the record in the DOI list
+NUMBERED_FILE = re.compile(r"\d+\.xml")
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_DOI_FILE = "checkpoint-doi.txt"
+CHECKPOINT_INTERVAL = 100
+#re-request records updated shortly before the last harvest to cover clock skew
+UPDATED_OVERLAP = datetime.timedelta(hours=1)
+CONCURRENCY=10
+#shard name: (facet in meta of a list response, query parameter filtering on it)
+SHARD_FACETS = {
+    "created": ("created", "created"),
+    "resource-type": ("resourceTypes", "resource-type-id"),
+    }
 
 def doi_to_file(doi):
-    pass
+    """Returns the XML file name for a DOI, safe to use in a single folder
 
-def get_doi_list_fastapi(doi_prefix, cache):
-    """DO NOT USE: Template for binding for FastAPI call to DataCite API cursor call
-    to list DOIs by prefix
+    Attributes:
+        doi (str): full DOI string
+    """
+    return urllib.parse.quote(doi.lower(), safe="") + ".xml"
+
+def get_doi_list_fastapi(doi_prefix, cache, headers=DEFAULT_HEADER):
+    """Binding for FastAPI call to DataCite API cursor call to list DOIs by prefix
+
+    The harvest is submitted to the job engine and runs outside the request,
+    progress can be polled at the returned status_url.
 
     Attributes:
         doi_prefix (str): DOI prefix for provider
-        cache (str): session specific folder path
-
-    Todo:
-        * Add in call to XML scraping
-        * Design FastAPI asynchronous return for results
+        cache (str): folder path in which session specific folders are created
+        headers (dict): request header to inform DataCite about API call
     """
-    if (sys.version_info.major >= 3) and (sys.version_info.major >= 12):
-        temp_dir = tempfile.TemporaryDirectory(dir=cache,delete=False)
-    else:
-        #This probably won't work
-        temp_dir = tempfile.TemporaryDirectory(dir=cache)
+    #imported here as the job engine itself builds on this module
+    from app.doi_agency.jobs import submit_job
 
-    fid = pathlib.Path(temp_dir.name).name
-    doi_file = pathlib.Path(temp_dir.name) / "doi.txt"
+    return submit_job(doi_prefix=doi_prefix, cache=cache, headers=headers)
 
-    #this is blocking and should be modified with a fork or spawn
-    result = get_doi_list_cursor(doi_prefix=doi_prefix,
-                                 filename=doi_file,
-                                 header_line = True)
+def get_doi_count(doi_prefix="10.14454",
+                  headers=DEFAULT_HEADER):
+    """Returns the DataCite record count for a DOI prefix
 
-##    return {
-##        "status_code": 200,
-##        "result": json.dumps(result)
-##        }
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        headers (dict): request header to inform DataCite about API call
+    """
+    url = PAGE1_URL_TEMPLATE % (doi_prefix)
+    LOGGER.debug("DataCite DOI query: %s", url)
+    json_response = client.get_json(url, headers=headers)
+    return json_response["meta"]["total"]
 
-##    return {
-##        "status_code": 200,
-##        "result": dict(zip(range(1,len(result)+1),result))
-##        }
+def get_provider_prefixes(provider_id,
+                          url_template=PROVIDER_PREFIXES_URL_TEMPLATE,
+                          headers=DEFAULT_HEADER):
+    """Returns the DOI prefixes of a DataCite provider
 
-    return {
-        "status_code": 200,
-        "message": f"Request {fid} started.",
-        "status_url": f"/request?fid={fid}"
-        }
+    Attributes:
+        provider_id (str): DataCite provider id, e.g. "ethz.wsl"
+        url_template (str): URL template for API call
+        headers (dict): request header to inform DataCite about API call
+    """
+    url = url_template % (urllib.parse.quote(provider_id, safe=""))
+    LOGGER.debug("DataCite prefix query: %s", url)
+    prefixes = []
+    for json_response in _iter_cursor_pages(url, headers=headers):
+        prefixes.extend(d["id"] for d in json_response["data"])
+
+    return prefixes
 
 def get_doi_list(doi_prefix="10.14454",
                  headers=DEFAULT_HEADER,
@@ -96,25 +145,20 @@ def get_doi_list(doi_prefix="10.14454",
         headers (dict): request header to inform DataCite about API call
         filename (str): file path where to write the DOI list
 
-    Todo:
-        * Consider supporting a provider id instead/in addition to a DOI prefixe
-
+    Note: several prefixes, or all prefixes of a provider id, are harvested
+    together with app.doi_agency.scheduler.harvest_prefixes.
     """
     #logic to determine page or cursor approach
 
     #check record count with pagination
-    url_template = PAGE1_URL_TEMPLATE
-    url = url_template % (doi_prefix)
-    data = None
-    LOGGER.debug("DataCite DOI query: %s", url)
-    json_response = json.loads(requests.get(url, headers=headers, data=data, timeout=TIMEOUT).text)
-    if json_response["meta"]["total"] > 10000:
+    if get_doi_count(doi_prefix, headers=headers) > 10000:
         LOGGER.info("Gathering records with cursor API call(s)")
         fun = get_doi_list_cursor
         #return get_doi_list_cursor(doi_prefix, headers=headers, filename=filename)
     else:
         LOGGER.info("Gathering records with pagnation API call(s)")
-        fun = get_doi_list_page
+        #at most 10 pages of 1000, fetched in parallel after the first
+        fun = functools.partial(get_doi_list_page, page_size=1000)
         #return get_doi_list_page(doi_prefix, headers=headers, filename=filename)
 
     return fun(doi_prefix, headers=headers, filename=filename)
@@ -125,13 +169,17 @@ def get_doi_list_page(doi_prefix="10.14454",
                  start_page = 1,
                  stop_offset = 0,
                  headers=DEFAULT_HEADER,
-                 filename=None):
+                 filename=None,
+                 concurrency=CONCURRENCY):
 
     """Explictly page based API call to list full DOIs
 
     Note: This call is done on a basis of a single DOI prefix for a provider.
     Providers can have multiple prefixes (I think).
 
+    The first page gives the page count, the remaining pages are then
+    requested in parallel and their DOIs joined in page order.
+
     Attributes:
         doi_prefix (str): DOI prefix for provider
         url_template (str): URL template for API call
@@ -140,18 +188,18 @@ def get_doi_list_page(doi_prefix="10.14454",
         stop_offset (int): page to stop at ending with 0 meaning no exclusion
         headers (dict): request header to inform DataCite about API call
         filename (str): file path where to write the DOI list
+        concurrency (int): max number of pages requested at the same time
 
-    Todo:
-        * Consider supporting a provider id instead/in addition to a DOI prefixe
-
+    Note: several prefixes, or all prefixes of a provider id, are harvested
+    together with app.doi_agency.scheduler.harvest_prefixes.
     """
     doi_list = []
 
     url = url_template % (doi_prefix, page_size, start_page)
-    data = None
     LOGGER.info("DataCite DOI query")
     LOGGER.debug("DataCite DOI query: %s", url)
-    json_response = json.loads(requests.get(url, headers=headers, data=data, timeout=TIMEOUT).text)
+    with metrics.stage("list_page"):
+        json_response = client.get_json(url, headers=headers)
 
     page_count = json_response["meta"]["totalPages"]
     result_count = json_response["meta"]["total"]
@@ -161,14 +209,17 @@ def get_doi_list_page(doi_prefix="10.14454",
     doi_list.extend(datacite_doi_json_to_list(json_response))
 
 
-    for i in range(start_page + 1, start_page + page_count - stop_offset):
+    def get_page(i):
         LOGGER.debug("Processing page %i of %i", i, page_count)
-
         url = url_template % (doi_prefix, page_size, i)
-        data = None
-        json_response = json.loads(requests.get(url, headers=headers, data=data, timeout=TIMEOUT).text)
+        with metrics.stage("list_page"):
+            return datacite_doi_json_to_list(client.get_json(url, headers=headers))
 
-        doi_list.extend(datacite_doi_json_to_list(json_response))
+    pages = range(start_page + 1, start_page + page_count - stop_offset)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        #map keeps page order regardless of completion order
+        for page_doi_list in executor.map(get_page, pages):
+            doi_list.extend(page_doi_list)
 
     LOGGER.info("Processing complete")
     if filename is not None:
@@ -183,75 +234,600 @@ def get_doi_list_page(doi_prefix="10.14454",
 
     return doi_list
 
+def iter_doi_list_page(doi_prefix="10.14454",
+                       url_template = PAGE_URL_TEMPLATE,
+                       page_size = 100,
+                       start_page = 1,
+                       stop_offset = 0,
+                       headers=DEFAULT_HEADER,
+                       filename=None):
+
+    """Generator variant of get_doi_list_page
+
+    DOIs are yielded and written to filename one page at a time.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        url_template (str): URL template for API call
+        page_size (int): max number of items per page
+        start_page (int): page to start on begining with 1 meaning no exclusion
+        stop_offset (int): page to stop at ending with 0 meaning no exclusion
+        headers (dict): request header to inform DataCite about API call
+        filename (str): file path where to write the DOI list
+    """
+    page_count = None
+    i = start_page
+
+    LOGGER.info("Processing page(s)")
+    with _open_doi_file(filename) as f:
+        while page_count is None or i < start_page + page_count - stop_offset:
+            url = url_template % (doi_prefix, page_size, i)
+            LOGGER.debug("DataCite DOI query: %s", url)
+            with metrics.stage("list_page"):
+                json_response = client.get_json(url, headers=headers)
+            page_count = json_response["meta"]["totalPages"]
+            LOGGER.debug("Processing page %i of %i", i, page_count)
+
+            for d in datacite_doi_json_to_list(json_response):
+                if f:
+                    f.write(f"{d}\n")
+                yield d
+
+            i += 1
+
+    LOGGER.info("Processing complete")
+
 def get_doi_list_cursor(doi_prefix="10.14454",
                         url_template = CURSOR_URL_TEMPLATE,
                         page_size=1000,
                         headers=DEFAULT_HEADER,
                         filename=None,
-                        header_line=False):
+                        header_line=False,
+                        checkpoint=None,
+                        resume=False):
 
     """Explictly cursor based API call to list full DOIs
 
     Note: This call is done on a basis of a single DOI prefix for a provider.
     Providers can have multiple prefixes (I think).
 
+    Use SPARSE_CURSOR_URL_TEMPLATE as url_template to only transfer the DOI
+    attribute of each record.
+
     Attributes:
         doi_prefix (str): DOI prefix for provider
         url_template (str): URL template for API call
         page_size (int): max number of items per page
         headers (dict): request header to inform DataCite about API call
         filename (str): file path where to write the DOI list
+        checkpoint (str): folder path for checkpoints, see iter_doi_list_cursor
+        resume (bool): continue from the last checkpoint
 
-    Todo:
-        * Consider supporting a provider id instead/in addition to a DOI prefixe
-
+    Note: several prefixes, or all prefixes of a provider id, are harvested
+    together with app.doi_agency.scheduler.harvest_prefixes.
     """
+    return list(iter_doi_list_cursor(doi_prefix,
+                                     url_template=url_template,
+                                     page_size=page_size,
+                                     headers=headers,
+                                     filename=filename,
+                                     header_line=header_line,
+                                     checkpoint=checkpoint,
+                                     resume=resume))
+
+def iter_doi_list_cursor(doi_prefix="10.14454",
+                         url_template = CURSOR_URL_TEMPLATE,
+                         page_size=1000,
+                         headers=DEFAULT_HEADER,
+                         filename=None,
+                         header_line=False,
+                         checkpoint=None,
+                         resume=False):
+
+    """Generator variant of get_doi_list_cursor
+
+    DOIs are yielded and written to filename one page at a time, so only a
+    single page is held in memory. The header line is the record count
+    reported by DataCite on the first page.
+
+    With a checkpoint folder the next cursor URL and the DOI file offset are
+    saved after every page. DOIs are then always written to a file, by
+    default CHECKPOINT_DOI_FILE in the checkpoint folder. On resume the DOIs
+    already in the file are yielded again before the cursor continues.
 
-    doi_list = []
-
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        url_template (str): URL template for API call
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+        filename (str): file path where to write the DOI list
+        header_line (bool): write the record count as first line
+        checkpoint (str): folder path for checkpoints
+        resume (bool): continue from the last checkpoint
+    """
 #    url = url_template % (provider, page_size)
     url = url_template % (doi_prefix, page_size)
-    data = None
+    if checkpoint is not None and filename is None:
+        filename = pathlib.Path(checkpoint) / CHECKPOINT_DOI_FILE
 
+    state = _resume_state(checkpoint, "list", doi_prefix, filename) if resume else None
+    page = 0
+    if state is not None:
+        LOGGER.info("Resuming cursor harvest of prefix %s", doi_prefix)
+        url = state["next_url"]
+        page = state["page"]
+        yield from _iter_doi_file(filename, state["doi_offset"], header_line)
 
     LOGGER.info("Processing cursor(s)")
-    LOGGER.debug("Getting cursor 1")
-    json_response = json.loads(requests.get(url, headers=headers, data=data, timeout=TIMEOUT).text)
+    with _open_doi_file(filename, append=state is not None) as f:
+        for json_response in _iter_cursor_pages(url, headers=headers, start=page + 1):
+            if f and header_line and page == 0:
+                f.write(f"{json_response['meta']['total']}\n")
+
+            for d in datacite_doi_json_to_list(json_response):
+                if f:
+                    f.write(f"{d}\n")
+                yield d
+
+            page += 1
+            if checkpoint is not None:
+                f.flush()
+                save_checkpoint(checkpoint, "list", {
+                    "doi_prefix": doi_prefix,
+                    "next_url": json_response.get("links", {}).get("next"),
+                    "doi_offset": f.tell(),
+                    "page": page,
+                    })
+
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, "list", {
+                "doi_prefix": doi_prefix,
+                "next_url": None,
+                "doi_offset": f.tell(),
+                "page": page,
+                })
 
-    result_count = json_response["meta"]["total"]
-    doi_list.extend(datacite_doi_json_to_list(json_response))
+    LOGGER.info("Processing complete")
 
-    if result_count > page_size:
-        next_url = json_response["links"]["next"]
+def iter_doi_attributes_cursor(doi_prefix="10.14454",
+                               fields=METADATA_FIELDS,
+                               page_size=1000,
+                               headers=DEFAULT_HEADER):
+    """Yields the JSON attributes of each record as cursor pages arrive
 
-        page_count = math.ceil(result_count/float(page_size))
-        for i in range(2,page_count+1):
-            LOGGER.debug("Getting cursor %i", i)
-            LOGGER.debug("Next url: %s", next_url)
-            json_response = json.loads(requests.get(url, headers=headers, data=data, timeout=TIMEOUT).text)
+    Only the requested fields are sent by DataCite (sparse fieldset), the
+    doi attribute is always included.
 
-            doi_list.extend(datacite_doi_json_to_list(json_response))
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        fields (iterable): attribute names, e.g. METADATA_FIELDS, None for all
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+    """
+    url = CURSOR_URL_TEMPLATE % (doi_prefix, page_size)
+    if fields is not None:
+        fields = ["doi"] + [f for f in fields if f != "doi"]
+        url += "&fields[dois]=" + ",".join(fields)
 
-            next_url = json_response["links"]["next"]
+    for json_response in _iter_cursor_pages(url, headers=headers):
+        for d in json_response["data"]:
+            yield d["attributes"]
+
+def get_doi_shards(doi_prefix="10.14454",
+                   shard="created",
+                   headers=DEFAULT_HEADER):
+    """Splits a DOI prefix into disjoint slices using the facet counts of one query
+
+    DataCite only reports the top facet values: the latest ten years, or the
+    most frequent resource types. The records outside them form one more
+    slice, a query for the years before or the other resource types.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        shard (str): key of SHARD_FACETS to split on
+        headers (dict): request header to inform DataCite about API call
+
+    Returns:
+        tuple: list of (query parameter, value, count) slices and the prefix total
+    """
+    facet, param = SHARD_FACETS[shard]
+    url = PAGE1_URL_TEMPLATE % (doi_prefix)
+    LOGGER.debug("DataCite facet query: %s", url)
+    meta = client.get_json(url, headers=headers)["meta"]
+
+    facets = meta.get(facet, [])
+    shards = [(param, f["id"], f["count"]) for f in facets]
+    covered = sum(f["count"] for f in facets)
+    if facets and covered < meta["total"]:
+        shards.append(("query", _remainder_query(shard, facets), meta["total"] - covered))
+    elif not facets:
+        shards = [("query", "*", meta["total"])]
+    LOGGER.info("Prefix %s split into %i %s slice(s)", doi_prefix, len(shards), shard)
+
+    return shards, meta["total"]
+
+def _remainder_query(shard, facets):
+    """Returns the query for the records of a prefix outside the reported facet values
+
+    Attributes:
+        shard (str): key of SHARD_FACETS
+        facets (list): facet values reported by DataCite
+    """
+    if shard == "created":
+        #facet years are the latest ones, so the rest was created before them
+        return "created:[* TO %s-01-01}" % min(f["id"] for f in facets)
+    return "NOT types.resourceTypeGeneral:(%s)" % " OR ".join('"%s"' % f["title"] for f in facets)
+
+def get_doi_list_sharded(doi_prefix="10.14454",
+                         shard="created",
+                         url_template = SPARSE_CURSOR_URL_TEMPLATE,
+                         page_size=1000,
+                         headers=DEFAULT_HEADER,
+                         filename=None,
+                         concurrency=CONCURRENCY,
+                         checkpoint=None,
+                         resume=False):
+
+    """Cursor based DOI list with one cursor per facet slice running in parallel
+
+    The slices come from get_doi_shards, including the one for the records
+    outside the reported facet values. Their DOIs are merged in slice order
+    and deduplicated.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        shard (str): key of SHARD_FACETS to split on
+        url_template (str): URL template for API call
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+        filename (str): file path where to write the DOI list
+        concurrency (int): max number of slices harvested at the same time
+        checkpoint (str): folder path for checkpoints, the list is saved there once complete
+        resume (bool): reuse the complete list of the last checkpoint instead of listing again
+    """
+    if checkpoint is not None and filename is None:
+        filename = pathlib.Path(checkpoint) / CHECKPOINT_DOI_FILE
+
+    state = _resume_state(checkpoint, "list", doi_prefix, filename) if resume else None
+    if state is not None and state["next_url"] is None:
+        #the XML stage resumes by list position, so the saved order must be kept
+        LOGGER.info("Reusing the DOI list of prefix %s from the checkpoint", doi_prefix)
+        return list(_iter_doi_file(filename, state["doi_offset"]))
+
+    shards, total = get_doi_shards(doi_prefix, shard=shard, headers=headers)
+
+    def get_shard(s):
+        param, value, count = s
+        LOGGER.debug("Harvesting slice %s=%s with %i record(s)", param, value, count)
+        shard_template = url_template + f"&{param}=" + urllib.parse.quote(str(value)).replace("%", "%%")
+        return get_doi_list_cursor(doi_prefix, url_template=shard_template,
+                                   page_size=page_size, headers=headers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        doi_list = list(dict.fromkeys(d for shard_doi_list in executor.map(get_shard, shards)
+                                      for d in shard_doi_list))
+
+    if len(doi_list) != total:
+        #e.g. records registered while the slices were listed
+        LOGGER.warning("Slices list %i of %i record(s)", len(doi_list), total)
 
-    LOGGER.info("Processing complete")
     if filename is not None:
         with open(filename,"w") as f:
-            if header_line:
-                f.write(f"{len(doi_list)}\n")
             for d in doi_list:
-                f.write("{d}\n")
+                f.write(f"{d}\n")
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, "list", {
+                    "doi_prefix": doi_prefix,
+                    "next_url": None,
+                    "doi_offset": f.tell(),
+                    "page": 0,
+                    })
 
     return doi_list
 
+def get_doi_xml_list_cursor(doi_prefix="10.14454",
+                            url_template = XML_CURSOR_URL_TEMPLATE,
+                            page_size=1000,
+                            headers=DEFAULT_HEADER,
+                            filename=None,
+                            header_line=False,
+                            folder=None,
+                            checkpoint=None,
+                            resume=False,
+                            raw=False,
+                            store=None,
+                            cache=None):
+
+    """Cursor based API call to list full DOIs together with their XML records
+
+    The list pages already carry the base64 encoded XML of each record, so
+    no per DOI request is needed.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        url_template (str): URL template for API call
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+        filename (str): file path where to write the DOI list
+        folder (str): path string for where to save XML files
+        checkpoint (str): folder path for checkpoints, see iter_doi_xml_list_cursor
+        resume (bool): continue from the last checkpoint
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into
+        cache (XMLCache): XML cache to reuse unchanged records from
+
+    Returns:
+        tuple: DOI list and XML list in the same order
+    """
+    doi_list = []
+    xml_list = []
+
+    for d, dc_xml_et in iter_doi_xml_list_cursor(doi_prefix,
+                                                 url_template=url_template,
+                                                 page_size=page_size,
+                                                 headers=headers,
+                                                 filename=filename,
+                                                 header_line=header_line,
+                                                 folder=folder,
+                                                 checkpoint=checkpoint,
+                                                 resume=resume,
+                                                 raw=raw,
+                                                 store=store,
+                                                 cache=cache):
+        doi_list.append(d)
+        xml_list.append(dc_xml_et)
+
+    return doi_list, xml_list
+
+def iter_doi_xml_list_cursor(doi_prefix="10.14454",
+                             url_template = XML_CURSOR_URL_TEMPLATE,
+                             page_size=1000,
+                             headers=DEFAULT_HEADER,
+                             filename=None,
+                             header_line=False,
+                             folder=None,
+                             checkpoint=None,
+                             resume=False,
+                             raw=False,
+                             store=None,
+                             cache=None):
+
+    """Generator variant of get_doi_xml_list_cursor yielding (DOI, XML) pairs
+
+    Each record is written to filename and folder as soon as its page
+    arrives. With raw the decoded bytes are written unchanged and
+    DataCiteRecord objects are yielded, which only parse the XML on demand.
+
+    With a checkpoint folder the next cursor URL, the DOI file offset and the
+    record count are saved after every page. On resume the records already
+    saved in folder are read back and yielded before the cursor continues.
+
+    With a cache the list pages also carry the updated timestamp of each
+    record. Records with a matching timestamp are taken from the cache
+    instead of being decoded, the others are decoded and put into the cache.
+    The XML always comes with the list pages: a request per changed record
+    would cost far more than the transfer it saves.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        url_template (str): URL template for API call
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+        filename (str): file path where to write the DOI list
+        header_line (bool): write the record count as first line
+        folder (str): path string for where to save XML files
+        checkpoint (str): folder path for checkpoints
+        resume (bool): continue from the last checkpoint
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into, in addition to or instead of folder
+        cache (XMLCache): XML cache to reuse unchanged records from
+    """
+    if folder:
+        if not pathlib.Path(folder).is_dir():
+            pathlib.Path(folder).mkdir(parents=True)
+
+    if cache is not None and url_template == XML_CURSOR_URL_TEMPLATE:
+        url_template = XML_UPDATED_CURSOR_URL_TEMPLATE
+
+    url = url_template % (doi_prefix, page_size)
+    if checkpoint is not None and filename is None:
+        filename = pathlib.Path(checkpoint) / CHECKPOINT_DOI_FILE
+
+    state = _resume_state(checkpoint, "harvest", doi_prefix, filename) if resume and folder else None
+    i = 0
+    page = 0
+    if state is not None:
+        LOGGER.info("Resuming cursor harvest of prefix %s after %i records", doi_prefix, state["records"])
+        url = state["next_url"]
+        page = state["page"]
+        for d in _iter_doi_file(filename, state["doi_offset"], header_line):
+            i += 1
+            yield d, load_xml(d, os.path.join(folder, f"{i}.xml"), raw=raw)
+
+    LOGGER.info("Processing cursor(s) with XML")
+    with _open_doi_file(filename, append=state is not None) as f:
+        for json_response in _iter_cursor_pages(url, headers=headers, start=page + 1):
+            if f and header_line and page == 0:
+                f.write(f"{json_response['meta']['total']}\n")
+
+            if cache is None:
+                records = ((d, datacite_xml_record(d, xml, raw=raw))
+                           for d, xml in datacite_xml_json_to_list(json_response))
+            else:
+                records = _iter_cached_page(json_response, cache, headers=headers, raw=raw)
+
+            for d, dc_xml_et in records:
+                i += 1
+
+                if f:
+                    f.write(f"{d}\n")
+                if folder:
+                    save_xml(dc_xml_et, os.path.join(folder, f"{i}.xml"))
+                if store is not None:
+                    store_xml(store, d, dc_xml_et)
+
+                yield d, dc_xml_et
+
+            page += 1
+            if checkpoint is not None:
+                f.flush()
+                save_checkpoint(checkpoint, "harvest", {
+                    "doi_prefix": doi_prefix,
+                    "next_url": json_response.get("links", {}).get("next"),
+                    "doi_offset": f.tell(),
+                    "page": page,
+                    "records": i,
+                    })
+
+    LOGGER.info("Processing complete")
+
+def _open_doi_file(filename, append=False):
+    """Returns a context manager for the DOI list file, or None if not given"""
+    if filename is None:
+        return contextlib.nullcontext()
+    return open(filename, "a" if append else "w")
+
+def _iter_doi_file(filename, offset, header_line=False):
+    """Truncates a DOI file to offset and yields its DOIs
+
+    Attributes:
+        filename (str): DOI list file written by a checkpointed harvest
+        offset (int): file size at the last checkpoint
+        header_line (bool): the first line is a record count
+    """
+    with open(filename, "r+") as f:
+        f.truncate(offset)
+        f.seek(0)
+        if header_line:
+            f.readline()
+        for line in f:
+            yield line.rstrip("\n")
+
+def load_checkpoint(checkpoint):
+    """Returns the checkpoint saved in a folder, or an empty dict
+
+    Attributes:
+        checkpoint (str): folder path for checkpoints
+    """
+    checkpoint_file = pathlib.Path(checkpoint) / CHECKPOINT_FILE
+    if not checkpoint_file.is_file():
+        return {}
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+def save_checkpoint(checkpoint, stage, state):
+    """Atomically saves the state of a harvest stage in the checkpoint folder
+
+    Attributes:
+        checkpoint (str): folder path for checkpoints
+        stage (str): harvest stage, e.g. "list", "harvest" or "xml"
+        state (dict): JSON serialisable state of the stage
+    """
+    checkpoint = pathlib.Path(checkpoint)
+    checkpoint.mkdir(parents=True, exist_ok=True)
+    saved = load_checkpoint(checkpoint)
+    saved[stage] = state
+
+    tmp = checkpoint / (CHECKPOINT_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(saved, f)
+    os.replace(tmp, checkpoint / CHECKPOINT_FILE)
+
+def clear_checkpoint(checkpoint):
+    """Removes the checkpoint of a finished harvest
+
+    Attributes:
+        checkpoint (str): folder path for checkpoints
+    """
+    (pathlib.Path(checkpoint) / CHECKPOINT_FILE).unlink(missing_ok=True)
+
+def _resume_state(checkpoint, stage, doi_prefix, filename):
+    """Returns the saved state of a stage if it can be resumed, else None"""
+    if checkpoint is None:
+        return None
+
+    state = load_checkpoint(checkpoint).get(stage)
+    if state is None or state.get("doi_prefix") != doi_prefix:
+        LOGGER.info("No checkpoint for prefix %s, starting from the beginning", doi_prefix)
+        return None
+
+    if not pathlib.Path(filename).is_file() or pathlib.Path(filename).stat().st_size < state["doi_offset"]:
+        LOGGER.warning("DOI file %s does not match checkpoint, starting from the beginning", filename)
+        return None
+
+    return state
+
+def _iter_cursor_pages(url, headers=DEFAULT_HEADER, start=1):
+    """Yields the JSON response of each cursor page starting at url
+
+    Attributes:
+        url (str): URL of the first cursor page
+        headers (dict): request header to inform DataCite about API call
+        start (int): number of the first page, used for logging
+    """
+    i = start
+    while url:
+        LOGGER.debug("Getting cursor %i", i)
+        LOGGER.debug("Next url: %s", url)
+        with metrics.stage("list_page"):
+            json_response = client.get_json(url, headers=headers)
+        if not json_response["data"]:
+            return
+
+        yield json_response
+
+        url = json_response.get("links", {}).get("next")
+        i += 1
+
+def _iter_cached_page(json_response, cache, headers=DEFAULT_HEADER, raw=False):
+    """Yields (DOI, XML) pairs of a cursor page, using cache for unchanged records
+
+    Records whose updated timestamp matches their cache entry are not
+    decoded, records without XML on the page are taken from the cache or
+    requested, see get_xml_cached.
+
+    Attributes:
+        json_response (dict): cursor page with doi and updated attributes
+        cache (XMLCache): XML cache
+        headers (dict): request header to inform DataCite about API call
+        raw (bool): keep records as bytes instead of lxml trees
+    """
+    for d in json_response["data"]:
+        attributes = d["attributes"]
+        xml = get_page_xml_cached(attributes, cache, headers=headers)
+        yield attributes["doi"], datacite_xml_bytes_record(attributes["doi"], xml, raw=raw)
+
+def get_page_xml_cached(attributes, cache, headers=DEFAULT_HEADER):
+    """Returns the XML bytes of a record listed on a cursor page, using cache
+
+    The XML on the page is only decoded and put into the cache if the
+    updated timestamp does not match the cache entry. Without XML on the
+    page the record is taken from the cache or requested, see get_xml_cached.
+
+    Attributes:
+        attributes (dict): record attributes with doi, updated and xml
+        cache (XMLCache): XML cache
+        headers (dict): request header to inform DataCite about API call
+    """
+    if "xml" not in attributes:
+        return get_xml_cached(attributes["doi"], cache,
+                              updated=attributes.get("updated"),
+                              headers=headers)
+
+    entry = cache.get(attributes["doi"])
+    if entry is not None and attributes.get("updated") is not None \
+            and cache.is_fresh(entry, attributes["updated"]):
+        return entry.xml
+    with metrics.stage("decode"):
+        xml = base64.b64decode(attributes["xml"])
+    cache.put(attributes["doi"], xml, updated=attributes.get("updated"))
+    return xml
+
 def datacite_doi_json_to_list(dc_j):
     """Extracts DOI values from a list of DataCite JSON objects
 
     Attributes:
         dc_j (list): list of DataCite JSON objects
-
-    Todo:
-        * Integrate this into the scrape to reduce memory footprint
     """
     doi_list = []
 
@@ -260,6 +836,256 @@ def datacite_doi_json_to_list(dc_j):
 
     return doi_list
 
+def datacite_xml_json_to_list(dc_j):
+    """Extracts DOI and base64 encoded XML pairs from a list of DataCite JSON objects
+
+    Attributes:
+        dc_j (list): list of DataCite JSON objects
+    """
+    return [(d["attributes"]["doi"], d["attributes"]["xml"]) for d in dc_j["data"]]
+
+def datacite_xml_decode(xml):
+    """Decodes a base64 encoded DataCite XML attribute into an lxml tree
+
+    Attributes:
+        xml (str): base64 encoded XML record
+    """
+    with metrics.stage("decode"):
+        xml = base64.b64decode(xml)
+    with metrics.stage("parse"):
+        return ET.fromstring(xml)
+
+def datacite_xml_record(doi, xml, raw=False):
+    """Decodes a base64 encoded DataCite XML attribute
+
+    Attributes:
+        doi (str): full DOI string
+        xml (str): base64 encoded XML record
+        raw (bool): return a DataCiteRecord with the bytes instead of an lxml tree
+    """
+    if raw:
+        with metrics.stage("decode"):
+            return DataCiteRecord.from_base64(doi, xml)
+    return datacite_xml_decode(xml)
+
+def datacite_xml_bytes_record(doi, xml, raw=False):
+    """Returns decoded XML bytes as DataCiteRecord or lxml tree
+
+    Attributes:
+        doi (str): full DOI string
+        xml (bytes): XML record
+        raw (bool): return a DataCiteRecord instead of an lxml tree
+    """
+    if raw:
+        return DataCiteRecord(doi, xml)
+    with metrics.stage("parse"):
+        return ET.fromstring(xml)
+
+def get_xml_cached(doi,
+                   cache,
+                   updated=None,
+                   url_template=DOI_URL_TEMPLATE,
+                   headers=DEFAULT_HEADER):
+    """Returns the XML bytes of a DOI from cache, or from the API if it changed
+
+    A cached record is used as is if its updated timestamp matches updated
+    or it was checked within the cache TTL. Otherwise it is revalidated with a
+    conditional request, and a new or changed record is put into the cache.
+
+    Attributes:
+        doi (str): full DOI string
+        cache (XMLCache): XML cache
+        updated (str): updated timestamp of the record on a list page
+        url_template (str): url template for API call
+        headers (dict): request header to inform DataCite about API call
+    """
+    entry = cache.get(doi)
+    if cache.is_fresh(entry, updated):
+        LOGGER.debug("Using cached record: %s", doi)
+        return entry.xml
+
+    with metrics.stage("xml_fetch"):
+        response = client.get(url_template % (doi), headers=_conditional_headers(headers, entry))
+    return _cache_response(cache, doi, entry, response)
+
+def _conditional_headers(headers, entry):
+    """Returns headers with If-None-Match for the ETag of a cache entry"""
+    if entry is None or not entry.etag:
+        return headers
+    return {**(headers or {}), "If-None-Match": entry.etag}
+
+def _cache_response(cache, doi, entry, response):
+    """Returns the XML bytes of a DOI response, putting changed records into cache"""
+    if response.status_code == 304:
+        LOGGER.debug("Cached record not modified: %s", doi)
+        cache.touch(doi)
+        return entry.xml
+
+    attributes = response.json()["data"]["attributes"]
+    with metrics.stage("decode"):
+        xml = base64.b64decode(attributes["xml"])
+    cache.put(doi, xml, updated=attributes.get("updated"), etag=response.headers.get("ETag"))
+    return xml
+
+def save_xml(record, path):
+    """Saves a record, DataCiteRecord bytes unchanged and lxml trees pretty printed
+
+    Attributes:
+        record (DataCiteRecord or lxml element): XML record
+        path (str): file path
+    """
+    with metrics.stage("write"):
+        if isinstance(record, DataCiteRecord):
+            record.write(path)
+        else:
+            ET.ElementTree(record).write(str(path), pretty_print=True)
+
+def store_xml(store, doi, record):
+    """Puts a record into a RecordStore
+
+    Attributes:
+        store (RecordStore): record store
+        doi (str): full DOI string
+        record (DataCiteRecord or lxml element): XML record
+    """
+    with metrics.stage("write"):
+        if isinstance(record, DataCiteRecord):
+            store.put(doi, record.xml)
+        else:
+            store.put(doi, ET.tostring(record, xml_declaration=True, encoding="UTF-8", pretty_print=True))
+
+def load_xml(doi, path, raw=False):
+    """Loads a saved record as DataCiteRecord or lxml tree
+
+    Attributes:
+        doi (str): full DOI string
+        path (str): file path
+        raw (bool): return a DataCiteRecord instead of an lxml tree
+    """
+    if raw:
+        return DataCiteRecord.from_file(doi, path)
+    return ET.parse(str(path)).getroot()
+
+def sync_doi_prefix(doi_prefix="10.14454",
+                    folder="cache",
+                    page_size=1000,
+                    headers=DEFAULT_HEADER):
+    """Incremental harvest of a DOI prefix into folder
+
+    The first run harvests every record. Later runs only request records
+    updated since the last successful run, and compare the current DOI list
+    (sparse fieldset) with the saved one to remove deleted records. XML files
+    are named with doi_to_file, so they can be replaced in place. Numbered
+    files of another harvest in folder are renamed first, see
+    migrate_numbered_files.
+
+    Attributes:
+        doi_prefix (str): DOI prefix for provider
+        folder (str): path string for where to save XML files and the state file
+        page_size (int): max number of items per page
+        headers (dict): request header to inform DataCite about API call
+
+    Returns:
+        dict: DOIs added, updated and deleted by this run
+    """
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    migrate_numbered_files(folder)
+    state_file = folder / (STATE_FILE_TEMPLATE % urllib.parse.quote(doi_prefix, safe=""))
+    started = datetime.datetime.now(datetime.timezone.utc)
+
+    state = None
+    if state_file.is_file():
+        with open(state_file) as f:
+            state = json.load(f)
+
+    url = XML_CURSOR_URL_TEMPLATE % (doi_prefix, page_size)
+    if state is None:
+        LOGGER.info("No state for prefix %s, harvesting all records", doi_prefix)
+        known = set()
+        current = None
+    else:
+        since = datetime.datetime.fromisoformat(state["last_harvest"]) - UPDATED_OVERLAP
+        since = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        LOGGER.info("Harvesting records of prefix %s updated since %s", doi_prefix, since)
+        url += "&query=" + urllib.parse.quote(UPDATED_QUERY_TEMPLATE % since)
+        known = set(state["dois"])
+        current = set(iter_doi_list_cursor(doi_prefix,
+                                           url_template=SPARSE_CURSOR_URL_TEMPLATE,
+                                           page_size=page_size,
+                                           headers=headers))
+
+    changed = set()
+    for json_response in _iter_cursor_pages(url, headers=headers):
+        for d, xml in datacite_xml_json_to_list(json_response):
+            ET.ElementTree(datacite_xml_decode(xml)).write(str(folder / doi_to_file(d)),
+                                                          pretty_print=True)
+            changed.add(d)
+
+    if current is None:
+        current = changed
+
+    #new DOIs the update query did not return, e.g. registered during this run
+    missing = [d for d in current - changed if not (folder / doi_to_file(d)).is_file()]
+    for d, dc_xml_et in zip(missing, iter_xml_list_datacite(missing, headers=headers)):
+        ET.ElementTree(dc_xml_et).write(str(folder / doi_to_file(d)), pretty_print=True)
+        changed.add(d)
+
+    deleted = known - current
+    for d in deleted:
+        LOGGER.debug("Removing deleted record %s", d)
+        (folder / doi_to_file(d)).unlink(missing_ok=True)
+
+    with open(state_file, "w") as f:
+        json.dump({"doi_prefix": doi_prefix,
+                   "last_harvest": started.isoformat(),
+                   "dois": sorted(current)}, f)
+
+    result = {"added": sorted(changed - known),
+              "updated": sorted(changed & known),
+              "deleted": sorted(deleted)}
+    LOGGER.info("Sync of prefix %s complete: %i added, %i updated, %i deleted",
+                doi_prefix, len(result["added"]), len(result["updated"]), len(result["deleted"]))
+
+    return result
+
+def migrate_numbered_files(folder):
+    """Renames the numbered XML files of a list harvest (1.xml ... N.xml) with doi_to_file
+
+    The DOI is read from the identifier of each record. A file whose DOI
+    already has a file is removed.
+
+    Attributes:
+        folder (str): path string of the XML files
+
+    Returns:
+        int: number of migrated files
+
+    Raises:
+        ValueError: if a numbered file has no DOI identifier, nothing is renamed then
+    """
+    folder = pathlib.Path(folder)
+    numbered = [p for p in folder.glob("*.xml") if NUMBERED_FILE.fullmatch(p.name)]
+    renames = []
+    for path in numbered:
+        try:
+            doi = (ET.parse(str(path)).getroot().findtext("{*}identifier") or "").strip()
+        except ET.XMLSyntaxError as e:
+            raise ValueError(f"Cannot read the DOI of {path}: {e}")
+        if not doi:
+            raise ValueError(f"{path} has no DOI identifier")
+        renames.append((path, folder / doi_to_file(doi)))
+
+    for path, target in renames:
+        if target.is_file():
+            path.unlink()
+        else:
+            path.rename(target)
+
+    if renames:
+        LOGGER.info("Renamed %i numbered XML files in %s to DOI file names", len(renames), folder)
+    return len(renames)
+
 def get_xml_list():
     """Calls the resource appropriate function to obtain DOI XML records
 
@@ -272,7 +1098,13 @@ def get_xml_list():
 def get_xml_list_datacite(doi_list=["10.14454/FXWS-0523"],
                           url_template = DOI_URL_TEMPLATE,
                           headers=DEFAULT_HEADER,
-                          folder=None):
+                          folder=None,
+                          checkpoint=None,
+                          resume=False,
+                          raw=False,
+                          store=None,
+                          cache=None,
+                          updated=None):
     """Explictly API based call to get DOI XML record
 
     Attributes:
@@ -280,32 +1112,263 @@ def get_xml_list_datacite(doi_list=["10.14454/FXWS-0523"],
         url_template (str): url template for API call
         headers (dict): request header to inform DataCite about API call
         folder (str): path string for where to save XML files
+        checkpoint (str): folder path for checkpoints, see iter_xml_list_datacite
+        resume (bool): continue from the last checkpoint
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into
+        cache (XMLCache): XML cache to reuse unchanged records from
+        updated (dict): updated timestamps by DOI, e.g. from list pages
+    """
+    return list(iter_xml_list_datacite(doi_list,
+                                       url_template=url_template,
+                                       headers=headers,
+                                       folder=folder,
+                                       checkpoint=checkpoint,
+                                       resume=resume,
+                                       raw=raw,
+                                       store=store,
+                                       cache=cache,
+                                       updated=updated))
+
+def iter_xml_list_datacite(doi_list=["10.14454/FXWS-0523"],
+                           url_template = DOI_URL_TEMPLATE,
+                           headers=DEFAULT_HEADER,
+                           folder=None,
+                           checkpoint=None,
+                           resume=False,
+                           raw=False,
+                           store=None,
+                           cache=None,
+                           updated=None):
+    """Generator variant of get_xml_list_datacite
+
+    doi_list can be any iterable, e.g. iter_doi_list_cursor, and each
+    record is saved and yielded before the next DOI is consumed. With raw
+    the decoded bytes are written unchanged and DataCiteRecord objects are
+    yielded.
+
+    With a checkpoint folder the number of saved records is stored every
+    CHECKPOINT_INTERVAL records. On resume these records are read back from
+    folder instead of being requested again.
+
+    With a cache records are taken from it when their updated timestamp
+    matches or their cache TTL has not expired, see get_xml_cached.
 
-    Todo:
-        * Rate limiting needed
+    Attributes:
+        doi_list (iterable): full DOI strings
+        url_template (str): url template for API call
+        headers (dict): request header to inform DataCite about API call
+        folder (str): path string for where to save XML files
+        checkpoint (str): folder path for checkpoints
+        resume (bool): continue from the last checkpoint
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into, in addition to or instead of folder
+        cache (XMLCache): XML cache to reuse unchanged records from
+        updated (dict): updated timestamps by DOI, e.g. from list pages
     """
     if folder:
         if not pathlib.Path(folder).is_dir():
             pathlib.Path(folder).mkdir(parents=True)
-            
-    xml_list = []
+
+    updated = updated or {}
+    done = 0
+    if resume and folder and checkpoint is not None:
+        done = load_checkpoint(checkpoint).get("xml", {}).get("records", 0)
+        LOGGER.info("Resuming XML harvest after %i records", done)
+
     LOGGER.info("Getting DOI record XML")
+    i = 0
     for i,d in enumerate(doi_list, start=1):
+        if i <= done:
+            yield load_xml(d, os.path.join(folder, f"{i}.xml"), raw=raw)
+            continue
+
         LOGGER.debug("Getting record %i: %s", i, d)
-        url = url_template % (d)
-        data = None
-        response = requests.get(url, headers=headers, data=data, timeout=TIMEOUT)
-        dc_xml_et = ET.fromstring(
-            base64.b64decode(
-                json.loads(response.text)["data"]["attributes"]["xml"]))
+        if cache is not None:
+            dc_xml_et = datacite_xml_bytes_record(
+                d, get_xml_cached(d, cache, updated=updated.get(d),
+                                  url_template=url_template, headers=headers), raw=raw)
+        else:
+            url = url_template % (d)
+            with metrics.stage("xml_fetch"):
+                json_response = client.get_json(url, headers=headers)
+            dc_xml_et = datacite_xml_record(d, json_response["data"]["attributes"]["xml"], raw=raw)
 
         if folder:
             LOGGER.debug("Saving record to disk")
-            ET.ElementTree(dc_xml_et).write(os.path.join(folder, f"{i}.xml"), pretty_print=True)
+            save_xml(dc_xml_et, os.path.join(folder, f"{i}.xml"))
+        if store is not None:
+            store_xml(store, d, dc_xml_et)
+
+        if checkpoint is not None and i % CHECKPOINT_INTERVAL == 0:
+            save_checkpoint(checkpoint, "xml", {"records": i})
+
+        yield dc_xml_et
+
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, "xml", {"records": i})
+
+async def get_xml_list_datacite_async(doi_list=["10.14454/FXWS-0523"],
+                                      url_template = DOI_URL_TEMPLATE,
+                                      headers=DEFAULT_HEADER,
+                                      folder=None,
+                                      concurrency=CONCURRENCY,
+                                      raw=False,
+                                      store=None,
+                                      cache=None,
+                                      updated=None,
+                                      checkpoint=None,
+                                      resume=False):
+    """Concurrent API based call to get DOI XML records
+
+    Records are fetched, decoded and saved by a fixed number of workers
+    sharing one connection pool. The result has the same order and shape
+    as get_xml_list_datacite. doi_list can be any iterable, e.g.
+    iter_doi_list_cursor: DOIs are read in a thread as workers need them.
+
+    With a checkpoint folder the number of records saved without a gap is
+    stored every CHECKPOINT_INTERVAL records, as by iter_xml_list_datacite,
+    and on resume these records are read back from folder.
 
-        xml_list.append(dc_xml_et)
+    Attributes:
+        doi_list (iterable): full DOI strings
+        url_template (str): url template for API call
+        headers (dict): request header to inform DataCite about API call
+        folder (str): path string for where to save XML files
+        concurrency (int): max number of requests in flight
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into
+        cache (XMLCache): XML cache to reuse unchanged records from
+        updated (dict): updated timestamps by DOI, e.g. from list pages
+        checkpoint (str): folder path for checkpoints
+        resume (bool): continue from the last checkpoint
+    """
+    if folder:
+        if not pathlib.Path(folder).is_dir():
+            pathlib.Path(folder).mkdir(parents=True)
 
-    return xml_list
+    done = 0
+    if resume and folder and checkpoint is not None:
+        done = load_checkpoint(checkpoint).get("xml", {}).get("records", 0)
+        LOGGER.info("Resuming XML harvest after %i records", done)
+    #records saved out of order, the checkpoint only advances over records without a gap
+    ahead = set()
+    progress = {"records": done, "checkpoint": done}
+
+    def record_saved(i):
+        ahead.add(i)
+        while progress["records"] + 1 in ahead:
+            ahead.remove(progress["records"] + 1)
+            progress["records"] += 1
+        if checkpoint is not None and progress["records"] - progress["checkpoint"] >= CHECKPOINT_INTERVAL:
+            progress["checkpoint"] = progress["records"]
+            save_checkpoint(checkpoint, "xml", {"records": progress["records"]})
+
+    updated = updated or {}
+    workers = max(1, concurrency)
+    results = {}
+    dois = enumerate(doi_list, start=1)
+    queue = asyncio.Queue(maxsize=2 * workers)
+
+    async def feed():
+        #a generator may block on list requests, so it is read in a thread
+        while batch := await asyncio.to_thread(lambda: list(itertools.islice(dois, workers))):
+            for item in batch:
+                await queue.put(item)
+        for _ in range(workers):
+            await queue.put(None)
+
+    LOGGER.info("Getting DOI record XML with %i worker(s)", concurrency)
+    async with client.new_async_client(pool_size=concurrency, headers=headers) as async_client:
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                i, d = item
+                metrics.QUEUE_DEPTH.set(queue.qsize(), queue="xml_fetch")
+                if i <= done:
+                    results[i] = await asyncio.to_thread(load_xml, d, os.path.join(folder, f"{i}.xml"), raw)
+                    continue
+
+                LOGGER.debug("Getting record %i: %s", i, d)
+                url = url_template % (d)
+                if cache is not None:
+                    entry = cache.get(d)
+                    if cache.is_fresh(entry, updated.get(d)):
+                        xml = entry.xml
+                    else:
+                        with metrics.stage("xml_fetch"):
+                            response = await client.async_get(async_client, url,
+                                                              headers=_conditional_headers(None, entry))
+                        xml = await asyncio.to_thread(_cache_response, cache, d, entry, response)
+                    dc_xml_et = datacite_xml_bytes_record(d, xml, raw=raw)
+                else:
+                    with metrics.stage("xml_fetch"):
+                        response = await client.async_get(async_client, url)
+                    dc_xml_et = datacite_xml_record(
+                        d, response.json()["data"]["attributes"]["xml"], raw=raw)
+
+                if folder:
+                    LOGGER.debug("Saving record to disk")
+                    await asyncio.to_thread(save_xml, dc_xml_et,
+                                            os.path.join(folder, f"{i}.xml"))
+                if store is not None:
+                    await asyncio.to_thread(store_xml, store, d, dc_xml_et)
+
+                results[i] = dc_xml_et
+                record_saved(i)
+
+        tasks = [asyncio.create_task(feed())] + [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            #stop the other tasks if one of them failed
+            for task in tasks:
+                task.cancel()
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, "xml", {"records": progress["records"]})
+
+    return [results[i] for i in range(1, len(results) + 1)]
+
+def get_xml_list_datacite_concurrent(doi_list=["10.14454/FXWS-0523"],
+                                     url_template = DOI_URL_TEMPLATE,
+                                     headers=DEFAULT_HEADER,
+                                     folder=None,
+                                     concurrency=CONCURRENCY,
+                                     raw=False,
+                                     store=None,
+                                     cache=None,
+                                     updated=None,
+                                     checkpoint=None,
+                                     resume=False):
+    """Blocking wrapper around get_xml_list_datacite_async
+
+    Attributes:
+        doi_list (iterable): full DOI strings
+        url_template (str): url template for API call
+        headers (dict): request header to inform DataCite about API call
+        folder (str): path string for where to save XML files
+        concurrency (int): max number of requests in flight
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into
+        cache (XMLCache): XML cache to reuse unchanged records from
+        updated (dict): updated timestamps by DOI, e.g. from list pages
+        checkpoint (str): folder path for checkpoints
+        resume (bool): continue from the last checkpoint
+    """
+    return asyncio.run(get_xml_list_datacite_async(doi_list,
+                                                   url_template=url_template,
+                                                   headers=headers,
+                                                   folder=folder,
+                                                   concurrency=concurrency,
+                                                   raw=raw,
+                                                   store=store,
+                                                   cache=cache,
+                                                   updated=updated,
+                                                   checkpoint=checkpoint,
+                                                   resume=resume))
 
 def get_xml_list_bolognese(doi_url="https://doi.org/10.7554/elife.01567",
                            docker_image="bolognese-cli"):
@@ -314,11 +1377,11 @@ def get_xml_list_bolognese(doi_url="https://doi.org/10.7554/elife.01567",
     Attributes:
         doi_url (str): full DOI URL
 
+    Note: Starts a container per DOI, use iter_xml_list_bolognese for lists
+
     Todo:
         * Rate limiting needed
         * Bolognese should support request headers
-        * Bolognese should support DOI batch requests
-        * Batch requests would need a path string for where to save XML files        
     """
     try:
         xml = docker.run(docker_image,
@@ -330,6 +1393,44 @@ def get_xml_list_bolognese(doi_url="https://doi.org/10.7554/elife.01567",
     except d_exceptions.NoSuchImage as e:
         LOGGER.error("Docker image not found")
 
+def iter_xml_list_bolognese(doi_list=["10.14454/FXWS-0523"],
+                            worker=None,
+                            folder=None,
+                            raw=False,
+                            store=None):
+    """Converts DOIs to DataCite XML records with long-lived Bolognese workers
+
+    DOIs are sent in batches to the worker processes, see BologneseWorker,
+    instead of starting a container per DOI. DOIs Bolognese cannot convert
+    are logged and skipped, saved files keep the list position as name.
+
+    Attributes:
+        doi_list (iterable): full DOI strings
+        worker (BologneseWorker): worker pool, a default pool is started and closed if None
+        folder (str): path string for where to save XML files
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store to put records into
+    """
+    if folder:
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+
+    with contextlib.ExitStack() as stack:
+        if worker is None:
+            worker = stack.enter_context(BologneseWorker())
+
+        dois = (d if d.startswith("http") else f"https://doi.org/{d}" for d in doi_list)
+        for i, (doi_url, xml, error) in enumerate(worker.iter_convert(dois, to="datacite"), start=1):
+            if error is not None:
+                LOGGER.error("Bolognese failed for %s: %s", doi_url, error)
+                continue
+            d = doi_url.split("doi.org/", 1)[-1]
+            dc_xml_et = datacite_xml_bytes_record(d, xml.encode("utf-8"), raw=raw)
+            if folder:
+                save_xml(dc_xml_et, os.path.join(folder, f"{i}.xml"))
+            if store is not None:
+                store_xml(store, d, dc_xml_et)
+            yield dc_xml_et
+
 if __name__ == "__test__":
     #example pagination
     DOI_PREFIX_EAWAG = "10.25678"
@@ -350,13 +1451,67 @@ if __name__ == "__test__":
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("doi_prefix",
-                        help="DOI prefix used to get suffixes")
+                        help="DOI prefix used to get suffixes, several comma separated, or provider id(s) with --provider")
     parser.add_argument("mailto",
                         help="contanct email address for the User-Agent header")
-    parser.add_argument("-d", "--doi", type=argparse.FileType('w', encoding='UTF-8'),
+    parser.add_argument("-d", "--doi", type=pathlib.Path,
                         help="JSON output file for DOI")
     parser.add_argument("-c", "--cache", type=pathlib.Path,
-                        help="Output folder to cache results")
+                        help="Output folder, or record store file (.sqlite, .db), to cache results")
+    parser.add_argument("--compress", action="store_true",
+                        help="zlib compress records when the cache is a record store file")
+    parser.add_argument("--xml-cache", type=pathlib.Path,
+                        help="SQLite file of cached XML records reused while unchanged")
+    parser.add_argument("--xml-cache-ttl", type=float,
+                        help="seconds a cached record is reused without asking DataCite")
+    parser.add_argument("--xml-cache-max-mb", type=int,
+                        help="evict least recently used records above this cache size")
+    parser.add_argument("--provider", action="store_true",
+                        help="doi_prefix are DataCite provider ids whose prefixes are harvested")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="number of prefixes harvested in parallel for several prefixes or --provider")
+    parser.add_argument("-j", "--concurrency", type=int, default=1,
+                        help="number of XML records fetched in parallel")
+    parser.add_argument("--harvest", action="store_true",
+                        help="get DOIs and XML records from the same cursor pages")
+    parser.add_argument("--sparse", action="store_true",
+                        help="only request the DOI attribute on list pages")
+    parser.add_argument("--raw", action="store_true",
+                        help="save XML records as received without parsing them")
+    parser.add_argument("--stream", action="store_true",
+                        help="write records as they arrive instead of collecting them in memory")
+    parser.add_argument("--attributes", type=pathlib.Path,
+                        help="write list page attributes to a JSON Lines (.jsonl, .jsonl.gz) or Parquet (.parquet) dataset")
+    parser.add_argument("--fields", default=",".join(METADATA_FIELDS),
+                        help="comma separated attributes written with --attributes")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap listing, decoding and writing in bounded queues of list pages")
+    parser.add_argument("--decode-workers", type=int, default=1,
+                        help="decoding threads with --pipeline")
+    parser.add_argument("--write-workers", type=int, default=1,
+                        help="writing threads with --pipeline")
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="capacity of each stage queue in pages with --pipeline")
+    parser.add_argument("--shard", choices=list(SHARD_FACETS),
+                        help="list DOIs with one parallel cursor per facet slice")
+    parser.add_argument("-z", "--archive", type=pathlib.Path,
+                        help="stream all XML records into an archive (.zip, .tar.gz or .tar.zst)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch records changed since the last run into the cache folder")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint in the cache folder")
+    parser.add_argument("--pool-size", type=int, default=client.POOL_SIZE,
+                        help="max number of pooled HTTP connections")
+    parser.add_argument("--timeout", type=float, default=client.TIMEOUT,
+                        help="HTTP read timeout in seconds")
+    parser.add_argument("--rate", type=float, default=ratelimit.RATE,
+                        help="max requests per second to DataCite")
+    parser.add_argument("--retries", type=int, default=ratelimit.MAX_RETRIES,
+                        help="retries for a failed or throttled request")
+    parser.add_argument("--rate-file", type=pathlib.Path,
+                        help="state file to share the rate limit between processes")
+    parser.add_argument("--http2", action="store_true",
+                        help="use HTTP/2 if the h2 package is installed")
     parser.add_argument("-l", "--log", type=argparse.FileType('w', encoding='UTF-8'),
                         help="Output file for log")
     parser.add_argument("-v", action="count", default=0,
@@ -374,6 +1529,15 @@ if __name__ == "__main__":
 
     ##consider adding an ERROR level logging
 
+    client.configure(pool_size=max(args.pool_size, args.concurrency),
+                     timeout=args.timeout,
+                     http2=args.http2)
+
+    ratelimit.configure(rate=args.rate,
+                        max_retries=args.retries,
+                        host_concurrency=max(ratelimit.HOST_CONCURRENCY, args.concurrency),
+                        path=args.rate_file)
+
     #set User-Agent for requests
     headers={"User-Agent": USER_AGENT,
              "From": args.mailto}  
@@ -387,7 +1551,7 @@ if __name__ == "__main__":
         logging.basicConfig(level=logging.DEBUG, handlers=[handler])
         root_logger.addHandler(handler)
         LOGGER.info("Logging to sys.stdout enabled")
-        LOGGER.info("Results will be written to \"%s\"", args.doi.name)
+        LOGGER.info("Results will be written to \"%s\"", args.doi)
 
     #logging to the specified file
     if args.log is not None:
@@ -426,15 +1590,176 @@ if __name__ == "__main__":
                 args.mailto,
                 LOG_LEVEL)
 
+    doi_file = args.doi
+
+    #the cache is either a folder of XML files or a single-file record store
+    folder = args.cache
+    store = None
+    if args.cache is not None and is_store_path(args.cache):
+        store = RecordStore(args.cache, compress=args.compress)
+        atexit.register(store.close)
+        folder = None
+    checkpoint = folder
+
+    cache = None
+    if args.xml_cache is not None:
+        cache = XMLCache(args.xml_cache,
+                         ttl=args.xml_cache_ttl,
+                         max_bytes=args.xml_cache_max_mb and args.xml_cache_max_mb * 2**20)
+        atexit.register(cache.close)
+        atexit.register(cache.evict)
+
+    if args.resume and folder is None:
+        parser.error("--resume requires -c/--cache with a folder")
+
+    if args.provider or "," in args.doi_prefix:
+        #imported here as the scheduler itself builds on this module
+        from app.doi_agency.scheduler import harvest_prefixes
+
+        ids = [i.strip() for i in args.doi_prefix.split(",") if i.strip()]
+        result = harvest_prefixes(doi_prefixes=[] if args.provider else ids,
+                                  provider_ids=ids if args.provider else [],
+                                  folder=folder,
+                                  headers=headers,
+                                  workers=args.workers,
+                                  raw=args.raw,
+                                  store=store,
+                                  cache=cache,
+                                  callback=lambda p: LOGGER.info("Harvested %i of %i records",
+                                                                 p["records"], p["total"]))
+        print({k: result[k] for k in ("records", "total", "done", "failed")})
+        sys.exit(1 if result["failed"] else 0)
+
+    if args.incremental:
+        if folder is None:
+            parser.error("--incremental requires -c/--cache with a folder")
+        try:
+            result = sync_doi_prefix(args.doi_prefix, folder=folder, headers=headers)
+        except ValueError as e:
+            parser.error(f"--incremental cannot use the cache folder: {e}")
+        print({k: len(v) for k, v in result.items()})
+        sys.exit(0)
+
+    if args.attributes:
+        #imported here as the export stage itself builds on this module
+        from app.doi_agency.export import export_attributes
+
+        fields = [f.strip() for f in args.fields.split(",") if f.strip()]
+        print(export_attributes(args.doi_prefix, args.attributes, fields=fields, headers=headers))
+        sys.exit(0)
+
+    if args.pipeline:
+        #imported here as the pipeline itself builds on this module
+        from app.doi_agency.export import write_archive
+        from app.doi_agency.pipeline import harvest_pipeline
+
+        pipeline = harvest_pipeline(args.doi_prefix,
+                                    headers=headers,
+                                    folder=folder,
+                                    store=store,
+                                    cache=cache,
+                                    raw=args.raw or args.archive is not None,
+                                    filename=doi_file,
+                                    decode_workers=args.decode_workers,
+                                    write_workers=args.write_workers,
+                                    queue_size=args.queue_size)
+        if args.archive:
+            #packaging consumes the written pages while the harvest goes on, see the consumer stats
+            write_archive(((doi_to_file(d), r.xml) for page in pipeline for d, r in page), args.archive)
+        else:
+            pipeline.run()
+        print(json.dumps(pipeline.stats(), indent=2))
+        sys.exit(0)
+
+    if args.archive:
+        #imported here as the export stage itself builds on this module
+        from app.doi_agency.export import iter_prefix_records, write_archive
+
+        write_archive(iter_prefix_records(args.doi_prefix, headers=headers), args.archive)
+        sys.exit(0)
+
+    if args.stream:
+        #bounded memory: records are written as their page arrives
+        if args.harvest:
+            records = (x for _, x in iter_doi_xml_list_cursor(args.doi_prefix,
+                                                              headers=headers,
+                                                              filename=doi_file,
+                                                              folder=folder,
+                                                              store=store,
+                                                              cache=cache,
+                                                              checkpoint=checkpoint,
+                                                              resume=args.resume,
+                                                              raw=args.raw))
+        else:
+            url_template = SPARSE_CURSOR_URL_TEMPLATE if args.sparse else CURSOR_URL_TEMPLATE
+            dois = iter_doi_list_cursor(args.doi_prefix, url_template=url_template,
+                                        headers=headers, filename=doi_file,
+                                        checkpoint=checkpoint, resume=args.resume)
+            records = iter_xml_list_datacite(dois, headers=headers,
+                                             folder=folder, store=store, cache=cache,
+                                             checkpoint=checkpoint, resume=args.resume,
+                                             raw=args.raw)
+
+        for dc_xml_et in records:
+            if args.cache is None:
+                if args.raw:
+                    print(dc_xml_et.xml.decode())
+                else:
+                    print(ET.tostring(dc_xml_et, encoding="unicode"))
+        if checkpoint is not None:
+            clear_checkpoint(checkpoint)
+        sys.exit(0)
+
+    if args.harvest:
+        #DOI list and XML records from the same cursor pages
+        doi_list, xml_list = get_doi_xml_list_cursor(args.doi_prefix,
+                                                     headers=headers,
+                                                     filename=doi_file,
+                                                     folder=folder,
+                                                     store=store,
+                                                     cache=cache,
+                                                     checkpoint=checkpoint,
+                                                     resume=args.resume,
+                                                     raw=args.raw)
+        if args.doi is None:
+            print(doi_list)
+        if args.cache is None:
+            print(xml_list)
+        if checkpoint is not None:
+            clear_checkpoint(checkpoint)
+        sys.exit(0)
+
+    url_template = SPARSE_CURSOR_URL_TEMPLATE if args.sparse else CURSOR_URL_TEMPLATE
+    if args.shard:
+        doi_list = get_doi_list_sharded(args.doi_prefix, shard=args.shard,
+                                        headers=headers, filename=doi_file,
+                                        checkpoint=checkpoint, resume=args.resume)
+    else:
+        doi_list = get_doi_list_cursor(args.doi_prefix, url_template=url_template,
+                                       headers=headers, filename=doi_file,
+                                       checkpoint=checkpoint, resume=args.resume)
     if args.doi is None:
-        doi_list = get_doi_list_cursor(args.doi_prefix, headers=headers)
         print(doi_list)
-    else:
-        doi_list = get_doi_list_cursor(args.doi_prefix,headers=headers, filename=args.doi.name)
 
     LOGGER.info("Begin scrape of DOI records.")
 
+    if args.concurrency > 1:
+        get_xml = functools.partial(get_xml_list_datacite_concurrent,
+                                    concurrency=args.concurrency,
+                                    checkpoint=checkpoint,
+                                    resume=args.resume,
+                                    raw=args.raw,
+                                    cache=cache)
+    else:
+        get_xml = functools.partial(get_xml_list_datacite,
+                                    checkpoint=checkpoint,
+                                    resume=args.resume,
+                                    raw=args.raw,
+                                    cache=cache)
+
     if args.cache is None:
-        print(get_xml_list_datacite(doi_list, headers=headers))
+        print(get_xml(doi_list, headers=headers))
     else:
-        get_xml_list_datacite(doi_list, headers=headers, folder=args.cache)
+        get_xml(doi_list, headers=headers, folder=folder, store=store)
+        if checkpoint is not None:
+            clear_checkpoint(checkpoint)
@@ -0,0 +1,200 @@
+"""DCAT-AP CH conversion of harvested DataCite XML records.
+
+Records are transformed with the XSLT stylesheets in the xslt folder. Every
+worker process compiles a stylesheet once and converts records in batches, so
+converting a prefix scales with the number of cores. The SHA-256 of every
+converted source record, together with the stylesheet, is kept next to the
+output store, which lets later runs convert only new and changed records and
+convert everything again once the stylesheet changes.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import time
+from logging import getLogger
+from typing import Iterable
+
+from lxml import etree as ET
+
+from app.doi_agency import metrics
+from app.doi_agency.store import RecordStore
+from app.doi_agency.utils import iter_batches, iter_process_pool
+
+log = getLogger(__name__)
+
+XSLT_FOLDER = pathlib.Path(__file__).resolve().parent / "xslt"
+DCAT_AP_CH_XSLT = XSLT_FOLDER / "datacite_dcat_ap_ch.xsl"
+DCAT_FOLDER = "dcat"
+DIGESTS_SUFFIX = ".digests.json"
+BATCH_SIZE = 100
+
+#compiled stylesheets of this process by path
+_transforms = {}
+
+
+def get_transform(xslt=DCAT_AP_CH_XSLT) -> ET.XSLT:
+    """Return the compiled stylesheet at xslt, compiling it on first use in this process.
+
+    Args:
+        xslt (str): XSLT file
+
+    Returns:
+        lxml.etree.XSLT
+    """
+    key = str(xslt)
+    if key not in _transforms:
+        _transforms[key] = ET.XSLT(ET.parse(key))
+    return _transforms[key]
+
+
+def dcat_store_path(folder, doi_prefix: str) -> pathlib.Path:
+    """Return the DCAT-AP CH store of doi_prefix in folder.
+
+    Args:
+        folder (str): folder of the DCAT stores, e.g. the dcat folder in the cache
+        doi_prefix (str): DOI prefix for provider
+
+    Returns:
+        pathlib.Path
+    """
+    return pathlib.Path(folder) / f"{doi_prefix.replace('/', '_')}.sqlite"
+
+
+def convert_record(xml: bytes, xslt=DCAT_AP_CH_XSLT) -> tuple[str, bytes]:
+    """Return DOI and DCAT-AP CH RDF/XML of a DataCite XML record.
+
+    Args:
+        xml (bytes): DataCite XML record
+        xslt (str): XSLT file
+
+    Returns:
+        tuple[str, bytes]
+    """
+    doc = ET.fromstring(xml)
+    doi = (doc.findtext("{*}identifier") or "").strip()
+    return doi, bytes(get_transform(xslt)(doc))
+
+
+def _init_worker(xslt: str) -> None:
+    """Compile the stylesheet once when a worker process starts."""
+    get_transform(xslt)
+
+
+def _convert_batch(batch: list[tuple[str, str, bytes]], xslt: str) -> tuple[list, list, float]:
+    """Convert (name, digest, XML) records, return conversions, errors and seconds taken."""
+    start = time.perf_counter()
+    converted = []
+    errors = []
+    for name, digest, xml in batch:
+        try:
+            doi, dcat = convert_record(xml, xslt)
+            converted.append((digest, doi or name, dcat))
+        except ET.Error as e:
+            errors.append((name, str(e)))
+    return converted, errors, time.perf_counter() - start
+
+
+def _digests_path(output: RecordStore) -> pathlib.Path:
+    return output.path.with_name(output.path.name + DIGESTS_SUFFIX)
+
+
+def load_digests(output: RecordStore) -> dict:
+    """Return {SHA-256 of stylesheet and source: DOI} of the records converted into output.
+
+    Args:
+        output (RecordStore): DCAT-AP CH store
+
+    Returns:
+        dict
+    """
+    try:
+        with open(_digests_path(output)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_digests(output: RecordStore, digests: dict) -> None:
+    """Atomically replace the source digests of output.
+
+    Args:
+        output (RecordStore): DCAT-AP CH store
+        digests (dict): {SHA-256 of stylesheet and source: DOI}
+    """
+    path = _digests_path(output)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(digests, f)
+    os.replace(tmp, path)
+
+
+def convert_records(records: Iterable[tuple[str, bytes]],
+                    output: RecordStore,
+                    xslt=DCAT_AP_CH_XSLT,
+                    workers: int | None = None,
+                    changed_only: bool = True,
+                    batch_size: int = BATCH_SIZE) -> dict:
+    """Convert DataCite XML records to DCAT-AP CH and put them into output by DOI.
+
+    Batches of records are converted by a pool of worker processes, at most
+    two batches per worker are in flight so records are read as they are
+    needed. With changed_only records whose source XML was converted before
+    with the same stylesheet are skipped. records is taken as the complete record set: the digests
+    and DCAT-AP CH records of DOIs not converted or unchanged in this run,
+    i.e. deleted at DataCite or failing conversion, are removed from output.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): (name, XML) records, e.g. from
+            export.iter_folder_records or export.iter_store_records
+        output (RecordStore): store for the DCAT-AP CH records
+        xslt (str): XSLT file
+        workers (int | None): worker processes, default one per core, 1 converts in this process
+        changed_only (bool): skip records converted before
+        batch_size (int): records per task
+
+    Returns:
+        dict with the number of converted, unchanged, failed and deleted records
+    """
+    xslt = str(xslt)
+    known = load_digests(output) if changed_only else {}
+    digests = {}
+    counts = {"converted": 0, "unchanged": 0, "failed": 0, "deleted": 0}
+    #a changed stylesheet changes every digest, so all records are converted again
+    stylesheet = hashlib.sha256(pathlib.Path(xslt).read_bytes())
+
+    def changed():
+        for name, xml in records:
+            source = stylesheet.copy()
+            source.update(xml)
+            digest = source.hexdigest()
+            if digest in known:
+                digests[digest] = known[digest]
+                counts["unchanged"] += 1
+            else:
+                yield name, digest, xml
+
+    results = iter_process_pool(functools.partial(_convert_batch, xslt=xslt),
+                                iter_batches(changed(), batch_size),
+                                workers=workers, initializer=_init_worker, initargs=(xslt,))
+    for converted, errors, seconds in results:
+        metrics.observe_stage("dcat", seconds)
+        for digest, doi, dcat in converted:
+            output.put(doi, dcat)
+            digests[digest] = doi
+        for name, error in errors:
+            log.error(f"DCAT-AP CH conversion of {name} failed: {error}")
+        counts["converted"] += len(converted)
+        counts["failed"] += len(errors)
+
+    seen = {doi.lower() for doi in digests.values()}
+    for doi in [doi for doi in output.dois() if doi not in seen]:
+        output.delete(doi)
+        counts["deleted"] += 1
+
+    output.commit()
+    save_digests(output, digests)
+    log.info(f"DCAT-AP CH conversion into {output.path}: {counts}")
+    return counts
@@ -1,34 +1,66 @@
 """Router used to gather DOI records from a DOI agency given a DOI prefix.
 """
 import logging
+import os
 from typing import Annotated, List, Any, Dict
 from pydantic import TypeAdapter, ValidationError
 
 from fastapi import APIRouter, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+
+from app.config import config_app
 
 from app.doi_agency.constants import ConvertSuccess, ConvertError, DOIAgency
 #from app.external_doi.dryad import convert_dryad_doi
 #from app.external_doi.utils import get_doi_external_platform, convert_doi
 #from app.external_doi.zenodo import convert_zenodo_doi
 
-from app.doi_agency.utils import get_doi_agency
-from app.doi_agency.datacite import get_doi_list_fastapi
+from app.doi_agency.utils import (
+    get_doi_agency,
+    iterate_blocking,
+    run_blocking,
+    set_router_threads,
+)
+from app.doi_agency.datacite import USER_AGENT
+from app.doi_agency.export import (
+    ARCHIVE_FORMATS,
+    STREAM_FORMATS,
+    archive_format_available,
+    iter_archive,
+    iter_folder_records,
+    iter_prefix_dois,
+    iter_prefix_records,
+    iter_stream,
+)
+from app.doi_agency.jobs import (
+    DONE,
+    DOI_FILE,
+    XML_CACHE_FILE,
+    XML_FOLDER,
+    job_folder,
+    public_status,
+    read_job_status,
+    resume_job,
+    submit_job,
+)
 
 log = logging.getLogger(__name__)
 
 # Setup doi_agency router
 router = APIRouter(prefix="/doi_agency", tags=["doi_agency"])
 
+# Disk and network work of the routes runs in a bounded thread pool, never on the event loop
+set_router_threads(config_app.ROUTER_THREADS)
+
 
 @router.get(
     "/list",
     name="doi_list",
-    status_code=200,
+    status_code=202,
     responses={
-        200: {
+        202: {
             "model": Dict[str, Any],
-            "description": "DOI list successfully returned",
+            "description": "DOI list request started",
         },
         400: {"model": ConvertError},
         404: {"model": ConvertError},
@@ -79,10 +111,22 @@ async def convert_external_doi(
             description="If true conversion to the DCAT-AP CH format is triggered.",
         ),
     ] = False,
+    refresh: Annotated[
+        bool,
+        Query(description="If true a finished harvest of the same prefix is not reused."),
+    ] = False,
+    validate: Annotated[
+        bool,
+        Query(description="If true the records are validated against their DataCite schema."),
+    ] = False,
 ):
     """Retrieve a DOI list given the DOI prefix
 
-    Currently supports DOIs issued by DataCite.
+    Currently supports DOIs issued by DataCite. A harvest of the same prefix
+    that is still running, or finished recently, is shared instead of
+    starting another one. With the DCAT-AP CH flag the harvested records
+    are converted afterwards, and with validate checked against their
+    DataCite schema. The request status reports the results.
     """
 
     try:
@@ -92,40 +136,276 @@ async def convert_external_doi(
 #                log.info("Here")
 #                result = get_doi_list_cursor(doi_prefix=doi_prefix)
 
-        result = get_doi_list_fastapi(doi_prefix=doi_prefix, cache=os.getenv("CACHE"))
+        headers = {"User-Agent": USER_AGENT, "From": user_agent}
+        result = await run_blocking(submit_job,
+                                    doi_prefix=doi_prefix,
+                                    cache=config_app.CACHE,
+                                    headers=headers,
+                                    max_workers=config_app.JOB_WORKERS,
+                                    xml_cache=os.path.join(config_app.CACHE, XML_CACHE_FILE),
+                                    doi_agency=doi_agency_name,
+                                    coalesce_ttl=0 if refresh else config_app.COALESCE_TTL,
+                                    dcat=dcat_trigger,
+                                    validate=validate,
+                                    retention=config_app.JOB_RETENTION,
+                                    process_workers=config_app.PROCESS_WORKERS)
 
-        cont = result.get("result", {})
         sc = result.get("status_code", 500)
-        return JSONResponse(content=cont, status_code=sc)
-
-    except:
-        pass
-        
-##        # Extract status code from conversion result
-##        sc = result.get("status_code", 500)
-##
-##        # Return result if conversion successful
-##        if is_type_valid(result, ConvertSuccess):
-##            cont = result.get("result", {})
-##            return JSONResponse(content=cont, status_code=sc)
-##
-##        # Return error if conversion failed
-##        elif is_type_valid(result, ConvertError):
-##            return JSONResponse(content=result, status_code=sc)
-##
-##        # Else raise exception if result cannot be validated as success or error
-##        else:
-##            raise Exception("Failed to validate result of conversion")
-##
-##    except Exception as e:
-##        log.error(e)
-##        return JSONResponse(
-##            {
-##                "status_code": 500,
-##                "message": "Failed to bind to DOI agency '%s'" % doi_agency_name,
-##                "error": "Check logs for error",
-##            }
-##        )
+        return JSONResponse(content=result, status_code=sc)
+
+    except Exception as e:
+        log.error(e)
+        return JSONResponse(
+            {
+                "status_code": 500,
+                "message": "Failed to bind to DOI agency '%s'" % doi_agency_name,
+                "error": "Check logs for error",
+            },
+            status_code=500,
+        )
+
+
+@router.get(
+    "/request",
+    name="doi_list_status",
+    status_code=200,
+    responses={
+        200: {
+            "model": Dict[str, Any],
+            "description": "Job state successfully returned",
+        },
+        404: {"model": ConvertError},
+    },
+)
+async def get_request_status(
+    fid: Annotated[str, Query(description="Request id returned by /doi_agency/list")],
+):
+    """Return state and progress of a DOI list request."""
+    folder = await run_blocking(job_folder, config_app.CACHE, fid)
+    if folder is None:
+        return JSONResponse(
+            {
+                "status_code": 404,
+                "message": f"Request '{fid}' not found",
+                "error": None,
+            },
+            status_code=404,
+        )
+
+    status = public_status(await run_blocking(read_job_status, folder))
+    if status["status"] == DONE:
+        status["result_url"] = f"/doi_agency/result?fid={fid}"
+
+    return JSONResponse({"status_code": 200, **status}, status_code=200)
+
+
+@router.get(
+    "/resume",
+    name="doi_list_resume",
+    status_code=202,
+    responses={
+        202: {
+            "model": Dict[str, Any],
+            "description": "DOI list request resumed",
+        },
+        404: {"model": ConvertError},
+        409: {"model": ConvertError},
+    },
+)
+async def resume_request(
+    fid: Annotated[str, Query(description="Request id of a failed or lost request")],
+):
+    """Resume a failed DOI list request, or one lost in a restart, from its last checkpoint."""
+    result = await run_blocking(resume_job, config_app.CACHE, fid,
+                                max_workers=config_app.JOB_WORKERS)
+    if result is None:
+        return JSONResponse(
+            {
+                "status_code": 404,
+                "message": f"Request '{fid}' not found",
+                "error": None,
+            },
+            status_code=404,
+        )
+
+    return JSONResponse(content=result, status_code=result["status_code"])
+
+
+@router.get(
+    "/result",
+    name="doi_list_result",
+    status_code=200,
+    responses={
+        200: {"description": "DOI list of a finished request"},
+        404: {"model": ConvertError},
+        409: {"model": ConvertError},
+    },
+)
+async def get_request_result(
+    fid: Annotated[str, Query(description="Request id returned by /doi_agency/list")],
+    archive_format: Annotated[
+        str | None,
+        Query(description=f"Download the XML records as archive, one of {list(ARCHIVE_FORMATS)}"),
+    ] = None,
+):
+    """Download the DOI list, or the XML records as archive, of a finished DOI list request."""
+    folder = await run_blocking(job_folder, config_app.CACHE, fid)
+    if folder is None:
+        return JSONResponse(
+            {
+                "status_code": 404,
+                "message": f"Request '{fid}' not found",
+                "error": None,
+            },
+            status_code=404,
+        )
+
+    status = await run_blocking(read_job_status, folder)
+    if status["status"] != DONE:
+        return JSONResponse(
+            {
+                "status_code": 409,
+                "message": f"Request '{fid}' is {status['status']}",
+                "error": status["error"],
+            },
+            status_code=409,
+        )
+
+    if archive_format is not None:
+        if not archive_format_available(archive_format):
+            return archive_format_error(archive_format)
+        return StreamingResponse(
+            iterate_blocking(iter_archive(iter_folder_records(folder / XML_FOLDER, folder / DOI_FILE),
+                                          archive_format)),
+            media_type=ARCHIVE_FORMATS[archive_format],
+            headers={"Content-Disposition": f'attachment; filename="{fid}.{archive_format}"'},
+        )
+
+    return FileResponse(folder / DOI_FILE, media_type="text/plain", filename=f"{fid}.txt")
+
+
+@router.get(
+    "/export",
+    name="doi_export",
+    status_code=200,
+    responses={
+        200: {"description": "Archive of the XML records, streamed while they are harvested"},
+        400: {"model": ConvertError},
+    },
+)
+async def export_doi_prefix(
+    doi_prefix: Annotated[
+        str,
+        Query(
+            description="DOI prefix",
+            openapi_examples={
+                "datacite": {
+                    "summary": "DataCite DOI prefix",
+                    "value": "10.25678",
+                },
+            },
+        ),
+    ],
+    user_agent: Annotated[
+        str,
+        Query(description="email address to send to DOI agency for API call"),
+    ],
+    archive_format: Annotated[
+        str,
+        Query(description=f"Archive format, one of {list(ARCHIVE_FORMATS)}"),
+    ] = "zip",
+):
+    """Stream an archive of all XML records of a DOI prefix.
+
+    The download starts with the first cursor page, records are added to the
+    archive as they arrive.
+    """
+    if not archive_format_available(archive_format):
+        return archive_format_error(archive_format)
+
+    headers = {"User-Agent": USER_AGENT, "From": user_agent}
+    filename = f"{doi_prefix.replace('/', '_')}.{archive_format}"
+    return StreamingResponse(
+        iterate_blocking(iter_archive(iter_prefix_records(doi_prefix, headers=headers), archive_format)),
+        media_type=ARCHIVE_FORMATS[archive_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get(
+    "/stream",
+    name="doi_stream",
+    status_code=200,
+    responses={
+        200: {"description": "DOIs streamed as NDJSON lines or Server-Sent Events while cursor pages arrive"},
+        400: {"model": ConvertError},
+    },
+)
+async def stream_doi_prefix(
+    doi_prefix: Annotated[
+        str,
+        Query(
+            description="DOI prefix",
+            openapi_examples={
+                "datacite": {
+                    "summary": "DataCite DOI prefix",
+                    "value": "10.25678",
+                },
+            },
+        ),
+    ],
+    user_agent: Annotated[
+        str,
+        Query(description="email address to send to DOI agency for API call"),
+    ],
+    stream_format: Annotated[
+        str,
+        Query(description=f"Stream format, one of {list(STREAM_FORMATS)}"),
+    ] = "ndjson",
+    metadata: Annotated[
+        bool,
+        Query(description="If true titles, creators, dates and types are sent with each DOI."),
+    ] = False,
+    page_size: Annotated[
+        int,
+        Query(ge=1, le=1000, description="Records per cursor page, smaller pages arrive sooner"),
+    ] = 1000,
+):
+    """Stream the DOIs of a DOI prefix as they are listed.
+
+    Each cursor page is forwarded as soon as it arrives, so clients can start
+    processing the first DOIs while the rest of the prefix is still listed.
+    """
+    if stream_format not in STREAM_FORMATS:
+        return JSONResponse(
+            {
+                "status_code": 400,
+                "message": f"Stream format '{stream_format}' is not available",
+                "error": f"Use one of {list(STREAM_FORMATS)}",
+            },
+            status_code=400,
+        )
+
+    headers = {"User-Agent": USER_AGENT, "From": user_agent}
+    dois = iter_prefix_dois(doi_prefix, metadata=metadata, headers=headers, page_size=page_size)
+    return StreamingResponse(
+        iterate_blocking(iter_stream(dois, stream_format)),
+        media_type=STREAM_FORMATS[stream_format],
+        #keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def archive_format_error(archive_format: str) -> JSONResponse:
+    """Return error response for an unknown or unavailable archive format."""
+    return JSONResponse(
+        {
+            "status_code": 400,
+            "message": f"Archive format '{archive_format}' is not available",
+            "error": f"Use one of {list(ARCHIVE_FORMATS)}",
+        },
+        status_code=400,
+    )
 
 
 def is_type_valid(obj: Any, typ: Any) -> bool:
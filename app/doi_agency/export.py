@@ -0,0 +1,488 @@
+"""Streaming archive export of DataCite XML records.
+
+Archives are produced as an iterator of byte chunks while records arrive, so
+neither the record set nor the archive is held in memory or written to disk.
+DOI lists are streamed the same way as NDJSON or Server-Sent Events. The JSON
+attributes of the list pages can be written to JSON Lines or Parquet datasets
+for analysis without any XML.
+"""
+
+import gzip
+import io
+import json
+import pathlib
+import tarfile
+import time
+import zipfile
+from logging import getLogger
+from typing import Iterable, Iterator
+
+from app.doi_agency.datacite import (
+    DEFAULT_HEADER,
+    METADATA_FIELDS,
+    doi_to_file,
+    iter_doi_attributes_cursor,
+    iter_doi_xml_list_cursor,
+)
+from app.doi_agency.utils import iter_batches
+
+log = getLogger(__name__)
+
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar.gz": "application/gzip",
+    "tar.zst": "application/zstd",
+}
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+DATASET_FORMATS = ("jsonl", "jsonl.gz", "parquet")
+DATASET_BATCH_SIZE = 10000
+#attributes written as integer columns to Parquet, all others as strings
+INTEGER_FIELDS = ("publicationYear", "citationCount", "viewCount", "downloadCount",
+                  "referenceCount", "partCount", "partOfCount", "versionCount", "versionOfCount")
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only, unseekable file collecting written bytes until drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> Iterator[bytes]:
+        """Yield and forget the bytes written since the last drain."""
+        chunks, self._chunks = self._chunks, []
+        if chunks:
+            yield b"".join(chunks)
+
+
+def iter_zip(records: Iterable[tuple[str, bytes]]) -> Iterator[bytes]:
+    """Yield a ZIP archive of (file name, content) records chunk by chunk.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): archive members
+
+    Returns:
+        Iterator[bytes]
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in records:
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(zinfo, data)
+            yield from buffer.drain()
+    yield from buffer.drain()
+
+
+def iter_tar(records: Iterable[tuple[str, bytes]], compression: str = "gz") -> Iterator[bytes]:
+    """Yield a compressed tar archive of (file name, content) records chunk by chunk.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): archive members
+        compression (str): "gz" or "zst", the latter needs the zstandard package
+
+    Returns:
+        Iterator[bytes]
+    """
+    buffer = _ChunkBuffer()
+    if compression == "zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("tar.zst export requires the zstandard package")
+        fileobj = zstandard.ZstdCompressor().stream_writer(buffer, closefd=False)
+        mode = "w|"
+    else:
+        fileobj = buffer
+        mode = f"w|{compression}"
+
+    with tarfile.open(fileobj=fileobj, mode=mode) as tf:
+        for name, data in records:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(time.time())
+            tf.addfile(tarinfo, io.BytesIO(data))
+            yield from buffer.drain()
+
+    if fileobj is not buffer:
+        fileobj.close()
+    yield from buffer.drain()
+
+
+def archive_format_available(archive_format: str) -> bool:
+    """Return True if archive_format is known and its compressor is installed.
+
+    Args:
+        archive_format (str): key of ARCHIVE_FORMATS
+
+    Returns:
+        bool
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        return False
+    if archive_format == "tar.zst":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+    return True
+
+
+def iter_archive(records: Iterable[tuple[str, bytes]], archive_format: str = "zip") -> Iterator[bytes]:
+    """Yield an archive in one of ARCHIVE_FORMATS chunk by chunk.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): archive members
+        archive_format (str): key of ARCHIVE_FORMATS
+
+    Returns:
+        Iterator[bytes]
+    """
+    if archive_format == "zip":
+        return iter_zip(records)
+    if archive_format == "tar.gz":
+        return iter_tar(records, "gz")
+    if archive_format == "tar.zst":
+        return iter_tar(records, "zst")
+    raise ValueError(f"Unknown archive format '{archive_format}'")
+
+
+def archive_format_from_path(path) -> str:
+    """Return the key of ARCHIVE_FORMATS matching the suffix of path.
+
+    Args:
+        path (str): archive file path
+
+    Returns:
+        str
+    """
+    name = pathlib.Path(path).name
+    for archive_format in ARCHIVE_FORMATS:
+        if name.endswith(f".{archive_format}"):
+            return archive_format
+    raise ValueError(f"Unknown archive format for '{name}', use one of {list(ARCHIVE_FORMATS)}")
+
+
+def iter_prefix_records(doi_prefix: str,
+                        headers: dict = DEFAULT_HEADER,
+                        page_size: int = 1000) -> Iterator[tuple[str, bytes]]:
+    """Yield (file name, XML bytes) of every record of doi_prefix as cursor pages arrive.
+
+    Args:
+        doi_prefix (str): DOI prefix for provider
+        headers (dict): request header to inform DataCite about API call
+        page_size (int): max number of items per cursor page
+
+    Returns:
+        Iterator[tuple[str, bytes]]
+    """
+    for d, record in iter_doi_xml_list_cursor(doi_prefix,
+                                              page_size=page_size,
+                                              headers=headers,
+                                              raw=True):
+        yield doi_to_file(d), record.xml
+
+
+def iter_folder_records(folder, doi_file=None) -> Iterator[tuple[str, bytes]]:
+    """Yield (file name, XML bytes) of the XML files in folder.
+
+    With the DOI list of a harvest the numbered files n.xml are yielded in
+    harvest order and named after the n-th DOI, see doi_to_file, like the
+    records of iter_prefix_records. Otherwise numbered files come in numeric
+    order, followed by the other files by name.
+
+    Args:
+        folder (str): folder with harvested XML files
+        doi_file (str): DOI list written by the harvest, one DOI per line
+
+    Returns:
+        Iterator[tuple[str, bytes]]
+    """
+    folder = pathlib.Path(folder)
+    if doi_file is not None:
+        with open(doi_file) as f:
+            for i, line in enumerate(f, start=1):
+                path = folder / f"{i}.xml"
+                if line.strip() and path.is_file():
+                    yield doi_to_file(line.strip()), path.read_bytes()
+        return
+
+    def key(path):
+        return (0, int(path.stem), "") if path.stem.isdigit() else (1, 0, path.name)
+
+    for path in sorted(folder.glob("*.xml"), key=key):
+        yield path.name, path.read_bytes()
+
+
+def iter_store_records(store) -> Iterator[tuple[str, bytes]]:
+    """Yield (file name, XML bytes) of the records in a RecordStore.
+
+    Args:
+        store (RecordStore): record store
+
+    Returns:
+        Iterator[tuple[str, bytes]]
+    """
+    for d, xml in store.iter_records():
+        yield doi_to_file(d), xml
+
+
+def write_archive(records: Iterable[tuple[str, bytes]], path) -> None:
+    """Write records to an archive file, the format follows the suffix of path.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): archive members
+        path (str): archive file path
+    """
+    with open(path, "wb") as f:
+        for chunk in iter_archive(records, archive_format_from_path(path)):
+            f.write(chunk)
+
+
+def iter_ndjson(items: Iterable[dict]) -> Iterator[bytes]:
+    """Yield each item as one line of JSON.
+
+    Args:
+        items (Iterable[dict]): JSON serialisable items
+
+    Returns:
+        Iterator[bytes]
+    """
+    for item in items:
+        yield json.dumps(item, ensure_ascii=False).encode() + b"\n"
+
+
+def iter_sse(items: Iterable[dict], event: str = "doi") -> Iterator[bytes]:
+    """Yield each item as Server-Sent Event, followed by an end event with the count.
+
+    Args:
+        items (Iterable[dict]): JSON serialisable items
+        event (str): event name of the items
+
+    Returns:
+        Iterator[bytes]
+    """
+    count = 0
+    for count, item in enumerate(items, start=1):
+        yield f"event: {event}\nid: {count}\ndata: {json.dumps(item, ensure_ascii=False)}\n\n".encode()
+    yield f"event: end\ndata: {json.dumps({'records': count})}\n\n".encode()
+
+
+def iter_stream(items: Iterable[dict], stream_format: str = "ndjson") -> Iterator[bytes]:
+    """Yield items in one of STREAM_FORMATS.
+
+    Args:
+        items (Iterable[dict]): JSON serialisable items
+        stream_format (str): key of STREAM_FORMATS
+
+    Returns:
+        Iterator[bytes]
+    """
+    if stream_format == "ndjson":
+        return iter_ndjson(items)
+    if stream_format == "sse":
+        return iter_sse(items)
+    raise ValueError(f"Unknown stream format '{stream_format}'")
+
+
+def iter_prefix_dois(doi_prefix: str,
+                     metadata: bool = False,
+                     headers: dict = DEFAULT_HEADER,
+                     page_size: int = 1000) -> Iterator[dict]:
+    """Yield {"doi": ...} of every record of doi_prefix, with metadata its list page attributes.
+
+    Args:
+        doi_prefix (str): DOI prefix for provider
+        metadata (bool): include METADATA_FIELDS attributes
+        headers (dict): request header to inform DataCite about API call
+        page_size (int): max number of items per cursor page
+
+    Returns:
+        Iterator[dict]
+    """
+    fields = METADATA_FIELDS if metadata else ("doi",)
+    yield from iter_doi_attributes_cursor(doi_prefix, fields=fields,
+                                          page_size=page_size, headers=headers)
+
+
+def dataset_format_from_path(path) -> str:
+    """Return the dataset format of a file path from its suffix.
+
+    Args:
+        path (str): dataset file path
+
+    Returns:
+        str: one of DATASET_FORMATS
+    """
+    name = pathlib.Path(path).name
+    for dataset_format in sorted(DATASET_FORMATS, key=len, reverse=True):
+        if name.endswith("." + dataset_format):
+            return dataset_format
+    raise ValueError(f"Unknown dataset format of '{path}', use one of {', '.join(DATASET_FORMATS)}")
+
+
+def _fields(fields: Iterable[str]) -> list[str]:
+    return ["doi"] + [f for f in fields if f != "doi"]
+
+
+def dataset_columns(fields: Iterable[str]) -> list[tuple[str, str]]:
+    """Return the Parquet columns of fields as (name, type), type "int64" or "string".
+
+    Args:
+        fields (Iterable[str]): attribute names, the doi is always the first column
+
+    Returns:
+        list[tuple[str, str]]
+    """
+    return [(f, "int64" if f in INTEGER_FIELDS else "string") for f in _fields(fields)]
+
+
+def flatten_attributes(attributes: dict, fields: Iterable[str]) -> dict:
+    """Return one row with a column per field, lists and objects as JSON strings.
+
+    Args:
+        attributes (dict): JSON attributes of a record
+        fields (Iterable[str]): attribute names
+
+    Returns:
+        dict
+    """
+    row = {}
+    for field in fields:
+        value = attributes.get(field)
+        if field in INTEGER_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = None
+        elif value is not None and not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        row[field] = value
+    return row
+
+
+def write_jsonl_dataset(items: Iterable[dict],
+                        path,
+                        fields: Iterable[str] = METADATA_FIELDS,
+                        batch_size: int = DATASET_BATCH_SIZE) -> int:
+    """Write the fields of items as JSON Lines, gzip compressed if path ends in .gz.
+
+    Args:
+        items (Iterable[dict]): JSON attributes of records
+        path (str): dataset file path
+        fields (Iterable[str]): attribute names, the doi is always written
+        batch_size (int): rows written at once
+
+    Returns:
+        int: number of rows
+    """
+    fields = _fields(fields)
+    opener = gzip.open if str(path).endswith(".gz") else open
+    rows = 0
+    with opener(path, "wb") as f:
+        for batch in iter_batches(items, batch_size):
+            f.write(b"".join(iter_ndjson({k: item.get(k) for k in fields} for item in batch)))
+            rows += len(batch)
+    return rows
+
+
+def write_parquet_dataset(items: Iterable[dict],
+                          path,
+                          fields: Iterable[str] = METADATA_FIELDS,
+                          batch_size: int = DATASET_BATCH_SIZE) -> int:
+    """Write the fields of items as Parquet, one row group per batch.
+
+    Columns of INTEGER_FIELDS are integers, all others strings with lists
+    and objects as JSON, see dataset_columns and flatten_attributes.
+
+    Args:
+        items (Iterable[dict]): JSON attributes of records
+        path (str): dataset file path
+        fields (Iterable[str]): attribute names, the doi is always written
+        batch_size (int): rows per row group
+
+    Returns:
+        int: number of rows
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet export requires the pyarrow package")
+
+    fields = _fields(fields)
+    schema = pyarrow.schema([(name, getattr(pyarrow, column_type)())
+                             for name, column_type in dataset_columns(fields)])
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(str(path), schema, compression="zstd") as writer:
+        for batch in iter_batches(items, batch_size):
+            writer.write_table(pyarrow.Table.from_pylist(
+                [flatten_attributes(item, fields) for item in batch], schema=schema))
+            rows += len(batch)
+    return rows
+
+
+def write_dataset(items: Iterable[dict],
+                  path,
+                  fields: Iterable[str] = METADATA_FIELDS,
+                  batch_size: int = DATASET_BATCH_SIZE) -> int:
+    """Write the fields of items to a dataset file, the format follows the suffix of path.
+
+    Args:
+        items (Iterable[dict]): JSON attributes of records
+        path (str): dataset file path ending in .jsonl, .jsonl.gz or .parquet
+        fields (Iterable[str]): attribute names, the doi is always written
+        batch_size (int): rows written at once
+
+    Returns:
+        int: number of rows
+    """
+    if dataset_format_from_path(path) == "parquet":
+        return write_parquet_dataset(items, path, fields, batch_size)
+    return write_jsonl_dataset(items, path, fields, batch_size)
+
+
+def export_attributes(doi_prefix: str,
+                      path,
+                      fields: Iterable[str] = METADATA_FIELDS,
+                      headers: dict = DEFAULT_HEADER,
+                      page_size: int = 1000,
+                      batch_size: int = DATASET_BATCH_SIZE) -> int:
+    """Write the list page attributes of every record of doi_prefix to a dataset file.
+
+    Only the chosen fields are requested from DataCite (sparse fieldset)
+    and no XML is transferred.
+
+    Args:
+        doi_prefix (str): DOI prefix for provider
+        path (str): dataset file path ending in .jsonl, .jsonl.gz or .parquet
+        fields (Iterable[str]): attribute names, the doi is always written
+        headers (dict): request header to inform DataCite about API call
+        page_size (int): max number of items per cursor page
+        batch_size (int): rows written at once
+
+    Returns:
+        int: number of rows
+    """
+    fields = _fields(fields)
+    dataset_format_from_path(path)
+    items = iter_doi_attributes_cursor(doi_prefix, fields=fields, page_size=page_size, headers=headers)
+    rows = write_dataset(items, path, fields, batch_size)
+    log.info(f"Exported {rows} records of prefix {doi_prefix} to {path}")
+    return rows
@@ -0,0 +1,47 @@
+"""Local fake of bolognese_worker.rb for tests, speaking the same JSON lines protocol.
+
+Run as python -m app.doi_agency.fake_bolognese. DOIs ending in "missing" are
+answered with an error, a DOI ending in "crash" ends the process, one
+ending in "hang" blocks it and one ending in "noid" gets an error without id.
+"""
+
+import json
+import sys
+import time
+from xml.sax.saxutils import escape
+
+XML_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<resource xmlns="http://datacite.org/schema/kernel-4">'
+                '<identifier identifierType="DOI">{doi}</identifier></resource>\n')
+
+
+def respond(request: dict) -> dict:
+    """Return the response to one worker request."""
+    doi = request.get("doi", "")
+    response = {"id": request.get("id"), "doi": doi}
+    if doi.endswith("missing"):
+        response["error"] = "not found"
+    else:
+        response["output"] = XML_TEMPLATE.format(doi=escape(doi.split("doi.org/")[-1].upper()))
+    return response
+
+
+def main():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if request.get("doi", "").endswith("crash"):
+            sys.exit(1)
+        if request.get("doi", "").endswith("hang"):
+            time.sleep(3600)
+        if request.get("doi", "").endswith("noid"):
+            sys.stdout.write(json.dumps({"error": "unreadable request"}) + "\n")
+            sys.stdout.flush()
+            continue
+        sys.stdout.write(json.dumps(respond(request)) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
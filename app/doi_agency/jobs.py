@@ -0,0 +1,691 @@
+"""Background job engine for DOI prefix harvests.
+
+Each job gets its own folder (fid) in the cache folder. The job state is kept
+in a JSON file in that folder, so any API worker can report on it. An index
+file in the cache folder maps job keys to the latest fid, and finished jobs
+are deleted by a retention sweep once they are older than JOB_RETENTION.
+While a job is queued or running its heartbeat file is touched every
+HEARTBEAT_INTERVAL, jobs whose heartbeat stopped for STALE_AFTER were lost
+and are marked failed. A lock file in the cache folder serializes job
+creation between all API worker processes.
+"""
+
+import fcntl
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging import getLogger
+
+from app.doi_agency import metrics
+from app.doi_agency.datacite import (
+    DEFAULT_HEADER,
+    clear_checkpoint,
+    get_doi_count,
+    iter_doi_xml_list_cursor,
+)
+from app.doi_agency.dcat import DCAT_FOLDER, convert_records, dcat_store_path
+from app.doi_agency.export import iter_folder_records
+from app.doi_agency.store import RecordStore
+from app.doi_agency.validation import validate_records
+from app.doi_agency.xmlcache import XMLCache
+
+log = getLogger(__name__)
+
+JOB_WORKERS = 2
+#worker processes of a job converting or validating records
+PROCESS_WORKERS = 2
+STATUS_FILE = "status.json"
+INDEX_FILE = "jobs.json"
+LOCK_FILE = ".jobs.lock"
+HEARTBEAT_FILE = "heartbeat"
+DOI_FILE = "doi.txt"
+XML_FOLDER = "xml"
+XML_CACHE_FILE = "xml-cache.sqlite"
+XML_CACHE_MAX_BYTES = 2**30
+#finished harvests are handed to identical requests for this many seconds
+COALESCE_TTL = 3600
+#seconds between two touches of the heartbeat file of a queued or running job
+HEARTBEAT_INTERVAL = 30
+#queued or running jobs without a heartbeat for this long are considered lost
+STALE_AFTER = 600
+#finished and failed jobs are deleted this many seconds after they ended
+JOB_RETENTION = 7 * 86400
+#min seconds between two retention sweeps of a cache folder
+SWEEP_INTERVAL = 3600
+
+#fields of the job state shown to clients, the state also holds request headers and server paths
+PUBLIC_FIELDS = ("fid", "doi_prefix", "status", "created", "started", "finished", "updated",
+                 "progress", "timings", "error", "dcat", "dcat_result", "validate", "validation")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_executor = None
+_xml_caches = {}
+_xml_caches_lock = threading.Lock()
+_submit_lock = threading.Lock()
+_last_sweep = {}
+_heartbeats = set()
+_heartbeat_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def get_executor(max_workers: int = JOB_WORKERS) -> ThreadPoolExecutor:
+    """Return the worker pool shared by all jobs, creating it on first use.
+
+    Args:
+        max_workers (int): number of harvests that can run at the same time
+
+    Returns:
+        ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix="doi-job")
+    return _executor
+
+
+def get_xml_cache(path: str, max_bytes: int | None = XML_CACHE_MAX_BYTES) -> XMLCache:
+    """Return the XML cache at path shared by all jobs, opening it on first use.
+
+    Args:
+        path (str): SQLite file of the cache
+        max_bytes (int | None): size the cache is evicted to after each job
+
+    Returns:
+        XMLCache
+    """
+    key = str(pathlib.Path(path).resolve())
+    with _xml_caches_lock:
+        if key not in _xml_caches:
+            _xml_caches[key] = XMLCache(path, max_bytes=max_bytes)
+        return _xml_caches[key]
+
+
+def job_folder(cache: str, fid: str) -> pathlib.Path | None:
+    """Return folder of job fid in cache, or None if fid is not a valid job.
+
+    Args:
+        cache (str): folder path in which job folders are created
+        fid (str): job id
+
+    Returns:
+        pathlib.Path | None
+    """
+    if not fid or pathlib.Path(fid).name != fid:
+        return None
+
+    folder = pathlib.Path(cache) / fid
+    if not (folder / STATUS_FILE).is_file():
+        return None
+
+    return folder
+
+
+def read_status(folder: pathlib.Path) -> dict:
+    """Return job state stored in folder.
+
+    Args:
+        folder (pathlib.Path): job folder
+
+    Returns:
+        dict
+    """
+    with open(folder / STATUS_FILE) as f:
+        return json.load(f)
+
+
+def write_status(folder: pathlib.Path, status: dict) -> None:
+    """Atomically replace job state stored in folder.
+
+    Args:
+        folder (pathlib.Path): job folder
+        status (dict): job state
+    """
+    status["updated"] = time.time()
+    tmp = folder / f"{STATUS_FILE}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp, folder / STATUS_FILE)
+
+
+def public_status(status: dict) -> dict:
+    """Return the fields of a job state that may be shown to any client, see PUBLIC_FIELDS.
+
+    Args:
+        status (dict): job state
+
+    Returns:
+        dict
+    """
+    public = {key: status[key] for key in PUBLIC_FIELDS if key in status}
+    if "dcat_result" in public:
+        public["dcat_result"] = {key: value for key, value in public["dcat_result"].items() if key != "store"}
+    return public
+
+
+def job_key(doi_agency: str, doi_prefix: str, page_size: int,
+            dcat: bool = False, validate: bool = False) -> str:
+    """Return the key under which identical harvests are coalesced.
+
+    Args:
+        doi_agency (str): DOI agency name
+        doi_prefix (str): DOI prefix for provider
+        page_size (int): max number of items per cursor page
+        dcat (bool): records are converted to DCAT-AP CH
+        validate (bool): records are validated
+
+    Returns:
+        str
+    """
+    key = f"{doi_agency.lower()}:{doi_prefix.lower()}:{page_size}"
+    if dcat:
+        key += ":dcat"
+    if validate:
+        key += ":validate"
+    return key
+
+
+def _beat() -> None:
+    """Touch the heartbeat file of every job in _heartbeats, forever."""
+    while True:
+        with _heartbeat_lock:
+            folders = list(_heartbeats)
+        for folder in folders:
+            try:
+                (folder / HEARTBEAT_FILE).touch()
+            except OSError as e:
+                log.warning(f"Heartbeat of job {folder.name} failed: {e}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def start_heartbeat(folder: pathlib.Path) -> None:
+    """Touch the heartbeat file of the job in folder until stop_heartbeat.
+
+    All jobs share one timer thread, started on first use.
+
+    Args:
+        folder (pathlib.Path): job folder
+    """
+    global _heartbeat_thread
+    (folder / HEARTBEAT_FILE).touch()
+    with _heartbeat_lock:
+        _heartbeats.add(folder)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_beat, name="doi-job-heartbeat", daemon=True)
+            _heartbeat_thread.start()
+
+
+def stop_heartbeat(folder: pathlib.Path) -> None:
+    """Stop touching the heartbeat file of the job in folder.
+
+    Args:
+        folder (pathlib.Path): job folder
+    """
+    with _heartbeat_lock:
+        _heartbeats.discard(folder)
+
+
+def is_stale(folder: pathlib.Path, status: dict) -> bool:
+    """Return True if a queued or running job has had no heartbeat for STALE_AFTER.
+
+    Such a job was lost, e.g. when the process running it was restarted.
+    Jobs without heartbeat file are judged by their last status update.
+
+    Args:
+        folder (pathlib.Path): job folder
+        status (dict): job state
+
+    Returns:
+        bool
+    """
+    if status["status"] not in (QUEUED, RUNNING):
+        return False
+    try:
+        heartbeat = (folder / HEARTBEAT_FILE).stat().st_mtime
+    except OSError:
+        heartbeat = 0
+    return time.time() - max(heartbeat, status["updated"]) >= STALE_AFTER
+
+
+def read_job_status(folder: pathlib.Path) -> dict:
+    """Return job state stored in folder, marking a lost job failed first.
+
+    The job is marked under the job lock of its cache folder, see _job_lock.
+
+    Args:
+        folder (pathlib.Path): job folder
+
+    Returns:
+        dict
+    """
+    status = read_status(folder)
+    if not is_stale(folder, status):
+        return status
+    with _job_lock(folder.parent):
+        return _read_job_status(folder)
+
+
+def _read_job_status(folder: pathlib.Path) -> dict:
+    """Return job state like read_job_status, the caller holds the job lock."""
+    status = read_status(folder)
+    if is_stale(folder, status):
+        log.warning(f"Job {folder.name} was lost while {status['status']}")
+        status["status"] = FAILED
+        status["error"] = f"Request lost, no heartbeat for {STALE_AFTER} s. It can be resumed."
+        status["finished"] = time.time()
+        write_status(folder, status)
+    return status
+
+
+@contextmanager
+def _job_lock(cache: str):
+    """Hold the job lock of cache, shared by all threads and processes using it."""
+    with _submit_lock, _file_lock(pathlib.Path(cache) / LOCK_FILE):
+        yield
+
+
+@contextmanager
+def _file_lock(path: pathlib.Path):
+    """Hold an exclusive lock on the file at path, also against other threads of this process."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _iter_statuses(cache: str):
+    """Yield the state of every job folder in cache, skipping unreadable ones."""
+    for status_file in pathlib.Path(cache).glob(f"*/{STATUS_FILE}"):
+        if status_file.parent.name.startswith("."):
+            #folder of a job being deleted, see sweep_jobs
+            continue
+        try:
+            yield read_status(status_file.parent)
+        except (OSError, ValueError):
+            continue
+
+
+def load_index(cache: str) -> dict:
+    """Return {job key: fid of the latest job} of cache.
+
+    A missing index is rebuilt once from the job folders.
+
+    Args:
+        cache (str): folder path in which job folders are created
+
+    Returns:
+        dict
+    """
+    path = pathlib.Path(cache) / INDEX_FILE
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        log.warning(f"Rebuilding unreadable job index {path}")
+
+    latest = {}
+    for status in _iter_statuses(cache):
+        key = status.get("key")
+        if key is not None and (key not in latest or status["created"] > latest[key]["created"]):
+            latest[key] = status
+    index = {key: status["fid"] for key, status in latest.items()}
+    save_index(cache, index)
+    return index
+
+
+def save_index(cache: str, index: dict) -> None:
+    """Atomically replace the job index of cache.
+
+    Args:
+        cache (str): folder path in which job folders are created
+        index (dict): {job key: fid}
+    """
+    path = pathlib.Path(cache) / INDEX_FILE
+    tmp = path.with_name(f"{INDEX_FILE}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+def find_job(cache: str, key: str, ttl: float = COALESCE_TTL) -> str | None:
+    """Return fid of the job with key if it is in flight or finished within ttl.
+
+    Only the latest job of key in the index is considered, if it was lost
+    it is marked failed, see read_job_status. The caller holds the job lock.
+
+    Args:
+        cache (str): folder path in which job folders are created
+        key (str): job key, see job_key
+        ttl (float): seconds a finished job is reused
+
+    Returns:
+        str | None
+    """
+    folder = job_folder(cache, load_index(cache).get(key))
+    if folder is None:
+        return None
+    try:
+        status = _read_job_status(folder)
+    except (OSError, ValueError):
+        return None
+
+    if status["status"] in (QUEUED, RUNNING):
+        fresh = True
+    elif status["status"] == DONE:
+        fresh = time.time() - status.get("finished", 0) < ttl
+    else:
+        fresh = False
+
+    return status["fid"] if fresh else None
+
+
+def sweep_jobs(cache: str, retention: float = JOB_RETENTION) -> list[str]:
+    """Delete the folders of jobs that finished or failed more than retention seconds ago.
+
+    Under the job lock the expired jobs are read again, removed from the
+    index and their folders renamed, so a job resumed meanwhile is kept and
+    a deleted one is never handed out. The renamed folders are deleted
+    after the lock is released.
+
+    Args:
+        cache (str): folder path in which job folders are created
+        retention (float): seconds a finished job is kept
+
+    Returns:
+        list[str] of the deleted fids
+    """
+    def is_expired(status):
+        return status["status"] in (DONE, FAILED) \
+            and time.time() - status.get("finished", status["updated"]) > retention
+
+    if not any(is_expired(status) for status in _iter_statuses(cache)):
+        return []
+
+    with _job_lock(cache):
+        expired = [status["fid"] for status in _iter_statuses(cache) if is_expired(status)]
+        index = load_index(cache)
+        save_index(cache, {key: fid for key, fid in index.items() if fid not in expired})
+        trash = []
+        for fid in expired:
+            folder = pathlib.Path(cache) / fid
+            trash.append(folder.with_name(f".{fid}.deleted"))
+            os.replace(folder, trash[-1])
+    for folder in trash:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if expired:
+        log.info(f"Deleted {len(expired)} job(s) older than {retention} s from {cache}")
+    return expired
+
+
+def _maybe_sweep(cache: str, retention: float) -> None:
+    """Start a retention sweep of cache in the background unless one ran within SWEEP_INTERVAL."""
+    key = str(pathlib.Path(cache).resolve())
+    with _submit_lock:
+        if time.time() - _last_sweep.get(key, 0) < SWEEP_INTERVAL:
+            return
+        _last_sweep[key] = time.time()
+    threading.Thread(target=sweep_jobs, args=(cache, retention),
+                     name="doi-job-sweep", daemon=True).start()
+
+
+def submit_job(doi_prefix: str,
+               cache: str,
+               headers: dict = DEFAULT_HEADER,
+               page_size: int = 1000,
+               max_workers: int = JOB_WORKERS,
+               xml_cache: str | None = None,
+               doi_agency: str = "datacite",
+               coalesce_ttl: float = COALESCE_TTL,
+               dcat: bool = False,
+               validate: bool = False,
+               retention: float = JOB_RETENTION,
+               process_workers: int = PROCESS_WORKERS) -> dict:
+    """Create a job folder for doi_prefix and queue its harvest.
+
+    Identical requests are coalesced: while a job for the same agency,
+    prefix and page size is queued or running, or finished less than
+    coalesce_ttl seconds ago, its fid is returned instead of starting
+    another harvest. With xml_cache unchanged records are taken from that
+    XML cache instead of being transferred again. With dcat the records
+    are converted to DCAT-AP CH and with validate checked against their
+    DataCite schema after the harvest, see run_job. At most every
+    SWEEP_INTERVAL the folders of jobs that ended more than retention
+    seconds ago are deleted in the background.
+
+    Args:
+        doi_prefix (str): DOI prefix for provider
+        cache (str): folder path in which job folders are created
+        headers (dict): request header to inform DataCite about API call
+        page_size (int): max number of items per cursor page
+        max_workers (int): size of the worker pool if not yet created
+        xml_cache (str | None): SQLite file of the XML cache shared by jobs
+        doi_agency (str): DOI agency name
+        coalesce_ttl (float): seconds a finished job is reused, 0 to only share running jobs
+        dcat (bool): convert the records to DCAT-AP CH
+        validate (bool): validate the records against their DataCite schema
+        retention (float): seconds finished jobs are kept
+        process_workers (int): worker processes converting or validating records
+
+    Returns:
+        dict with status code, message and status_url
+    """
+    pathlib.Path(cache).mkdir(parents=True, exist_ok=True)
+    _maybe_sweep(cache, retention)
+    key = job_key(doi_agency, doi_prefix, page_size, dcat, validate)
+    if xml_cache is not None:
+        xml_cache = str(xml_cache)
+
+    with _job_lock(cache):
+        fid = find_job(cache, key, ttl=coalesce_ttl)
+        if fid is not None:
+            log.info(f"Request for {key} joins request {fid}")
+            return {
+                "status_code": 202,
+                "message": f"Request {fid} for the same prefix is reused.",
+                "fid": fid,
+                "status_url": f"/doi_agency/request?fid={fid}",
+                "coalesced": True,
+                }
+
+        folder = pathlib.Path(tempfile.mkdtemp(dir=cache))
+        fid = folder.name
+        _create_job(folder, fid, key, doi_prefix, headers, page_size, xml_cache, dcat, validate,
+                    process_workers)
+        start_heartbeat(folder)
+        index = load_index(cache)
+        index[key] = fid
+        save_index(cache, index)
+
+    metrics.QUEUE_DEPTH.inc(queue="jobs")
+    get_executor(max_workers).submit(run_job, folder, doi_prefix, headers, page_size,
+                                     False, xml_cache, dcat, validate, process_workers)
+
+    return {
+        "status_code": 202,
+        "message": f"Request {fid} started.",
+        "fid": fid,
+        "status_url": f"/doi_agency/request?fid={fid}",
+        "coalesced": False,
+        }
+
+
+def _create_job(folder, fid, key, doi_prefix, headers, page_size, xml_cache, dcat, validate,
+                process_workers=PROCESS_WORKERS) -> None:
+    """Write the initial state of a queued job."""
+    write_status(folder, {
+        "fid": fid,
+        "key": key,
+        "doi_prefix": doi_prefix,
+        "status": QUEUED,
+        "headers": headers,
+        "page_size": page_size,
+        "xml_cache": xml_cache,
+        "dcat": dcat,
+        "validate": validate,
+        "process_workers": process_workers,
+        "created": time.time(),
+        "progress": {"records": 0, "total": None},
+        "error": None,
+    })
+
+
+def resume_job(cache: str,
+               fid: str,
+               max_workers: int = JOB_WORKERS) -> dict | None:
+    """Queue a failed or lost job again, continuing from its last checkpoint.
+
+    A queued or running job is lost once its heartbeat stopped, see
+    is_stale, e.g. after the process running it crashed or was restarted.
+
+    Args:
+        cache (str): folder path in which job folders are created
+        fid (str): job id
+        max_workers (int): size of the worker pool if not yet created
+
+    Returns:
+        dict with status code, message and status_url or None if fid is not a job
+    """
+    folder = job_folder(cache, fid)
+    if folder is None:
+        return None
+
+    with _job_lock(cache):
+        status = _read_job_status(folder)
+        if status["status"] != FAILED:
+            return {
+                "status_code": 409,
+                "message": f"Request {fid} is {status['status']}, only failed or lost requests can be resumed.",
+                "error": None,
+                }
+
+        status["status"] = QUEUED
+        status["error"] = None
+        write_status(folder, status)
+        start_heartbeat(folder)
+
+    metrics.QUEUE_DEPTH.inc(queue="jobs")
+    get_executor(max_workers).submit(run_job, folder, status["doi_prefix"],
+                                     status["headers"], status["page_size"], True,
+                                     status.get("xml_cache"), status.get("dcat", False),
+                                     status.get("validate", False),
+                                     status.get("process_workers", PROCESS_WORKERS))
+
+    return {
+        "status_code": 202,
+        "message": f"Request {fid} resumed.",
+        "fid": fid,
+        "status_url": f"/doi_agency/request?fid={fid}",
+        }
+
+
+def run_job(folder: pathlib.Path,
+            doi_prefix: str,
+            headers: dict = DEFAULT_HEADER,
+            page_size: int = 1000,
+            resume: bool = False,
+            xml_cache: str | None = None,
+            dcat: bool = False,
+            validate: bool = False,
+            process_workers: int = PROCESS_WORKERS) -> None:
+    """Harvest DOI list and XML records of doi_prefix into folder.
+
+    Progress and the time spent per harvest stage are written to the job
+    state and a checkpoint is saved in folder after every page. The XML
+    cache is evicted to its size limit afterwards. The heartbeat of the job
+    is kept up until it has finished, including the conversion and
+    validation steps.
+
+    With dcat the records are converted to DCAT-AP CH into the store of
+    the prefix in the dcat folder of the cache, shared by all jobs so only
+    changed records are converted again. A lock file next to the store
+    lets one job at a time convert into it. With validate the records are
+    checked against their DataCite schema and the state gets a summary.
+
+    Args:
+        folder (pathlib.Path): job folder
+        doi_prefix (str): DOI prefix for provider
+        headers (dict): request header to inform DataCite about API call
+        page_size (int): max number of items per cursor page
+        resume (bool): continue from the last checkpoint
+        xml_cache (str | None): SQLite file of the XML cache shared by jobs
+        dcat (bool): convert the records to DCAT-AP CH
+        validate (bool): validate the records against their DataCite schema
+        process_workers (int): worker processes converting or validating records
+    """
+    metrics.QUEUE_DEPTH.dec(queue="jobs")
+    start_heartbeat(folder)
+    try:
+        status = read_status(folder)
+        status["status"] = RUNNING
+        status["started"] = time.time()
+        write_status(folder, status)
+
+        cache = None if xml_cache is None else get_xml_cache(xml_cache)
+        with metrics.collect() as timings:
+            _harvest(folder, status, timings, doi_prefix, headers, page_size, resume, cache, dcat, validate,
+                     process_workers)
+
+        status["finished"] = time.time()
+        status["timings"] = timings.as_dict()
+        write_status(folder, status)
+    finally:
+        stop_heartbeat(folder)
+
+
+def _harvest(folder, status, timings, doi_prefix, headers, page_size, resume, cache, dcat, validate,
+             process_workers) -> None:
+    """Run the harvest of run_job, recording progress or the error in status."""
+    try:
+        status["progress"]["total"] = get_doi_count(doi_prefix, headers=headers)
+        write_status(folder, status)
+
+        records = 0
+        for _ in iter_doi_xml_list_cursor(doi_prefix,
+                                          page_size=page_size,
+                                          headers=headers,
+                                          filename=folder / DOI_FILE,
+                                          folder=folder / XML_FOLDER,
+                                          checkpoint=folder,
+                                          resume=resume,
+                                          cache=cache):
+            records += 1
+            if records % page_size == 0:
+                status["progress"]["records"] = records
+                status["timings"] = timings.as_dict()
+                write_status(folder, status)
+
+        status["progress"]["records"] = records
+        if dcat:
+            output = dcat_store_path(folder.parent / DCAT_FOLDER, doi_prefix)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            #jobs of a prefix with other options share the store, convert one at a time
+            with _file_lock(output.with_name(output.name + ".lock")), RecordStore(output) as store:
+                counts = convert_records(iter_folder_records(folder / XML_FOLDER, folder / DOI_FILE), store,
+                                         workers=process_workers)
+            status["dcat_result"] = {"store": str(output), **counts}
+        if validate:
+            status["validation"] = validate_records(iter_folder_records(folder / XML_FOLDER, folder / DOI_FILE),
+                                                    workers=process_workers)
+        status["status"] = DONE
+        clear_checkpoint(folder)
+        if cache is not None:
+            cache.evict()
+    except Exception as e:
+        log.exception(f"Job {folder.name} failed: {e}")
+        status["status"] = FAILED
+        status["error"] = str(e)
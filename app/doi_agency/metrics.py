@@ -0,0 +1,220 @@
+"""Harvest instrumentation in the Prometheus text format.
+
+Upstream calls and pipeline stages record latency histograms, byte and retry
+counters and queue depth gauges in a process wide registry, rendered by
+render() for the /metrics route. Stage timings are also added to the summary
+of the active collect() block, which jobs store as their timing summary.
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from typing import Iterator
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_summary = contextvars.ContextVar("timing_summary", default=None)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+class _Metric:
+    """Metric with one value per label set."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _render_value(self, labels: dict, value) -> list[str]:
+        return [f"{self.name}{_labels(labels)} {value}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                #one count per bucket, then +Inf count and sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return 0 if counts is None else counts[-2]
+
+    def _render_value(self, labels: dict, counts) -> list[str]:
+        lines = [f"{self.name}_bucket{_labels({**labels, 'le': bound})} {count}"
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {counts[-2]}")
+        lines.append(f"{self.name}_count{_labels(labels)} {counts[-2]}")
+        lines.append(f"{self.name}_sum{_labels(labels)} {counts[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("datacite_request_seconds",
+                            "Latency of DataCite API requests", ("endpoint",))
+REQUESTS = Counter("datacite_requests_total",
+                   "DataCite API responses by status", ("endpoint", "status"))
+RESPONSE_BYTES = Counter("datacite_response_bytes_total",
+                         "Bytes received from the DataCite API", ("endpoint",))
+RETRIES = Counter("datacite_retries_total",
+                  "Retried DataCite API requests", ("endpoint", "reason"))
+STAGE_SECONDS = Histogram("harvest_stage_seconds",
+                          "Time spent per call of a harvest stage", ("stage",))
+QUEUE_DEPTH = Gauge("harvest_queue_depth",
+                    "Items waiting in harvest queues", ("queue",))
+
+REGISTRY = [REQUEST_SECONDS, REQUESTS, RESPONSE_BYTES, RETRIES, STAGE_SECONDS, QUEUE_DEPTH]
+
+
+def endpoint(url) -> str:
+    """Return the DataCite endpoint name of url, e.g. "dois" for list pages and "doi" for records.
+
+    Args:
+        url (str): request URL
+
+    Returns:
+        str
+    """
+    path = str(url).split("://", 1)[-1].split("?", 1)[0]
+    parts = path.split("/")[1:]
+    if not parts or not parts[0]:
+        return "root"
+    return "doi" if parts[0] == "dois" and len(parts) > 1 else parts[0]
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Record one call of a harvest stage, also in the active timing summary.
+
+    Args:
+        stage (str): stage name, e.g. "list_page", "xml_fetch", "decode", "parse" or "write"
+        seconds (float): duration of the call
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    summary = _summary.get()
+    if summary is not None:
+        summary.add(stage, seconds)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed block as one call of harvest stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+class TimingSummary:
+    """Calls and seconds per stage of one job."""
+
+    def __init__(self):
+        self.started = time.time()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            calls, total = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (calls + 1, total + seconds)
+
+    def as_dict(self) -> dict:
+        """Return {"seconds": wall time, "stages": {stage: {"calls", "seconds"}}}."""
+        with self._lock:
+            stages = {k: {"calls": c, "seconds": round(s, 4)} for k, (c, s) in self._stages.items()}
+        return {"seconds": round(time.time() - self.started, 4), "stages": stages}
+
+
+@contextlib.contextmanager
+def collect() -> Iterator[TimingSummary]:
+    """Collect the stage timings of the enclosed block, in this thread, into a TimingSummary."""
+    summary = TimingSummary()
+    token = _summary.set(summary)
+    try:
+        yield summary
+    finally:
+        _summary.reset(token)
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
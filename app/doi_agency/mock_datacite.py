@@ -0,0 +1,311 @@
+"""Local stand-in for the DataCite REST API, for tests and benchmarks.
+
+MockDataCite serves synthetic prefixes of configurable size from the /dois
+(page and cursor mode, sparse fieldsets, prefix, updated and created filters,
+created facets), /dois/{doi} (with ETag) and /prefixes endpoints. It can add
+latency and answer every n-th request with HTTP 429, counts requests by
+endpoint and, for tests, keeps them. Use its handler with
+httpx.MockTransport in process, or serve() it over HTTP and route the DataCite
+URLs to it with LocalTransport.
+"""
+
+import base64
+import datetime
+import http.server
+import threading
+import time
+from logging import getLogger
+
+import httpx
+
+log = getLogger(__name__)
+
+RECORD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<resource xmlns="http://datacite.org/schema/kernel-4" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://datacite.org/schema/kernel-4 http://schema.datacite.org/meta/kernel-4/metadata.xsd">
+  <identifier identifierType="DOI">{doi}</identifier>
+  <creators>
+    <creator>
+      <creatorName nameType="Personal">Doe, Jane</creatorName>
+      <givenName>Jane</givenName>
+      <familyName>Doe</familyName>
+    </creator>
+  </creators>
+  <titles>
+    <title xml:lang="en">Synthetic dataset {number}</title>
+  </titles>
+  <publisher>Example Publisher</publisher>
+  <publicationYear>{year}</publicationYear>
+  <resourceType resourceTypeGeneral="Dataset">Dataset</resourceType>
+  <dates>
+    <date dateType="Updated">{updated}</date>
+  </dates>
+  <descriptions>
+    <description descriptionType="Abstract">{description}</description>
+  </descriptions>
+</resource>
+"""
+
+
+class MockDataCite:
+    """Synthetic DataCite API.
+
+    Args:
+        prefixes (dict): record count by DOI prefix
+        latency (float): seconds added to every response
+        throttle_every (int): answer every n-th request with HTTP 429, 0 never
+        retry_after (float): Retry-After seconds sent with HTTP 429
+        provider_id (str): provider owning all prefixes
+        facet_size (int): created years reported with list responses, latest first like DataCite
+        record (bool): keep the served requests in requests, e.g. to inspect them in tests
+    """
+
+    def __init__(self, prefixes: dict | None = None, latency: float = 0.0,
+                 throttle_every: int = 0, retry_after: float = 0,
+                 provider_id: str = "mock.provider", facet_size: int = 10, record: bool = False):
+        self.prefixes = dict(prefixes or {"10.1234": 100})
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.provider_id = provider_id
+        self.facet_size = facet_size
+        self.record = record
+        self.updated = {}
+        self.deleted = set()
+        self.counts = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._served = 0
+
+    def dois(self, doi_prefix: str) -> list[str]:
+        """Return the DOIs of doi_prefix."""
+        dois = [f"{doi_prefix}/mock.{i}" for i in range(self.prefixes.get(doi_prefix, 0))]
+        return [d for d in dois if d not in self.deleted]
+
+    def xml(self, doi: str) -> bytes:
+        """Return the synthetic XML record of doi."""
+        number = _number(doi)
+        return RECORD_TEMPLATE.format(
+            doi=doi.upper(), number=number, year=2000 + number % 25,
+            updated=self.updated_of(doi)[:10],
+            description=f"Description of synthetic dataset {number}. " * 5,
+        ).encode()
+
+    def updated_of(self, doi: str) -> str:
+        """Return the updated timestamp of doi."""
+        return self.updated.get(doi.lower(), "2020-01-01T00:00:00Z")
+
+    def created_of(self, doi: str) -> str:
+        """Return the created timestamp of doi, in 2021 for odd and 2020 for even numbers."""
+        return f"{2020 + _number(doi) % 2}-01-01T00:00:00Z"
+
+    def attributes(self, doi: str) -> dict:
+        """Return the JSON attributes of doi."""
+        number = _number(doi)
+        return {
+            "doi": doi.lower(),
+            "titles": [{"title": f"Synthetic dataset {number}"}],
+            "creators": [{"name": "Doe, Jane", "nameType": "Personal"}],
+            "publicationYear": 2000 + number % 25,
+            "types": {"resourceTypeGeneral": "Dataset"},
+            "created": self.created_of(doi),
+            "updated": self.updated_of(doi),
+            "xml": base64.b64encode(self.xml(doi)).decode(),
+        }
+
+    def reset_counts(self) -> None:
+        """Forget the recorded requests and their counts."""
+        with self._lock:
+            self.counts = {}
+            self.requests = []
+            self._served = 0
+
+    def _count(self, kind: str, request: httpx.Request) -> bool:
+        """Record a request and return True if it is throttled."""
+        with self._lock:
+            if self.record:
+                self.requests.append(request)
+            self._served += 1
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            throttled = self.throttle_every and self._served % self.throttle_every == 0
+            if throttled:
+                self.counts["429"] = self.counts.get("429", 0) + 1
+            return bool(throttled)
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        """Answer a request to api.datacite.org, usable with httpx.MockTransport."""
+        path = request.url.path
+        kind = "doi" if path.startswith("/dois/") else path.strip("/")
+        if self.latency:
+            time.sleep(self.latency)
+        if self._count(kind, request):
+            return httpx.Response(429, headers={"Retry-After": str(self.retry_after)})
+
+        if kind == "doi":
+            doi = path[len("/dois/"):]
+            if doi.lower() not in self.dois(doi.rsplit("/", 1)[0].lower()):
+                return httpx.Response(404, json={"errors": [{"status": "404"}]})
+            etag = f'"{self.updated_of(doi)}"'
+            if request.headers.get("If-None-Match") == etag:
+                return httpx.Response(304, headers={"ETag": etag})
+            return httpx.Response(200, json={"data": {"id": doi, "type": "dois",
+                                                      "attributes": self.attributes(doi)}},
+                                  headers={"ETag": etag})
+        if kind == "prefixes":
+            return httpx.Response(200, json={"data": [{"id": p, "type": "prefixes"}
+                                                      for p in self.prefixes],
+                                             "links": {}})
+        if kind == "dois":
+            return self._list(request)
+
+        return httpx.Response(404, json={"errors": [{"status": "404"}]})
+
+    def _list(self, request: httpx.Request) -> httpx.Response:
+        params = request.url.params
+        size = int(params.get("page[size]", 25))
+        cursor = params.get("page[cursor]")
+        page = int(cursor if cursor is not None else params.get("page[number]", 1))
+
+        dois = self.dois(params.get("prefix", ""))
+        query = params.get("query", "")
+        if query.startswith("updated:["):
+            since = query.split("[", 1)[1].split(" ", 1)[0]
+            dois = [d for d in dois if self.updated_of(d) >= since]
+        elif query.startswith("created:[* TO "):
+            before = query.split(" TO ", 1)[1][:4]
+            dois = [d for d in dois if self.created_of(d)[:4] < before]
+        if "created" in params:
+            dois = [d for d in dois if self.created_of(d)[:4] == params["created"]]
+
+        fields = params.get("fields[dois]")
+        data = []
+        for d in dois[(page - 1) * size:page * size]:
+            attributes = self.attributes(d)
+            if fields is not None:
+                attributes = {k: v for k, v in attributes.items() if k in fields.split(",")}
+            data.append({"id": d, "type": "dois", "attributes": attributes})
+
+        links = {}
+        if page * size < len(dois):
+            key = "page[cursor]" if cursor is not None else "page[number]"
+            links["next"] = str(request.url.copy_set_param(key, page + 1))
+
+        years = [self.created_of(d)[:4] for d in dois]
+        facets = [{"id": y, "title": y, "count": years.count(y)}
+                  for y in sorted(set(years), reverse=True)][:self.facet_size]
+        return httpx.Response(200, json={
+            "data": data,
+            "meta": {"total": len(dois), "totalPages": -(-len(dois) // size), "page": page,
+                     "created": facets},
+            "links": links,
+        })
+
+    def set_updated(self, doi: str, updated: datetime.datetime | str | None = None) -> None:
+        """Mark doi as updated, by default now."""
+        if updated is None:
+            updated = datetime.datetime.now(datetime.timezone.utc)
+        if isinstance(updated, datetime.datetime):
+            updated = updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.updated[doi.lower()] = updated
+
+    def delete(self, doi: str) -> None:
+        """Remove doi from its prefix, as if deleted at DataCite."""
+        self.deleted.add(doi.lower())
+
+
+def _number(doi: str) -> int:
+    """Return the running number of a synthetic DOI."""
+    suffix = doi.rsplit(".", 1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+class LocalTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """Transport sending every request to base_url instead of its own host.
+
+    Args:
+        base_url (str): URL of a local server, e.g. from serve()
+        pool_size (int): max number of pooled connections
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 100):
+        self.url = httpx.URL(base_url)
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._sync = httpx.HTTPTransport(limits=limits)
+        self._async = httpx.AsyncHTTPTransport(limits=limits)
+
+    def _rewrite(self, request: httpx.Request) -> httpx.Request:
+        request.url = request.url.copy_with(scheme=self.url.scheme, host=self.url.host,
+                                            port=self.url.port)
+        request.headers["Host"] = request.url.netloc.decode()
+        return request
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self._sync.handle_request(self._rewrite(request))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._async.handle_async_request(self._rewrite(request))
+
+    def close(self) -> None:
+        self._sync.close()
+
+    async def aclose(self) -> None:
+        await self._async.aclose()
+
+
+def serve(mock: MockDataCite, host: str = "127.0.0.1", port: int = 0) -> http.server.ThreadingHTTPServer:
+    """Serve mock over HTTP in a background thread, one thread per connection.
+
+    Args:
+        mock (MockDataCite): API to serve
+        host (str): address to bind
+        port (int): port to bind, 0 for a free one
+
+    Returns:
+        http.server.ThreadingHTTPServer, its URL is f"http://{host}:{server.server_port}"
+        and server.shutdown() stops it
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        #headers and body are written separately, avoid delayed ACK stalls
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = f"http://{self.headers.get('Host', host)}{self.path}"
+            response = mock.handler(httpx.Request("GET", url, headers=dict(self.headers)))
+            body = response.content
+            self.send_response(response.status_code)
+            for key, value in response.headers.items():
+                if key.lower() not in ("content-length", "connection"):
+                    self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-datacite").start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a synthetic DataCite API")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--prefix", action="append", default=[],
+                        help="PREFIX=COUNT, may be repeated (default 10.1234=1000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th request with 429")
+    args = parser.parse_args()
+
+    prefixes = dict((p.split("=")[0], int(p.split("=")[1])) for p in args.prefix) or {"10.1234": 1000}
+    server = serve(MockDataCite(prefixes, latency=args.latency, throttle_every=args.throttle_every),
+                   port=args.port)
+    print(f"Mock DataCite API at http://127.0.0.1:{server.server_port} serving {prefixes}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,335 @@
+"""Pipeline runner linking harvest stages with bounded queues.
+
+Every stage runs in its own worker threads and hands items to the next stage
+through a bounded queue, so listing, decoding and writing overlap. A slow
+stage fills its input queue, which blocks the stages before it instead of
+growing memory. Each stage, and the consumer iterating the pipeline, e.g. to
+package records, reports items, busy and idle time and its throughput, and
+queue depths are exported as harvest_queue_depth.
+"""
+
+import contextvars
+import os
+import pathlib
+import queue
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Iterable, Iterator
+
+from app.doi_agency import metrics
+from app.doi_agency.datacite import (
+    DEFAULT_HEADER,
+    datacite_xml_bytes_record,
+    datacite_xml_record,
+    get_page_xml_cached,
+    iter_doi_attributes_cursor,
+    save_xml,
+    store_xml,
+)
+from app.doi_agency.utils import iter_batches
+
+log = getLogger(__name__)
+
+QUEUE_SIZE = 100
+#list pages held by each queue of a harvest pipeline, each up to page_size records
+PAGE_QUEUE_SIZE = 4
+#seconds between checks for an aborted pipeline while waiting on a queue
+POLL_INTERVAL = 0.1
+#seconds a stopped pipeline waits for its threads, one blocked e.g. in a request is left to finish on its own
+JOIN_TIMEOUT = 1.0
+
+_STOP = object()
+
+
+class _Aborted(Exception):
+    """The pipeline was stopped by an error or by its consumer."""
+
+
+class Stage:
+    """One step of a Pipeline.
+
+    Args:
+        name (str): stage name in stats and queue metrics
+        func (Callable): called with every item, returns the item for the next stage or None to drop it
+        workers (int): threads running func
+        queue_size (int | None): capacity of the input queue, default that of the pipeline
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1, queue_size: int | None = None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._finished = 0
+        self._stats = {"items_in": 0, "items_out": 0,
+                       "busy_seconds": 0.0, "idle_seconds": 0.0, "blocked_seconds": 0.0}
+
+    def _add(self, **values) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def _finish(self) -> bool:
+        """Count a finished worker, return True for the last one."""
+        with self._lock:
+            self._finished += 1
+            return self._finished == self.workers
+
+    def stats(self, seconds: float) -> dict:
+        """Return the stats of the stage after running for seconds."""
+        with self._lock:
+            stats = {"workers": self.workers, **self._stats}
+        for key in ("busy_seconds", "idle_seconds", "blocked_seconds"):
+            stats[key] = round(stats[key], 4)
+        stats["items_per_second"] = round(stats["items_in"] / seconds, 1) if seconds else None
+        return stats
+
+
+class Pipeline:
+    """Runs the stages over the items of source, see the module docstring.
+
+    Iterating starts the threads and yields the items leaving the last
+    stage. With more than one worker in a stage items leave in completion
+    order. The first error of a stage stops the pipeline and is raised to
+    the consumer, stopping to iterate stops all stages. Threads are daemons,
+    and a stopped pipeline does not wait for a thread still busy after
+    JOIN_TIMEOUT, e.g. a source blocked in a request.
+
+    Args:
+        source (Iterable): items of the first stage, read in a thread of its own
+        stages (list[Stage]): stages in order
+        queue_size (int): default capacity of the stage queues and of the output queue
+    """
+
+    def __init__(self, source: Iterable, stages: list[Stage], queue_size: int = QUEUE_SIZE):
+        self.source = source
+        self.stages = list(stages)
+        self._queues = [queue.Queue(s.queue_size or queue_size) for s in self.stages]
+        self._queues.append(queue.Queue(queue_size))
+        self._names = [s.name for s in self.stages] + ["output"]
+        self._abort = threading.Event()
+        self._error = None
+        self._started = None
+        self._seconds = None
+        self._source_stats = {"items": 0, "blocked_seconds": 0.0}
+        self._consumer_stats = {"items": 0, "busy_seconds": 0.0, "idle_seconds": 0.0}
+
+    def _put(self, index: int, item) -> float:
+        """Put item into queue index, return the seconds blocked."""
+        start = time.perf_counter()
+        while True:
+            if self._abort.is_set():
+                raise _Aborted()
+            try:
+                self._queues[index].put(item, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        metrics.QUEUE_DEPTH.set(self._queues[index].qsize(), queue=self._names[index])
+        return time.perf_counter() - start
+
+    def _get(self, index: int) -> tuple:
+        """Return the next item of queue index and the seconds waited."""
+        start = time.perf_counter()
+        while True:
+            if self._abort.is_set():
+                raise _Aborted()
+            try:
+                item = self._queues[index].get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                pass
+        metrics.QUEUE_DEPTH.set(self._queues[index].qsize(), queue=self._names[index])
+        return item, time.perf_counter() - start
+
+    def _fail(self, error: Exception) -> None:
+        if self._error is None:
+            self._error = error
+        self._abort.set()
+
+    def _read_source(self) -> None:
+        try:
+            for item in self.source:
+                self._source_stats["blocked_seconds"] += self._put(0, item)
+                self._source_stats["items"] += 1
+            self._put(0, _STOP)
+        except _Aborted:
+            pass
+        except Exception as e:
+            log.exception(f"Pipeline source failed: {e}")
+            self._fail(e)
+        finally:
+            if hasattr(self.source, "close"):
+                self.source.close()
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        try:
+            while True:
+                item, idle = self._get(index)
+                if item is _STOP:
+                    #leave the marker for the other workers of the stage
+                    self._put(index, _STOP)
+                    break
+                start = time.perf_counter()
+                result = stage.func(item)
+                busy = time.perf_counter() - start
+                blocked = 0.0
+                if result is not None:
+                    blocked = self._put(index + 1, result)
+                stage._add(items_in=1, items_out=int(result is not None),
+                           busy_seconds=busy, idle_seconds=idle, blocked_seconds=blocked)
+            if stage._finish():
+                self._put(index + 1, _STOP)
+        except _Aborted:
+            pass
+        except Exception as e:
+            log.exception(f"Pipeline stage {stage.name} failed: {e}")
+            self._fail(e)
+
+    def _start(self) -> list[threading.Thread]:
+        #threads share the context, e.g. the timing summary of a job
+        targets = [(self._read_source, (), "pipeline-source")]
+        for index, stage in enumerate(self.stages):
+            targets += [(self._work, (index,), f"pipeline-{stage.name}")] * stage.workers
+        threads = []
+        for target, args, name in targets:
+            context = contextvars.copy_context()
+            thread = threading.Thread(target=context.run, args=(target, *args), name=name, daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def __iter__(self) -> Iterator:
+        self._started = time.perf_counter()
+        threads = self._start()
+        finished = False
+        try:
+            while True:
+                item, idle = self._get(len(self.stages))
+                if item is _STOP:
+                    finished = True
+                    break
+                self._consumer_stats["idle_seconds"] += idle
+                start = time.perf_counter()
+                yield item
+                #time the consumer spent on the item
+                self._consumer_stats["busy_seconds"] += time.perf_counter() - start
+                self._consumer_stats["items"] += 1
+        except _Aborted:
+            pass
+        finally:
+            self._abort.set()
+            deadline = None if finished else time.monotonic() + JOIN_TIMEOUT
+            for thread in threads:
+                thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            busy = [thread.name for thread in threads if thread.is_alive()]
+            if busy:
+                log.warning(f"Pipeline stopped, leaving busy threads behind: {', '.join(busy)}")
+            self._seconds = time.perf_counter() - self._started
+        if self._error is not None:
+            raise self._error
+
+    def run(self) -> dict:
+        """Run the pipeline, dropping the items of the last stage, and return the stats."""
+        for _ in self:
+            pass
+        return self.stats()
+
+    def stats(self) -> dict:
+        """Return the wall time and the stats of the source, of every stage and of the consumer.
+
+        Returns:
+            dict with seconds, source, stages by name and consumer
+        """
+        seconds = self._seconds
+        if seconds is None:
+            seconds = time.perf_counter() - self._started if self._started else 0.0
+        return {
+            "seconds": round(seconds, 4),
+            "source": {"items": self._source_stats["items"],
+                       "blocked_seconds": round(self._source_stats["blocked_seconds"], 4)},
+            "stages": {s.name: s.stats(seconds) for s in self.stages},
+            "consumer": {"items": self._consumer_stats["items"],
+                         "busy_seconds": round(self._consumer_stats["busy_seconds"], 4),
+                         "idle_seconds": round(self._consumer_stats["idle_seconds"], 4),
+                         "items_per_second": round(self._consumer_stats["items"] / seconds, 1)
+                         if seconds else None},
+        }
+
+
+def harvest_pipeline(doi_prefix: str,
+                     headers: dict = DEFAULT_HEADER,
+                     folder=None,
+                     store=None,
+                     cache=None,
+                     raw: bool = False,
+                     page_size: int = 1000,
+                     filename=None,
+                     decode_workers: int = 1,
+                     write_workers: int = 1,
+                     queue_size: int = PAGE_QUEUE_SIZE) -> Pipeline:
+    """Return a Pipeline harvesting the records of doi_prefix.
+
+    The source lists cursor pages, which carry the XML of their records, so
+    no request per record is needed. Stages: decode (base64, or the XML
+    cache for records whose updated timestamp is unchanged) and write (to
+    folder as numbered files and/or to store). Items are pages: iterating
+    the pipeline yields the list of (DOI, record) of a page once it is
+    written, e.g. to package them.
+
+    Args:
+        doi_prefix (str): DOI prefix for provider
+        headers (dict): request header to inform DataCite about API call
+        folder (str): path string for where to save XML files
+        store (RecordStore): record store to put records into
+        cache (XMLCache): XML cache to reuse unchanged records from
+        raw (bool): keep records as bytes instead of lxml trees
+        page_size (int): max number of items per cursor page
+        filename (str): file path where to write the DOI list
+        decode_workers (int): parallel decoding threads
+        write_workers (int): parallel writing threads
+        queue_size (int): capacity of every stage queue, in pages
+
+    Returns:
+        Pipeline
+    """
+    if folder:
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+    fields = ("doi", "xml") if cache is None else ("doi", "updated", "xml")
+
+    def listing():
+        f = open(filename, "w") if filename else None
+        try:
+            attributes = enumerate(iter_doi_attributes_cursor(doi_prefix, fields=fields, page_size=page_size,
+                                                              headers=headers), start=1)
+            #batches of page_size are the cursor pages
+            for page in iter_batches(attributes, page_size):
+                if f is not None:
+                    f.writelines(a["doi"] + "\n" for _, a in page)
+                yield page
+        finally:
+            if f is not None:
+                f.close()
+
+    def decode(page):
+        if cache is None:
+            return [(i, a["doi"], datacite_xml_record(a["doi"], a["xml"], raw=raw)) for i, a in page]
+        return [(i, a["doi"], datacite_xml_bytes_record(a["doi"], get_page_xml_cached(a, cache, headers=headers),
+                                                        raw=raw))
+                for i, a in page]
+
+    def write(page):
+        for i, d, record in page:
+            if folder:
+                save_xml(record, os.path.join(folder, f"{i}.xml"))
+            if store is not None:
+                store_xml(store, d, record)
+        return [(d, record) for _, d, record in page]
+
+    return Pipeline(listing(), [
+        Stage("decode", decode, workers=decode_workers),
+        Stage("write", write, workers=write_workers),
+    ], queue_size=queue_size)
@@ -0,0 +1,235 @@
+"""Adaptive rate limiting and retry policy for DataCite API calls.
+
+One RateLimiter is shared by every thread and async task of a process. Its
+request schedule (a token bucket kept as the next free send time) and any
+pause requested by a 429 can also be shared between processes through a
+state file.
+
+DataCite allows about 3000 requests per 5 minutes per client address.
+"""
+
+import asyncio
+import contextlib
+import email.utils
+import json
+import random
+import threading
+import time
+import weakref
+from collections import defaultdict
+from logging import getLogger
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+log = getLogger(__name__)
+
+RATE = 10.0
+BURST = 10
+HOST_CONCURRENCY = 10
+MAX_RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 60.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Return seconds to wait from a Retry-After header, in seconds or HTTP date form.
+
+    Args:
+        value (str | None): Retry-After header value
+
+    Returns:
+        float | None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket with 429 pauses, AIMD rate adaptation and a per-host concurrency cap.
+
+    The rate is halved on every 429 and creeps back to the configured rate
+    with each successful call.
+
+    Args:
+        rate (float | None): max requests per second, None disables the bucket
+        burst (int): requests that can be sent at once after being idle
+        host_concurrency (int): max requests in flight per host, for the threads
+            of a process and for the tasks of each event loop
+        max_retries (int): retries for a failed request
+        backoff (float): base of the exponential backoff in seconds
+        max_backoff (float): upper bound of a single backoff in seconds
+        path (str | None): state file shared between processes
+    """
+
+    def __init__(self,
+                 rate: float | None = RATE,
+                 burst: int = BURST,
+                 host_concurrency: int = HOST_CONCURRENCY,
+                 max_retries: int = MAX_RETRIES,
+                 backoff: float = BACKOFF,
+                 max_backoff: float = MAX_BACKOFF,
+                 path: str | None = None):
+        self.max_rate = rate
+        self.burst = max(1, burst)
+        self.host_concurrency = max(1, host_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.path = path if fcntl is not None else None
+
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+        self._host_slots = defaultdict(lambda: threading.BoundedSemaphore(self.host_concurrency))
+        #asyncio semaphores by host of each event loop, tasks cannot wait on the threading ones
+        self._async_host_slots = weakref.WeakKeyDictionary()
+
+    def _initial_state(self) -> dict:
+        return {"next": 0.0, "paused_until": 0.0, "rate": self.max_rate}
+
+    def _update(self, fn):
+        """Apply fn to the shared state under the thread and file lock and return its result."""
+        with self._lock:
+            if self.path is None:
+                return fn(self._state)
+
+            with open(self.path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else self._initial_state()
+                    result = fn(state)
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self) -> float:
+        """Reserve a send slot and return the seconds to wait before using it.
+
+        Returns:
+            float
+        """
+        def fn(state):
+            now = time.time()
+            if self.max_rate is None:
+                return max(0.0, state["paused_until"] - now)
+
+            interval = 1.0 / state["rate"]
+            start = max(now, state["next"] - (self.burst - 1) * interval, state["paused_until"])
+            state["next"] = max(state["next"], start) + interval
+            return start - now
+
+        return self._update(fn)
+
+    async def async_reserve(self) -> float:
+        """Like reserve, locking the state file in a worker thread so the event loop is not blocked.
+
+        Returns:
+            float
+        """
+        if self.path is None:
+            return self.reserve()
+        return await asyncio.to_thread(self.reserve)
+
+    def throttled(self, retry_after: float | None = None) -> None:
+        """Record a 429: pause all callers and halve the rate.
+
+        Args:
+            retry_after (float | None): seconds requested by the server
+        """
+        def fn(state):
+            pause = retry_after if retry_after is not None else self.backoff
+            state["paused_until"] = max(state["paused_until"], time.time() + pause)
+            if self.max_rate is not None:
+                state["rate"] = max(self.max_rate / 100, state["rate"] / 2)
+            log.warning(f"Throttled by server, pausing {pause:.1f}s at {state['rate']} requests/s")
+
+        self._update(fn)
+
+    def success(self) -> None:
+        """Record a successful call, raising the rate towards the configured rate."""
+        if self.max_rate is None:
+            return
+
+        def fn(state):
+            state["rate"] = min(self.max_rate, state["rate"] + self.max_rate / 100)
+
+        self._update(fn)
+
+    def backoff_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Return seconds to wait before retry number attempt + 1.
+
+        Retry-After wins, otherwise exponential backoff with full jitter.
+
+        Args:
+            attempt (int): number of the failed attempt, starting at 0
+            retry_after (float | None): seconds requested by the server
+
+        Returns:
+            float
+        """
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._host_slots[host]
+
+    @contextlib.contextmanager
+    def host_slot(self, host: str):
+        """Hold one of the concurrent request slots of host."""
+        with self._slot(host):
+            yield
+
+    def _async_slot(self, host: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = self._async_host_slots.setdefault(loop, {})
+            if host not in slots:
+                slots[host] = asyncio.Semaphore(self.host_concurrency)
+            return slots[host]
+
+    @contextlib.asynccontextmanager
+    async def async_host_slot(self, host: str):
+        """Hold one of the concurrent request slots of host in the running event loop."""
+        async with self._async_slot(host):
+            yield
+
+
+_limiter = RateLimiter()
+
+
+def configure(**kwargs) -> RateLimiter:
+    """Replace the shared limiter, keyword arguments as for RateLimiter.
+
+    Returns:
+        RateLimiter
+    """
+    global _limiter
+    _limiter = RateLimiter(**kwargs)
+    return _limiter
+
+
+def get_limiter() -> RateLimiter:
+    """Return the shared limiter.
+
+    Returns:
+        RateLimiter
+    """
+    return _limiter
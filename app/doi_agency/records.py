@@ -0,0 +1,50 @@
+"""DataCite XML records kept as raw bytes."""
+
+import base64
+
+from lxml import etree as ET
+
+
+class DataCiteRecord:
+    """DataCite XML record kept as the decoded bytes from the API.
+
+    The lxml tree is only built when tree is first accessed, so archiving a
+    record costs a base64 decode and a write.
+
+    Args:
+        doi (str): full DOI string
+        xml (bytes): XML document
+    """
+
+    __slots__ = ("doi", "xml", "_tree")
+
+    def __init__(self, doi: str, xml: bytes):
+        self.doi = doi
+        self.xml = xml
+        self._tree = None
+
+    @classmethod
+    def from_base64(cls, doi: str, xml: str) -> "DataCiteRecord":
+        """Return record from the base64 encoded xml attribute of the DataCite JSON."""
+        return cls(doi, base64.b64decode(xml))
+
+    @classmethod
+    def from_file(cls, doi: str, path) -> "DataCiteRecord":
+        """Return record read from an XML file."""
+        with open(path, "rb") as f:
+            return cls(doi, f.read())
+
+    @property
+    def tree(self) -> ET._Element:
+        """Root element of the record, parsed on first access."""
+        if self._tree is None:
+            self._tree = ET.fromstring(self.xml)
+        return self._tree
+
+    def write(self, path) -> None:
+        """Write the XML bytes unchanged to path."""
+        with open(path, "wb") as f:
+            f.write(self.xml)
+
+    def __repr__(self) -> str:
+        return f"DataCiteRecord({self.doi!r}, {len(self.xml)} bytes)"
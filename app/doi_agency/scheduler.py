@@ -0,0 +1,204 @@
+"""Harvest scheduler for several DOI prefixes or whole providers.
+
+Prefixes are expanded into one harvest task each, sized by their meta.total,
+and run in a worker pool largest first, so a big prefix starts early and the
+small ones fill the remaining workers. Progress is combined over all tasks.
+"""
+
+import pathlib
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, Iterable
+
+from app.doi_agency.datacite import (
+    DEFAULT_HEADER,
+    get_doi_count,
+    get_provider_prefixes,
+    iter_doi_xml_list_cursor,
+)
+
+log = getLogger(__name__)
+
+WORKERS = 4
+DOI_FILE = "doi.txt"
+XML_FOLDER = "xml"
+
+
+class HarvestProgress:
+    """Thread-safe record counts of all harvest tasks.
+
+    Args:
+        tasks (list[tuple[str, int]]): (DOI prefix, record count) of each task
+        callback (Callable[[dict], None] | None): called with snapshot() after every page
+    """
+
+    def __init__(self, tasks: list[tuple[str, int]],
+                 callback: Callable[[dict], None] | None = None):
+        self.callback = callback
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._prefixes = {
+            doi_prefix: {"status": "queued", "records": 0, "total": total, "error": None}
+            for doi_prefix, total in tasks
+        }
+
+    def update(self, doi_prefix: str, **kwargs) -> None:
+        """Update the state of a prefix and report the combined progress.
+
+        Args:
+            doi_prefix (str): DOI prefix of the task
+            **kwargs: status, records, error or seconds of the task
+        """
+        with self._lock:
+            self._prefixes[doi_prefix].update(kwargs)
+        if self.callback is not None:
+            self.callback(self.snapshot())
+
+    def snapshot(self) -> dict:
+        """Return combined and per prefix progress.
+
+        Returns:
+            dict with records, total, done, failed, seconds and prefixes
+        """
+        with self._lock:
+            prefixes = {k: dict(v) for k, v in self._prefixes.items()}
+        return {
+            "records": sum(p["records"] for p in prefixes.values()),
+            "total": sum(p["total"] for p in prefixes.values()),
+            "done": sum(p["status"] == "done" for p in prefixes.values()),
+            "failed": sum(p["status"] == "failed" for p in prefixes.values()),
+            "seconds": time.time() - self.started,
+            "prefixes": prefixes,
+        }
+
+
+def expand_prefixes(doi_prefixes: Iterable[str] = (),
+                    provider_ids: Iterable[str] = (),
+                    headers: dict = DEFAULT_HEADER) -> list[str]:
+    """Return the DOI prefixes given and those of the providers, without duplicates.
+
+    Args:
+        doi_prefixes (Iterable[str]): DOI prefixes
+        provider_ids (Iterable[str]): DataCite provider ids
+        headers (dict): request header to inform DataCite about API call
+
+    Returns:
+        list[str]
+    """
+    prefixes = list(doi_prefixes)
+    for provider_id in provider_ids:
+        provider_prefixes = get_provider_prefixes(provider_id, headers=headers)
+        log.info(f"Provider {provider_id} has {len(provider_prefixes)} prefixes")
+        prefixes.extend(provider_prefixes)
+
+    return list(dict.fromkeys(prefixes))
+
+
+def plan_harvest(doi_prefixes: Iterable[str],
+                 headers: dict = DEFAULT_HEADER,
+                 workers: int = WORKERS) -> list[tuple[str, int]]:
+    """Return (DOI prefix, record count) tasks, largest first, skipping empty prefixes.
+
+    Args:
+        doi_prefixes (Iterable[str]): DOI prefixes
+        headers (dict): request header to inform DataCite about API call
+        workers (int): number of record counts requested in parallel
+
+    Returns:
+        list[tuple[str, int]]
+    """
+    doi_prefixes = list(doi_prefixes)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        totals = list(executor.map(lambda p: get_doi_count(p, headers=headers), doi_prefixes))
+
+    tasks = sorted(zip(doi_prefixes, totals), key=lambda task: task[1], reverse=True)
+    return [task for task in tasks if task[1] > 0]
+
+
+def prefix_folder(folder, doi_prefix: str) -> pathlib.Path:
+    """Return the folder of doi_prefix in folder.
+
+    Args:
+        folder (str): folder for all prefixes
+        doi_prefix (str): DOI prefix
+
+    Returns:
+        pathlib.Path
+    """
+    return pathlib.Path(folder) / urllib.parse.quote(doi_prefix, safe="")
+
+
+def harvest_prefixes(doi_prefixes: Iterable[str] = (),
+                     provider_ids: Iterable[str] = (),
+                     folder=None,
+                     headers: dict = DEFAULT_HEADER,
+                     workers: int = WORKERS,
+                     page_size: int = 1000,
+                     raw: bool = False,
+                     store=None,
+                     cache=None,
+                     callback: Callable[[dict], None] | None = None) -> dict:
+    """Harvest the DOI lists and XML records of several prefixes in a worker pool.
+
+    Each prefix is harvested with iter_doi_xml_list_cursor into its own
+    sub folder of folder (DOI list and numbered XML files) and/or into store.
+    A failed prefix is reported and does not stop the others.
+
+    Args:
+        doi_prefixes (Iterable[str]): DOI prefixes
+        provider_ids (Iterable[str]): DataCite provider ids whose prefixes are harvested too
+        folder (str): folder in which a sub folder per prefix is created
+        headers (dict): request header to inform DataCite about API call
+        workers (int): number of prefixes harvested at the same time
+        page_size (int): max number of items per cursor page
+        raw (bool): keep records as bytes instead of lxml trees
+        store (RecordStore): record store shared by all prefixes
+        cache (XMLCache): XML cache to reuse unchanged records from
+        callback (Callable[[dict], None] | None): called with the combined progress after every page
+
+    Returns:
+        dict: combined progress, see HarvestProgress.snapshot
+    """
+    prefixes = expand_prefixes(doi_prefixes, provider_ids, headers=headers)
+    tasks = plan_harvest(prefixes, headers=headers, workers=workers)
+    progress = HarvestProgress(tasks, callback=callback)
+    log.info(f"Harvesting {len(tasks)} prefixes with {sum(t for _, t in tasks)} records "
+             f"using {workers} workers")
+
+    def run(task):
+        doi_prefix, _ = task
+        started = time.time()
+        progress.update(doi_prefix, status="running")
+
+        kwargs = {}
+        if folder is not None:
+            sub_folder = prefix_folder(folder, doi_prefix)
+            sub_folder.mkdir(parents=True, exist_ok=True)
+            kwargs = {"filename": sub_folder / DOI_FILE, "folder": sub_folder / XML_FOLDER}
+
+        records = 0
+        try:
+            for _ in iter_doi_xml_list_cursor(doi_prefix, page_size=page_size, headers=headers,
+                                              raw=raw, store=store, cache=cache, **kwargs):
+                records += 1
+                if records % page_size == 0:
+                    progress.update(doi_prefix, records=records)
+        except Exception as e:
+            log.exception(f"Harvest of prefix {doi_prefix} failed: {e}")
+            progress.update(doi_prefix, status="failed", records=records, error=str(e),
+                            seconds=time.time() - started)
+            return
+
+        progress.update(doi_prefix, status="done", records=records,
+                        seconds=time.time() - started)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="doi-prefix") as executor:
+        list(executor.map(run, tasks))
+
+    result = progress.snapshot()
+    log.info(f"Harvested {result['records']} records of {result['done']} prefixes "
+             f"in {result['seconds']:.1f}s, {result['failed']} failed")
+    return result
@@ -0,0 +1,174 @@
+"""Single-file record store for harvested DataCite XML records.
+
+Records live in one SQLite file keyed by DOI instead of one XML file per
+record, which keeps large prefixes cheap to list, copy and remove.
+"""
+
+import pathlib
+import sqlite3
+import threading
+import time
+import zlib
+from logging import getLogger
+from typing import Iterable, Iterator
+
+log = getLogger(__name__)
+
+STORE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+BATCH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    doi TEXT PRIMARY KEY,
+    xml BLOB NOT NULL,
+    compressed INTEGER NOT NULL,
+    stored REAL NOT NULL
+)
+"""
+
+
+def is_store_path(path) -> bool:
+    """Return True if path names a record store file rather than a folder.
+
+    Args:
+        path (str): cache path
+
+    Returns:
+        bool
+    """
+    return pathlib.Path(path).suffix in STORE_SUFFIXES
+
+
+class RecordStore:
+    """Appendable record store with lookup by DOI and sequential scans.
+
+    Writes are committed in batches of batch_size, call commit() or close()
+    (or use the store as context manager) to make the last batch durable.
+    The store can be shared between threads.
+
+    Args:
+        path (str): SQLite file, created if missing
+        compress (bool): zlib compress records written from now on
+        batch_size (int): writes per commit
+    """
+
+    def __init__(self, path, compress: bool = False, batch_size: int = BATCH_SIZE):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def put(self, doi: str, xml: bytes) -> None:
+        """Insert or replace the record of doi.
+
+        Args:
+            doi (str): full DOI string
+            xml (bytes): XML document
+        """
+        data = zlib.compress(xml) if self.compress else xml
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO records (doi, xml, compressed, stored) VALUES (?, ?, ?, ?)",
+                (doi.lower(), data, int(self.compress), time.time()))
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._commit()
+
+    def put_many(self, records: Iterable[tuple[str, bytes]]) -> None:
+        """Insert or replace (DOI, XML) records.
+
+        Args:
+            records (Iterable[tuple[str, bytes]]): records to store
+        """
+        for doi, xml in records:
+            self.put(doi, xml)
+
+    def get(self, doi: str) -> bytes | None:
+        """Return the XML of doi, or None if it is not stored.
+
+        Args:
+            doi (str): full DOI string
+
+        Returns:
+            bytes | None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT xml, compressed FROM records WHERE doi = ?",
+                                   (doi.lower(),)).fetchone()
+        return None if row is None else self._decode(*row)
+
+    def delete(self, doi: str) -> None:
+        """Remove the record of doi if stored.
+
+        Args:
+            doi (str): full DOI string
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM records WHERE doi = ?", (doi.lower(),))
+            self._pending += 1
+
+    def dois(self) -> Iterator[str]:
+        """Yield the stored DOIs in insertion order."""
+        with self._lock:
+            rows = self._db.execute("SELECT doi FROM records ORDER BY rowid").fetchall()
+        for (doi,) in rows:
+            yield doi
+
+    def iter_records(self) -> Iterator[tuple[str, bytes]]:
+        """Yield (DOI, XML) records in insertion order, one at a time.
+
+        Returns:
+            Iterator[tuple[str, bytes]]
+        """
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT rowid, doi, xml, compressed FROM records WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last, self.batch_size)).fetchall()
+            if not rows:
+                return
+            for last, doi, data, compressed in rows:
+                yield doi, self._decode(data, compressed)
+
+    def __contains__(self, doi: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM records WHERE doi = ?",
+                                    (doi.lower(),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def commit(self) -> None:
+        """Commit pending writes."""
+        with self._lock:
+            self._commit()
+
+    def close(self) -> None:
+        """Commit pending writes and close the file."""
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def _commit(self) -> None:
+        self._db.commit()
+        self._pending = 0
+
+    @staticmethod
+    def _decode(data: bytes, compressed: int) -> bytes:
+        return zlib.decompress(data) if compressed else data
+
+    def __enter__(self) -> "RecordStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,16 @@
+from app.doi_agency import benchmark
+
+
+def test_benchmarks_against_mock_server(tmp_path):
+    output = tmp_path / "bench.json"
+    results = benchmark.main(["-n", "40", "--xml-records", "10", "--page-size", "10",
+                              "--throttle-every", "7", "-o", str(output)])
+    by_name = {r["name"]: r for r in results}
+
+    assert set(by_name) == set(benchmark.BENCHMARKS)
+    assert by_name["get_doi_list_cursor"]["records"] == 40
+    assert by_name["get_xml_list_datacite_concurrent"]["records"] == 10
+    #throttled requests are retried
+    assert by_name["get_xml_list_datacite"]["requests"]["doi"] > 10
+    assert by_name["get_xml_list_datacite"]["peak_memory_mb"] > 0
+    assert output.is_file()
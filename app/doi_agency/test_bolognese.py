@@ -0,0 +1,75 @@
+import sys
+import time
+
+import pytest
+
+from app.doi_agency import bolognese, datacite
+from app.doi_agency.bolognese import BologneseError, BologneseWorker, docker_command
+from app.doi_agency.store import RecordStore
+
+FAKE_COMMAND = [sys.executable, "-m", "app.doi_agency.fake_bolognese"]
+
+
+def test_worker_converts_batches_in_order():
+    dois = [f"https://doi.org/10.1234/fake.{i}" for i in range(23)]
+    with BologneseWorker(FAKE_COMMAND, concurrency=3, batch_size=5) as worker:
+        results = list(worker.iter_convert(dois))
+        #processes stay up between calls
+        pids = {p._popen.pid for p in worker._processes}
+        assert worker.convert(dois[0]).startswith("<?xml")
+        assert {p._popen.pid for p in worker._processes} == pids
+
+    assert [r[0] for r in results] == dois
+    assert all(error is None and "10.1234/FAKE." in output for _, output, error in results)
+    assert len(pids) == 3
+
+
+def test_worker_reports_errors_and_restarts():
+    with BologneseWorker(FAKE_COMMAND, concurrency=1, batch_size=2) as worker:
+        with pytest.raises(BologneseError):
+            worker.convert("10.1234/missing")
+        #the answer read before the crash is kept, only the crashing DOI fails
+        results = list(worker.iter_convert(["10.1234/a", "10.1234/crash", "10.1234/b"]))
+        assert [error is None for _, _, error in results] == [True, False, True]
+        assert "exited" in results[1][2]
+        assert worker.convert("10.1234/c")
+
+
+def test_error_without_id_fails_the_batch_at_once():
+    with BologneseWorker(FAKE_COMMAND, concurrency=1, batch_size=3, timeout=60) as worker:
+        start = time.perf_counter()
+        results = list(worker.iter_convert(["10.1234/a", "10.1234/noid", "10.1234/b"]))
+        assert time.perf_counter() - start < 30
+        assert [error is None for _, _, error in results] == [True, False, True]
+        assert "unreadable request" in results[1][2]
+
+
+def test_docker_containers_are_named_and_killed(monkeypatch):
+    assert docker_command("image", "worker-1")[:6] == ["docker", "run", "--rm", "-i", "--name", "worker-1"]
+    killed = []
+    monkeypatch.setattr(bolognese.subprocess, "run", lambda command, **kwargs: killed.append(command))
+
+    process = bolognese._Process(FAKE_COMMAND)
+    process._start()
+    process._container = "bolognese-worker-1"
+    process.kill()
+    assert killed == [["docker", "kill", "bolognese-worker-1"]]
+    assert process._popen is None
+
+
+def test_worker_restarts_hung_process():
+    with BologneseWorker(FAKE_COMMAND, concurrency=1, batch_size=3, timeout=0.5) as worker:
+        results = list(worker.iter_convert(["10.1234/a", "10.1234/hang", "10.1234/b"]))
+        assert [error is None for _, _, error in results] == [True, False, True]
+        assert "did not answer" in results[1][2]
+        assert worker.convert("10.1234/c")
+
+
+def test_iter_xml_list_bolognese(tmp_path):
+    dois = ["10.1234/a", "10.1234/missing", "10.1234/b"]
+    with BologneseWorker(FAKE_COMMAND) as worker, RecordStore(tmp_path / "records.sqlite") as store:
+        records = list(datacite.iter_xml_list_bolognese(dois, worker=worker, folder=tmp_path / "xml",
+                                                        raw=True, store=store))
+        assert [r.doi for r in records] == ["10.1234/a", "10.1234/b"]
+        assert store.get("10.1234/b") == records[1].xml
+    assert sorted(p.name for p in (tmp_path / "xml").iterdir()) == ["1.xml", "3.xml"]
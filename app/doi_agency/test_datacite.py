@@ -0,0 +1,321 @@
+import asyncio
+
+import httpx
+import pytest
+from lxml import etree as ET
+
+from app.doi_agency import client, datacite, metrics, ratelimit, scheduler
+from app.doi_agency.mock_datacite import MockDataCite
+from app.doi_agency.store import RecordStore
+from app.doi_agency.xmlcache import XMLCache
+
+PREFIXES = {"10.1234": 5}
+DOIS = MockDataCite(PREFIXES).dois("10.1234")
+
+
+def identifier(tree):
+    return tree.findtext("{*}identifier").lower()
+
+
+@pytest.fixture(autouse=True)
+def mock():
+    mock = MockDataCite(PREFIXES, record=True)
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    ratelimit.configure(rate=None, max_retries=2, backoff=0)
+    yield mock
+    client.configure()
+    ratelimit.configure()
+
+
+def test_doi_list_cursor_and_page(tmp_path):
+    filename = tmp_path / "doi.txt"
+    assert datacite.get_doi_list_cursor("10.1234", page_size=2, filename=filename) == DOIS
+    assert filename.read_text().split() == DOIS
+    assert datacite.get_doi_list_page("10.1234", page_size=2) == DOIS
+    assert datacite.get_doi_list_page("10.1234", page_size=1, concurrency=4) == DOIS
+
+    assert list(datacite.iter_doi_attributes_cursor("10.1234", fields=["updated"], page_size=2)) == \
+        [{"doi": d, "updated": "2020-01-01T00:00:00Z"} for d in DOIS]
+
+
+def test_harvest_from_cursor_pages(tmp_path):
+    doi_list, xml_list = datacite.get_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path)
+    assert doi_list == DOIS
+    assert [identifier(x) for x in xml_list] == DOIS
+    assert len(list(tmp_path.glob("*.xml"))) == len(DOIS)
+
+
+def test_harvest_needs_no_record_requests(tmp_path, mock):
+    filename = tmp_path / "doi.txt"
+    doi_list, xml_list = datacite.get_doi_xml_list_cursor("10.1234", page_size=2, filename=filename,
+                                                          header_line=True, folder=tmp_path / "xml")
+
+    #three pages, the last one without a next link
+    assert [r.url.path for r in mock.requests] == ["/dois"] * 3
+    assert mock.requests[0].url.params["fields[dois]"] == "doi,xml"
+    assert filename.read_text().split() == ["5"] + DOIS
+    assert identifier(ET.parse(str(tmp_path / "xml" / "4.xml")).getroot()) == DOIS[3]
+    page = {"data": [{"id": DOIS[0], "attributes": mock.attributes(DOIS[0])}]}
+    assert datacite.datacite_xml_json_to_list(page) == [(DOIS[0], mock.attributes(DOIS[0])["xml"])]
+
+
+def test_generators_request_pages_as_consumed(tmp_path, mock):
+    def paths():
+        return [r.url.path for r in mock.requests]
+
+    for dois in (datacite.iter_doi_list_page("10.1234", page_size=2),
+                 datacite.iter_doi_list_cursor("10.1234", page_size=2)):
+        mock.reset_counts()
+        assert next(dois) == DOIS[0]
+        assert paths() == ["/dois"]
+        assert list(dois) == DOIS[1:]
+
+    #records are requested and saved one DOI at a time
+    mock.reset_counts()
+    records = datacite.iter_xml_list_datacite(datacite.iter_doi_list_cursor("10.1234", page_size=2),
+                                              folder=tmp_path / "xml", raw=True)
+    assert next(records).doi == DOIS[0]
+    assert paths() == ["/dois", f"/dois/{DOIS[0]}"]
+    assert [p.name for p in (tmp_path / "xml").iterdir()] == ["1.xml"]
+    assert [r.doi for r in records] == DOIS[1:]
+
+    mock.reset_counts()
+    pairs = datacite.iter_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path / "harvest", raw=True)
+    assert next(pairs)[0] == DOIS[0]
+    assert paths() == ["/dois"]
+    assert len(list(pairs)) == len(DOIS) - 1
+
+
+def test_concurrent_xml_keeps_order(tmp_path):
+    xml_list = datacite.get_xml_list_datacite_concurrent(DOIS, folder=tmp_path, concurrency=3)
+    assert [identifier(x) for x in xml_list] == DOIS
+    assert (tmp_path / "2.xml").is_file()
+
+
+def test_concurrent_xml_from_iterator(tmp_path, mock):
+    dois = datacite.iter_doi_list_cursor("10.1234", page_size=2)
+    xml_list = datacite.get_xml_list_datacite_concurrent(dois, folder=tmp_path, concurrency=2, raw=True)
+    assert [x.doi for x in xml_list] == DOIS
+    assert (tmp_path / "5.xml").read_bytes() == xml_list[4].xml
+
+    async def fetch():
+        return await datacite.get_xml_list_datacite_async(iter(DOIS[:3]), concurrency=8, raw=True)
+
+    assert [x.doi for x in asyncio.run(fetch())] == DOIS[:3]
+    assert datacite.get_xml_list_datacite_concurrent(iter([]), concurrency=2) == []
+
+    mock.delete(DOIS[3])
+    with pytest.raises(httpx.HTTPStatusError):
+        datacite.get_xml_list_datacite_concurrent(iter(DOIS), concurrency=2)
+
+
+def test_incremental_sync(tmp_path, mock):
+    result = datacite.sync_doi_prefix("10.1234", folder=tmp_path, page_size=2)
+    assert result == {"added": DOIS, "updated": [], "deleted": []}
+
+    mock.prefixes["10.1234"] += 1
+    new = mock.dois("10.1234")[-1]
+    mock.set_updated(new, "2999-01-01T00:00:00Z")
+    mock.set_updated(DOIS[3], "2999-01-01T00:00:00Z")
+    mock.delete(DOIS[0])
+
+    result = datacite.sync_doi_prefix("10.1234", folder=tmp_path, page_size=2)
+    assert result == {"added": [new], "updated": [DOIS[3]], "deleted": [DOIS[0]]}
+    assert sorted(p.name for p in tmp_path.glob("*.xml")) == \
+        sorted(datacite.doi_to_file(d) for d in mock.dois("10.1234"))
+
+
+def test_incremental_sync_migrates_numbered_files(tmp_path):
+    datacite.get_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path)
+    assert (tmp_path / "1.xml").is_file()
+
+    result = datacite.sync_doi_prefix("10.1234", folder=tmp_path, page_size=2)
+    assert result["added"] == DOIS
+    assert sorted(p.name for p in tmp_path.glob("*.xml")) == sorted(datacite.doi_to_file(d) for d in DOIS)
+
+    (tmp_path / "1.xml").write_text("<resource/>")
+    with pytest.raises(ValueError):
+        datacite.sync_doi_prefix("10.1234", folder=tmp_path, page_size=2)
+
+
+def test_resume_cursor_harvest(tmp_path, mock):
+    def failing(request):
+        if request.url.params.get("page[cursor]") == "3":
+            return httpx.Response(500, text="")
+        return mock.handler(request)
+
+    client.configure(transport=httpx.MockTransport(failing))
+    with pytest.raises(httpx.HTTPStatusError):
+        datacite.get_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path, checkpoint=tmp_path)
+    assert datacite.load_checkpoint(tmp_path)["harvest"]["records"] == 4
+
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    doi_list, xml_list = datacite.get_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path,
+                                                          checkpoint=tmp_path, resume=True)
+    assert doi_list == DOIS
+    assert [identifier(x) for x in xml_list] == DOIS
+
+
+def test_resume_concurrent_xml_and_sharded_list(tmp_path, mock):
+    def failing(request):
+        if request.url.path == f"/dois/{DOIS[3]}":
+            return httpx.Response(404, json={"errors": []})
+        return mock.handler(request)
+
+    client.configure(transport=httpx.MockTransport(failing))
+    doi_list = datacite.get_doi_list_sharded("10.1234", page_size=2, checkpoint=tmp_path)
+    with pytest.raises(httpx.HTTPStatusError):
+        datacite.get_xml_list_datacite_concurrent(doi_list, folder=tmp_path, concurrency=1,
+                                                  checkpoint=tmp_path)
+    failed = doi_list.index(DOIS[3])
+    assert datacite.load_checkpoint(tmp_path)["xml"]["records"] == failed
+
+    #the list is not requested again and the saved records are read back
+    mock.reset_counts()
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    assert datacite.get_doi_list_sharded("10.1234", page_size=2, checkpoint=tmp_path, resume=True) == doi_list
+    xml_list = datacite.get_xml_list_datacite_concurrent(doi_list, folder=tmp_path, concurrency=2,
+                                                         checkpoint=tmp_path, resume=True)
+    assert [identifier(x) for x in xml_list] == doi_list
+    assert sorted(r.url.path for r in mock.requests) == ["/dois/" + d for d in sorted(doi_list[failed:])]
+    assert datacite.load_checkpoint(tmp_path)["xml"]["records"] == len(DOIS)
+
+
+def test_sharded_doi_list(tmp_path):
+    filename = tmp_path / "doi.txt"
+    doi_list = datacite.get_doi_list_sharded("10.1234", shard="created", page_size=2, filename=filename)
+    assert sorted(doi_list) == DOIS
+    #records of 2021 come first, the latest year is the first facet
+    assert doi_list[:2] == [DOIS[1], DOIS[3]]
+    assert filename.read_text().split() == doi_list
+
+
+def test_sharded_doi_list_with_truncated_facets(mock):
+    mock.facet_size = 1
+    doi_list = datacite.get_doi_list_sharded("10.1234", shard="created", page_size=2)
+    assert sorted(doi_list) == DOIS
+
+    #facets, one page of the 2021 slice and two of the records created before
+    params = [r.url.params for r in mock.requests]
+    assert len(params) == 1 + 1 + 2
+    assert sorted(p.get("query") for p in params[1:] if "query" in p) == ["created:[* TO 2021-01-01}"] * 2
+
+
+def test_retry_after_429(mock):
+    mock.throttle_every = 2
+    assert datacite.get_doi_list_cursor("10.1234", page_size=2) == DOIS
+    assert mock.counts["429"] == 2
+    assert mock.requests[1].url == mock.requests[2].url
+
+
+def test_async_requests_share_host_slots_and_state_file(tmp_path):
+    state = tmp_path / "ratelimit.json"
+    ratelimit.configure(rate=None, host_concurrency=2, backoff=0, path=state)
+    in_flight = []
+    peak = []
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        in_flight.append(request)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(request)
+        return httpx.Response(200, json={})
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as async_client:
+            return await asyncio.gather(*(client.async_get(async_client, "https://api.test/dois")
+                                          for _ in range(6)))
+
+    assert [r.status_code for r in asyncio.run(main())] == [200] * 6
+    assert max(peak) == 2
+    #the 429 pause went through the state file
+    assert ratelimit.get_limiter()._update(lambda s: s["paused_until"]) > 0
+
+
+def test_raw_records_are_written_unchanged(tmp_path):
+    records = datacite.get_xml_list_datacite(DOIS[:2], folder=tmp_path, raw=True)
+    assert (tmp_path / "1.xml").read_bytes() == records[0].xml
+    assert records[0]._tree is None
+    assert identifier(records[1].tree) == DOIS[1]
+
+
+def test_harvest_into_record_store(tmp_path, mock):
+    with RecordStore(tmp_path / "records.sqlite", compress=True) as store:
+        datacite.get_doi_xml_list_cursor("10.1234", page_size=2, store=store, raw=True)
+        assert len(store) == len(DOIS)
+        assert store.get(DOIS[3]) == mock.xml(DOIS[3])
+        assert [d for d, _ in store.iter_records()] == DOIS
+    assert not list(tmp_path.glob("*.xml"))
+
+
+def test_xml_cache_reuses_unchanged_records(tmp_path, mock):
+    with XMLCache(tmp_path / "cache.sqlite") as cache:
+        datacite.get_doi_xml_list_cursor("10.1234", page_size=2, cache=cache)
+        assert len(cache) == len(DOIS)
+
+        #only the record updated since is decoded and stored again, no record is requested
+        mock.reset_counts()
+        mock.set_updated(DOIS[2], "2030-01-01T00:00:00Z")
+        doi_list, xml_list = datacite.get_doi_xml_list_cursor("10.1234", page_size=2, cache=cache)
+        assert doi_list == DOIS
+        assert [identifier(x) for x in xml_list] == DOIS
+        assert mock.counts == {"dois": 3}
+        assert cache.get(DOIS[2]).updated == "2030-01-01T00:00:00Z"
+
+        #the second request is conditional and answered with 304
+        mock.reset_counts()
+        for _ in range(2):
+            xml_list = datacite.get_xml_list_datacite([DOIS[2]], cache=cache, raw=True)
+            assert xml_list[0].xml == mock.xml(DOIS[2])
+        assert mock.requests[-1].headers["If-None-Match"] == '"2030-01-01T00:00:00Z"'
+
+        assert cache.evict(max_bytes=0) == len(DOIS)
+        assert cache.size() == 0
+
+
+def test_partially_cached_harvest_only_requests_list_pages(tmp_path):
+    mock = MockDataCite({"10.1234": 200})
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    with XMLCache(tmp_path / "cache.sqlite") as cache:
+        for d in mock.dois("10.1234")[::2]:
+            cache.put(d, mock.xml(d), updated=mock.updated_of(d))
+        mock.set_updated("10.1234/mock.4", "2030-01-01T00:00:00Z")
+
+        records = datacite.get_doi_xml_list_cursor("10.1234", page_size=100, cache=cache, raw=True)[1]
+        assert [r.xml for r in records] == [mock.xml(d) for d in mock.dois("10.1234")]
+        assert mock.counts == {"dois": 2}
+        assert len(cache) == 200
+        assert cache.get("10.1234/mock.4").updated == "2030-01-01T00:00:00Z"
+
+
+def test_harvest_provider_prefixes(tmp_path, mock):
+    mock.prefixes["10.5678"] = 7
+    reports = []
+
+    result = scheduler.harvest_prefixes(provider_ids=["test.provider"], folder=tmp_path,
+                                        workers=2, page_size=2, callback=reports.append)
+    assert (result["records"], result["total"], result["done"], result["failed"]) == (12, 12, 2, 0)
+    #largest prefix is scheduled first
+    assert list(result["prefixes"]) == ["10.5678", "10.1234"]
+    assert reports[-1]["records"] == 12
+    doi_file = scheduler.prefix_folder(tmp_path, "10.5678") / scheduler.DOI_FILE
+    assert doi_file.read_text().split() == mock.dois("10.5678")
+
+
+def test_harvest_metrics_and_timing_summary(tmp_path):
+    requests = metrics.REQUESTS.value(endpoint="dois", status=200)
+    with metrics.collect() as timings:
+        datacite.get_doi_xml_list_cursor("10.1234", page_size=2, folder=tmp_path)
+
+    assert metrics.REQUESTS.value(endpoint="dois", status=200) - requests == 3
+    stages = timings.as_dict()["stages"]
+    assert stages["list_page"]["calls"] == 3
+    assert stages["decode"]["calls"] == stages["parse"]["calls"] == stages["write"]["calls"] == len(DOIS)
+
+    text = metrics.render()
+    assert 'datacite_requests_total{endpoint="dois",status="200"}' in text
+    assert 'harvest_stage_seconds_bucket{stage="write",le="+Inf"}' in text
@@ -0,0 +1,99 @@
+import pathlib
+import time
+
+from lxml import etree as ET
+
+from app.doi_agency import dcat, jobs
+from app.doi_agency.mock_datacite import MockDataCite
+from app.doi_agency.store import RecordStore
+from app.doi_agency.test_jobs import wait_for_folder
+
+NS = {"dcat": "http://www.w3.org/ns/dcat#", "dct": "http://purl.org/dc/terms/"}
+
+
+def test_convert_records_parallel_and_changed_only(tmp_path):
+    mock = MockDataCite({"10.1234": 30})
+    records = [(d, mock.xml(d)) for d in mock.dois("10.1234")]
+
+    with RecordStore(tmp_path / "dcat.sqlite") as output:
+        counts = dcat.convert_records(records + [("broken", b"<resource")], output,
+                                      workers=2, batch_size=4)
+        assert counts == {"converted": 30, "unchanged": 0, "failed": 1, "deleted": 0}
+        dataset = ET.fromstring(output.get("10.1234/mock.7")).find("dcat:Dataset", NS)
+        assert dataset.findtext("dct:title", namespaces=NS) == "Synthetic dataset 7"
+        assert dataset.find("dcat:distribution/dcat:Distribution", NS) is not None
+
+        mock.set_updated("10.1234/mock.7", "2024-05-01T00:00:00Z")
+        records[7] = ("10.1234/mock.7", mock.xml("10.1234/mock.7"))
+        counts = dcat.convert_records(records, output, workers=1)
+        assert counts == {"converted": 1, "unchanged": 29, "failed": 0, "deleted": 0}
+        modified = ET.fromstring(output.get("10.1234/mock.7")).findtext(".//dct:modified", namespaces=NS)
+        assert modified == "2024-05-01"
+
+        #records no longer harvested are removed with their digests
+        counts = dcat.convert_records(records[:25], output, workers=1)
+        assert counts == {"converted": 0, "unchanged": 25, "failed": 0, "deleted": 5}
+        assert len(output) == 25 and "10.1234/mock.27" not in output
+        assert len(dcat.load_digests(output)) == 25
+
+        #records are converted again with a changed stylesheet
+        xslt = tmp_path / "changed.xsl"
+        xslt.write_bytes(dcat.DCAT_AP_CH_XSLT.read_bytes() + b"\n<!-- changed -->\n")
+        counts = dcat.convert_records(records[:25], output, xslt=xslt, workers=1)
+        assert counts == {"converted": 25, "unchanged": 0, "failed": 0, "deleted": 0}
+
+
+def test_job_converts_to_dcat(tmp_path, monkeypatch):
+    mock = MockDataCite({"10.1234": 3})
+
+    def harvest(doi_prefix, page_size, headers, filename, folder, **kwargs):
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+        pathlib.Path(filename).write_text("".join(d + "\n" for d in mock.dois(doi_prefix)))
+        for i, d in enumerate(mock.dois(doi_prefix), start=1):
+            (pathlib.Path(folder) / f"{i}.xml").write_bytes(mock.xml(d))
+            yield d, None
+
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", harvest)
+
+    for converted in (3, 0):
+        fid = jobs.submit_job("10.1234", cache=tmp_path, coalesce_ttl=0, dcat=True, process_workers=1)["fid"]
+        status = wait_for_folder(tmp_path / fid)
+        assert status["status"] == jobs.DONE
+        assert status["dcat_result"]["converted"] == converted
+        #the option is kept for resume
+        assert status["dcat"] is True
+        assert status["process_workers"] == 1
+        assert status["dcat_result"]["converted"] + status["dcat_result"]["unchanged"] == 3
+        assert "dcat" in status["timings"]["stages"] or not converted
+
+
+def test_jobs_of_a_prefix_convert_one_at_a_time(tmp_path, monkeypatch):
+    mock = MockDataCite({"10.1234": 3})
+    running = []
+    overlap = []
+
+    def harvest(doi_prefix, page_size, headers, filename, folder, **kwargs):
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+        pathlib.Path(filename).write_text("".join(d + "\n" for d in mock.dois(doi_prefix)))
+        for i, d in enumerate(mock.dois(doi_prefix), start=1):
+            (pathlib.Path(folder) / f"{i}.xml").write_bytes(mock.xml(d))
+            yield d, None
+
+    def slow_convert(records, output, workers=None):
+        running.append(output.path)
+        overlap.append(len(running))
+        time.sleep(0.2)
+        running.remove(output.path)
+        return {"converted": 0, "unchanged": 0, "failed": 0, "deleted": 0}
+
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", harvest)
+    monkeypatch.setattr(jobs, "convert_records", slow_convert)
+
+    #different options make different jobs, both converting into the store of the prefix
+    fids = [jobs.submit_job("10.1234", cache=tmp_path, dcat=True, page_size=page_size)["fid"]
+            for page_size in (10, 20)]
+    for fid in fids:
+        assert wait_for_folder(tmp_path / fid)["status"] == jobs.DONE
+    assert overlap == [1, 1]
@@ -0,0 +1,72 @@
+import gzip
+import json
+
+import httpx
+import pytest
+
+from app.doi_agency import client, datacite, export, ratelimit
+from app.doi_agency.mock_datacite import MockDataCite
+
+
+@pytest.fixture
+def mock():
+    mock = MockDataCite({"10.1234": 25})
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    ratelimit.configure(rate=None, backoff=0)
+    yield mock
+    client.configure()
+    ratelimit.configure()
+
+
+def test_export_attributes_jsonl(tmp_path, mock):
+    path = tmp_path / "10.1234.jsonl.gz"
+    rows = export.export_attributes("10.1234", path, fields=["titles", "publicationYear"],
+                                    page_size=10, batch_size=7)
+
+    with gzip.open(path, "rt") as f:
+        lines = [json.loads(line) for line in f]
+    assert rows == len(lines) == 25
+    assert lines[3] == {"doi": "10.1234/mock.3", "titles": [{"title": "Synthetic dataset 3"}],
+                        "publicationYear": 2003}
+    #only the chosen fields are requested, no XML
+    assert mock.counts == {"dois": 3}
+
+    with pytest.raises(ValueError):
+        export.export_attributes("10.1234", tmp_path / "10.1234.csv")
+
+
+def test_export_attributes_parquet(tmp_path, mock):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "10.1234.parquet"
+    assert export.export_attributes("10.1234", path, page_size=10, batch_size=10) == 25
+
+    table = pq.read_table(path)
+    assert table.num_rows == 25
+    assert pq.ParquetFile(path).num_row_groups == 3
+    row = table.slice(3, 1).to_pylist()[0]
+    assert row["publicationYear"] == 2003
+    assert json.loads(row["titles"]) == [{"title": "Synthetic dataset 3"}]
+
+
+def test_dataset_columns_match_rows(mock):
+    #the Parquet schema and rows, without pyarrow
+    fields = ["titles", "publicationYear", "doi", "citationCount"]
+    columns = export.dataset_columns(fields)
+    assert columns == [("doi", "string"), ("titles", "string"), ("publicationYear", "int64"),
+                       ("citationCount", "int64")]
+
+    names = [name for name, _ in columns]
+    python_types = {"int64": int, "string": str}
+    for attributes in datacite.iter_doi_attributes_cursor("10.1234", fields=names, page_size=10):
+        row = export.flatten_attributes(attributes, names)
+        assert list(row) == names
+        for name, column_type in columns:
+            assert row[name] is None or isinstance(row[name], python_types[column_type])
+
+
+def test_flatten_attributes():
+    row = export.flatten_attributes({"doi": "10.1234/a", "publicationYear": "2020",
+                                     "types": {"resourceTypeGeneral": "Dataset"}},
+                                    ["doi", "publicationYear", "types", "created"])
+    assert row == {"doi": "10.1234/a", "publicationYear": 2020,
+                   "types": '{"resourceTypeGeneral": "Dataset"}', "created": None}
@@ -0,0 +1,321 @@
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from lxml import etree as ET
+
+from app.config import config_app
+from app.doi_agency import doi_agency_router, jobs, utils
+from app.doi_agency.datacite import doi_to_file
+from app.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def fake_harvest(doi_prefix, page_size, headers, filename, folder, **kwargs):
+    with open(filename, "w") as f:
+        for i in range(3):
+            f.write(f"{doi_prefix}/{i}\n")
+            yield f"{doi_prefix}/{i}", ET.fromstring("<resource/>")
+
+
+def wait_for(fid, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        status = client.get("/doi_agency/request", params={"fid": fid}).json()
+        if status["status"] in (jobs.DONE, jobs.FAILED):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(fid)
+
+
+def wait_for_folder(folder, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        status = jobs.read_status(folder)
+        if status["status"] in (jobs.DONE, jobs.FAILED):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(folder)
+
+
+def test_list_job_status_and_result(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_app, "CACHE", str(tmp_path))
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", fake_harvest)
+
+    response = client.get("/doi_agency/list", params={
+        "doi_agency_name": "datacite",
+        "doi_prefix": "10.1234",
+        "user_agent": "user@example.com",
+    })
+    assert response.status_code == 202
+    fid = response.json()["fid"]
+
+    status = wait_for(fid)
+    assert status["status"] == jobs.DONE
+    assert status["progress"] == {"records": 3, "total": 3}
+    #the requester's e-mail and server paths stay private
+    assert "headers" not in status and "xml_cache" not in status
+    assert "user@example.com" not in json.dumps(status)
+
+    result = client.get(status["result_url"])
+    assert result.status_code == 200
+    assert result.text.split() == ["10.1234/0", "10.1234/1", "10.1234/2"]
+    assert status["timings"]["seconds"] >= 0
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'harvest_queue_depth{queue="jobs"} 0' in response.text
+
+
+def test_result_archive_names_records_by_doi(tmp_path, monkeypatch):
+    def harvest(doi_prefix, page_size, headers, filename, folder, **kwargs):
+        folder.mkdir(parents=True, exist_ok=True)
+        with open(filename, "w") as f:
+            for i in range(1, 12):
+                f.write(f"{doi_prefix}/R{i}\n")
+                (folder / f"{i}.xml").write_text(f"<resource>{i}</resource>")
+                yield f"{doi_prefix}/R{i}", None
+
+    monkeypatch.setattr(config_app, "CACHE", str(tmp_path))
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 11)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", harvest)
+
+    fid = jobs.submit_job("10.1234", cache=tmp_path)["fid"]
+    assert wait_for_folder(tmp_path / fid)["status"] == jobs.DONE
+    response = client.get("/doi_agency/result", params={"fid": fid, "archive_format": "zip"})
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+
+    #the same member names as /doi_agency/export, in harvest order
+    assert archive.namelist() == [doi_to_file(f"10.1234/R{i}") for i in range(1, 12)]
+    assert archive.read(doi_to_file("10.1234/R10")) == b"<resource>10</resource>"
+
+
+def test_identical_requests_are_coalesced(tmp_path, monkeypatch):
+    release = threading.Event()
+
+    def blocked_harvest(*args, **kwargs):
+        release.wait(5)
+        yield from fake_harvest(*args, **kwargs)
+
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", blocked_harvest)
+
+    first = jobs.submit_job("10.1234", cache=tmp_path)
+    second = jobs.submit_job("10.1234", cache=tmp_path)
+    assert second["fid"] == first["fid"] and second["coalesced"]
+    other = jobs.submit_job("10.5678", cache=tmp_path)
+    assert other["fid"] != first["fid"]
+
+    release.set()
+    assert wait_for_folder(tmp_path / first["fid"])["status"] == jobs.DONE
+    wait_for_folder(tmp_path / other["fid"])
+    assert jobs.submit_job("10.1234", cache=tmp_path)["fid"] == first["fid"]
+    refreshed = jobs.submit_job("10.1234", cache=tmp_path, coalesce_ttl=0)
+    assert refreshed["fid"] != first["fid"]
+    wait_for_folder(tmp_path / refreshed["fid"])
+
+
+def test_job_index_and_retention_sweep(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", fake_harvest)
+
+    fids = [jobs.submit_job(prefix, cache=tmp_path)["fid"] for prefix in ("10.1234", "10.5678")]
+    for fid in fids:
+        wait_for_folder(tmp_path / fid)
+    key = jobs.job_key("datacite", "10.1234", 1000)
+    assert jobs.load_index(tmp_path)[key] == fids[0]
+
+    #a lost index is rebuilt from the job folders
+    (tmp_path / jobs.INDEX_FILE).unlink()
+    assert jobs.find_job(tmp_path, key) == fids[0]
+    assert len(jobs.load_index(tmp_path)) == 2
+
+    old = tmp_path / fids[0]
+    status = jobs.read_status(old)
+    status["finished"] = time.time() - 2 * jobs.JOB_RETENTION
+    jobs.write_status(old, status)
+
+    assert jobs.sweep_jobs(tmp_path) == [fids[0]]
+    assert not old.exists() and (tmp_path / fids[1]).is_dir()
+    assert key not in jobs.load_index(tmp_path)
+    assert jobs.find_job(tmp_path, key) is None
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".") and p.is_dir()] == []
+
+    #a job resumed between the first look and the lock is kept
+    kept = tmp_path / fids[1]
+    status = jobs.read_status(kept)
+    status["finished"] = time.time() - 2 * jobs.JOB_RETENTION
+    jobs.write_status(kept, status)
+    job_lock = jobs._job_lock
+
+    def resume_then_lock(cache):
+        status["status"] = jobs.QUEUED
+        jobs.write_status(kept, status)
+        return job_lock(cache)
+
+    monkeypatch.setattr(jobs, "_job_lock", resume_then_lock)
+    assert jobs.sweep_jobs(tmp_path) == []
+    assert kept.is_dir()
+
+
+def test_lost_job_can_be_resumed(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", fake_harvest)
+
+    folder = tmp_path / "lost"
+    folder.mkdir()
+    jobs._create_job(folder, "lost", "key", "10.1234", {}, 1000, None, False, False)
+    status = jobs.read_status(folder)
+    status["status"] = jobs.RUNNING
+    jobs.write_status(folder, status)
+    assert jobs.resume_job(tmp_path, "lost")["status_code"] == 409
+
+    #the process running it went away without updating the state
+    monkeypatch.setattr(jobs, "STALE_AFTER", 0)
+    assert jobs.resume_job(tmp_path, "lost")["status_code"] == 202
+    assert wait_for_folder(folder)["status"] == jobs.DONE
+
+
+def test_heartbeat_keeps_job_alive_and_lost_job_is_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "STALE_AFTER", 60)
+    key = jobs.job_key("datacite", "10.1234", 1000)
+    folder = tmp_path / "queued"
+    folder.mkdir()
+    jobs._create_job(folder, "queued", key, "10.1234", {}, 1000, None, False, False)
+    jobs.save_index(tmp_path, {key: "queued"})
+    #the status of a queued job or one converting records is not updated for long
+    status = jobs.read_status(folder)
+    status["updated"] = time.time() - 120
+    (folder / jobs.STATUS_FILE).write_text(json.dumps(status))
+
+    jobs.start_heartbeat(folder)
+    try:
+        assert jobs.find_job(tmp_path, key) == "queued"
+    finally:
+        jobs.stop_heartbeat(folder)
+
+    #the heartbeat stopped with the process that queued the job
+    os.utime(folder / jobs.HEARTBEAT_FILE, (time.time() - 120, time.time() - 120))
+    assert jobs.find_job(tmp_path, key) is None
+    status = jobs.read_status(folder)
+    assert status["status"] == jobs.FAILED
+    assert "lost" in status["error"]
+
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", fake_harvest)
+    fid = jobs.submit_job("10.1234", cache=tmp_path)["fid"]
+    assert fid != "queued"
+    assert jobs.load_index(tmp_path)[key] == fid
+    assert (tmp_path / jobs.LOCK_FILE).exists()
+    assert wait_for_folder(tmp_path / fid)["status"] == jobs.DONE
+
+
+def test_unknown_request():
+    assert client.get("/doi_agency/request", params={"fid": "../etc"}).status_code == 404
+
+
+def test_export_streams_zip(monkeypatch):
+    def fake_records(doi_prefix, headers):
+        for i in range(3):
+            yield f"{i}.xml", b"<resource/>"
+
+    monkeypatch.setattr(doi_agency_router, "iter_prefix_records", fake_records)
+
+    response = client.get("/doi_agency/export", params={
+        "doi_prefix": "10.1234",
+        "user_agent": "user@example.com",
+    })
+    assert response.status_code == 200
+    assert zipfile.ZipFile(io.BytesIO(response.content)).namelist() == ["0.xml", "1.xml", "2.xml"]
+
+    response = client.get("/doi_agency/export", params={
+        "doi_prefix": "10.1234",
+        "user_agent": "user@example.com",
+        "archive_format": "rar",
+    })
+    assert response.status_code == 400
+
+
+def test_stream_dois(monkeypatch):
+    def fake_dois(doi_prefix, metadata, headers, page_size):
+        for i in range(3):
+            yield {"doi": f"{doi_prefix}/{i}"}
+
+    monkeypatch.setattr(doi_agency_router, "iter_prefix_dois", fake_dois)
+    params = {"doi_prefix": "10.1234", "user_agent": "user@example.com"}
+
+    response = client.get("/doi_agency/stream", params=params)
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["doi"] for line in response.text.splitlines()] == \
+        ["10.1234/0", "10.1234/1", "10.1234/2"]
+
+    response = client.get("/doi_agency/stream", params={**params, "stream_format": "sse"})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = response.text.strip().split("\n\n")
+    assert events[0] == 'event: doi\nid: 1\ndata: {"doi": "10.1234/0"}'
+    assert events[-1] == 'event: end\ndata: {"records": 3}'
+
+    assert client.get("/doi_agency/stream", params={**params, "stream_format": "xml"}).status_code == 400
+
+
+@pytest.mark.anyio
+async def test_health_and_docs_responsive_during_harvest(monkeypatch):
+    """Load test: list and export requests holding every router thread must not hold up other routes."""
+    release = threading.Event()
+
+    def slow_submit(**kwargs):
+        release.wait(10)
+        return {"status_code": 202, "fid": "slow"}
+
+    def slow_records(doi_prefix, headers):
+        for i in range(5):
+            release.wait(10)
+            yield f"{i}.xml", b"<resource/>"
+
+    monkeypatch.setattr(doi_agency_router, "submit_job", slow_submit)
+    monkeypatch.setattr(doi_agency_router, "iter_prefix_records", slow_records)
+    limiter = utils.get_router_limiter()
+
+    params = {"doi_agency_name": "datacite", "doi_prefix": "10.1234", "user_agent": "user@example.com"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+        async def get(url, **kwargs):
+            response = await ac.get(url, **kwargs)
+            assert response.status_code in (200, 202)
+            return response
+
+        #more requests than router threads, so some wait for the limiter
+        harvests = [asyncio.create_task(get("/doi_agency/list", params=params))
+                    for _ in range(utils.ROUTER_THREADS)]
+        harvests += [asyncio.create_task(get("/doi_agency/export", params=params)) for _ in range(4)]
+        try:
+            for _ in range(500):
+                if limiter.borrowed_tokens == limiter.total_tokens:
+                    break
+                await asyncio.sleep(0.01)
+            assert limiter.borrowed_tokens == limiter.total_tokens
+
+            for _ in range(10):
+                await asyncio.wait_for(get("/health"), timeout=5)
+                await asyncio.wait_for(get("/docs"), timeout=5)
+            assert limiter.borrowed_tokens == limiter.total_tokens
+            assert not any(h.done() for h in harvests)
+        finally:
+            release.set()
+        await asyncio.gather(*harvests)
+    assert limiter.borrowed_tokens == 0
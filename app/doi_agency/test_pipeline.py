@@ -0,0 +1,113 @@
+import threading
+import time
+
+import httpx
+import pytest
+
+from app.doi_agency import client, ratelimit
+from app.doi_agency.mock_datacite import MockDataCite
+from app.doi_agency.pipeline import Pipeline, Stage, harvest_pipeline
+from app.doi_agency.store import RecordStore
+from app.doi_agency.xmlcache import XMLCache
+
+
+def test_slow_stage_holds_back_source():
+    listed = []
+    written = []
+
+    def source():
+        for i in range(200):
+            listed.append(i)
+            yield i
+
+    def slow_write(item):
+        #in flight at most: three queues of two, one item in the source and per worker
+        assert len(listed) - len(written) <= 3 * 2 + 1 + 3 + 1
+        time.sleep(0.001)
+        written.append(item)
+        return item
+
+    pipeline = Pipeline(source(), [
+        Stage("double", lambda i: i * 2, workers=3),
+        Stage("write", slow_write),
+    ], queue_size=2)
+
+    assert sorted(pipeline) == list(range(0, 400, 2))
+    stats = pipeline.stats()
+    assert stats["source"]["items"] == 200
+    assert stats["stages"]["double"]["workers"] == 3
+    assert stats["stages"]["write"]["items_in"] == 200
+    assert stats["stages"]["double"]["blocked_seconds"] > 0
+
+    pipeline = Pipeline(range(10), [Stage("drop_odd", lambda i: None if i % 2 else i)])
+    assert sorted(pipeline) == [0, 2, 4, 6, 8]
+    assert pipeline.stats()["stages"]["drop_odd"]["items_out"] == 5
+
+
+def test_errors_and_early_close_stop_all_stages():
+    def fail(i):
+        if i == 50:
+            raise ValueError("bad item")
+        return i
+
+    with pytest.raises(ValueError):
+        list(Pipeline(iter(range(1000)), [Stage("fail", fail, workers=2)]))
+
+    threads = threading.active_count()
+    items = iter(Pipeline(iter(range(10**6)), [Stage("copy", lambda i: i, workers=4)], queue_size=5))
+    assert next(items) is not None
+    items.close()
+    assert threading.active_count() == threads
+
+
+def test_early_close_does_not_wait_for_a_blocked_source():
+    release = threading.Event()
+
+    def source():
+        yield 0
+        #e.g. a list page request that takes long to answer
+        release.wait(5)
+        yield 1
+
+    items = iter(Pipeline(source(), [Stage("copy", lambda i: i)]))
+    assert next(items) == 0
+    start = time.perf_counter()
+    items.close()
+    assert time.perf_counter() - start < 2
+    release.set()
+
+
+def test_harvest_pipeline(tmp_path):
+    mock = MockDataCite({"10.1234": 45})
+    client.configure(transport=httpx.MockTransport(mock.handler))
+    ratelimit.configure(rate=None, backoff=0)
+    try:
+        with RecordStore(tmp_path / "records.sqlite") as store:
+            pipeline = harvest_pipeline("10.1234", folder=tmp_path / "xml", store=store, raw=True,
+                                        page_size=10, filename=tmp_path / "doi.txt",
+                                        decode_workers=2, queue_size=2)
+            pages = list(pipeline)
+            assert len(store) == 45
+
+        #the XML comes with the list pages
+        assert mock.counts == {"dois": 5}
+        mock.reset_counts()
+        with XMLCache(tmp_path / "cache.sqlite") as cache:
+            for _ in range(2):
+                cached = harvest_pipeline("10.1234", cache=cache, raw=True, page_size=10).run()
+        assert mock.counts == {"dois": 10}
+    finally:
+        client.configure()
+        ratelimit.configure()
+
+    assert [len(page) for page in sorted(pages, key=len, reverse=True)] == [10, 10, 10, 10, 5]
+    assert sorted(d for page in pages for d, _ in page) == sorted(mock.dois("10.1234"))
+    assert len(list((tmp_path / "xml").glob("*.xml"))) == 45
+    assert (tmp_path / "xml" / "7.xml").read_bytes() == mock.xml("10.1234/mock.6")
+    assert (tmp_path / "doi.txt").read_text().split() == mock.dois("10.1234")
+    stats = pipeline.stats()
+    assert stats["source"]["items"] == 5
+    assert stats["stages"]["decode"]["workers"] == 2
+    assert stats["stages"]["write"]["items_out"] == 5
+    assert stats["consumer"]["items"] == 5
+    assert cached["stages"]["write"]["items_out"] == 5
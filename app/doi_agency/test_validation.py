@@ -0,0 +1,152 @@
+import pathlib
+
+import httpx
+import pytest
+
+from app.doi_agency import client, jobs, validation
+from app.doi_agency.mock_datacite import MockDataCite
+from app.doi_agency.test_jobs import wait_for_folder
+
+SCHEMA = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns="http://datacite.org/schema/kernel-4"
+           targetNamespace="http://datacite.org/schema/kernel-4" elementFormDefault="qualified">
+  <xs:include schemaLocation="include/identifier.xsd"/>
+  <xs:element name="resource">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="identifier" type="identifier"/>
+        <xs:any minOccurs="0" maxOccurs="unbounded" processContents="skip"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+INCLUDE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns="http://datacite.org/schema/kernel-4"
+           targetNamespace="http://datacite.org/schema/kernel-4" elementFormDefault="qualified">
+  <xs:complexType name="identifier">
+    <xs:simpleContent>
+      <xs:extension base="xs:string">
+        <xs:attribute name="identifierType" type="xs:string" use="required"/>
+      </xs:extension>
+    </xs:simpleContent>
+  </xs:complexType>
+</xs:schema>
+"""
+
+
+def write_schema(folder, version):
+    root = folder / f"kernel-{version}"
+    (root / "include").mkdir(parents=True)
+    (root / "metadata.xsd").write_bytes(SCHEMA)
+    (root / "include" / "identifier.xsd").write_bytes(INCLUDE)
+
+
+def test_validate_records_per_prefix(tmp_path):
+    write_schema(tmp_path, "4.5")
+    mock = MockDataCite({"10.1234": 12, "10.5678": 3})
+    records = [(d, mock.xml(d)) for p in mock.prefixes for d in mock.dois(p)]
+    records.append(("bad.xml", mock.xml("10.5678/mock.9").replace(b'identifierType="DOI"', b"")))
+    records.append(("kernel-3.xml", b'<resource xmlns="http://datacite.org/schema/kernel-3"/>'))
+    records.append(("broken.xml", b"<resource"))
+
+    summary = validation.validate_records(records, folder=tmp_path, workers=2, batch_size=4)
+
+    #kernel-4 records fall back to the newest local 4.x schema
+    assert summary["10.1234"]["valid"] == 12
+    assert summary["10.1234"]["versions"] == {"4": 12}
+    assert summary["10.5678"]["valid"] == 3
+    assert summary["10.5678"]["invalid"] == 1
+    assert "identifierType" in summary["10.5678"]["errors"]["10.5678/MOCK.9"][0]
+    assert summary["unknown"]["no_schema"] == 1
+    assert summary["unknown"]["errors"]["kernel-3.xml"] == ["no local schema for version 3"]
+    assert summary["unknown"]["malformed"] == 1
+
+    with pytest.raises(validation.SchemaError):
+        validation.validate_records(records, folder=tmp_path / "missing")
+
+
+def test_download_schema_follows_includes(tmp_path):
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.path)
+        body = INCLUDE if request.url.path.endswith("identifier.xsd") else SCHEMA
+        return httpx.Response(200, content=body)
+
+    client.configure(transport=httpx.MockTransport(handler))
+    try:
+        path = validation.download_schema("4.5", tmp_path)
+    finally:
+        client.configure()
+
+    assert requested == ["/meta/kernel-4.5/metadata.xsd", "/meta/kernel-4.5/include/identifier.xsd"]
+    assert validation.schema_path("4.5", tmp_path) == path
+    assert validation.get_schema("4.5", tmp_path) is not None
+
+
+XML_XSD = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="http://www.w3.org/XML/1998/namespace">
+  <xs:attribute name="lang" type="xs:language"/>
+</xs:schema>
+"""
+
+
+def test_download_schema_copies_absolute_imports(tmp_path):
+    include = INCLUDE.replace(
+        b'  <xs:complexType name="identifier">',
+        b'  <xs:import namespace="http://www.w3.org/XML/1998/namespace"\n'
+        b'             schemaLocation="http://www.w3.org/2009/01/xml.xsd"/>\n'
+        b'  <xs:complexType name="identifier">').replace(
+        b'use="required"/>', b'use="required"/>\n        <xs:attribute ref="xml:lang"/>')
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        if request.url.host == "www.w3.org":
+            return httpx.Response(200, content=XML_XSD)
+        return httpx.Response(200, content=include if request.url.path.endswith("identifier.xsd") else SCHEMA)
+
+    client.configure(transport=httpx.MockTransport(handler))
+    try:
+        validation.download_schema("4.5", tmp_path)
+    finally:
+        client.configure()
+
+    assert requested[-1] == "http://www.w3.org/2009/01/xml.xsd"
+    root = tmp_path / "kernel-4.5"
+    assert (root / "remote" / "www.w3.org" / "2009" / "01" / "xml.xsd").read_bytes() == XML_XSD
+    saved = (root / "include" / "identifier.xsd").read_text()
+    assert 'schemaLocation="../remote/www.w3.org/2009/01/xml.xsd"' in saved
+    assert "http://www.w3.org/2009/01/xml.xsd" not in saved
+    #compiles without network access
+    assert validation.get_schema("4.5", tmp_path) is not None
+
+
+def test_job_validates_records(tmp_path, monkeypatch):
+    write_schema(tmp_path / "schemas", "4.5")
+    monkeypatch.setattr(validation, "SCHEMA_FOLDER", tmp_path / "schemas")
+    mock = MockDataCite({"10.1234": 3})
+
+    def harvest(doi_prefix, page_size, headers, filename, folder, **kwargs):
+        folder.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(filename).write_text("".join(d + "\n" for d in mock.dois(doi_prefix)))
+        for i, d in enumerate(mock.dois(doi_prefix), start=1):
+            (folder / f"{i}.xml").write_bytes(mock.xml(d))
+            yield d, None
+
+    monkeypatch.setattr(jobs, "get_doi_count", lambda doi_prefix, headers: 3)
+    monkeypatch.setattr(jobs, "iter_doi_xml_list_cursor", harvest)
+
+    fid = jobs.submit_job("10.1234", cache=tmp_path / "cache", validate=True)["fid"]
+    status = wait_for_folder(tmp_path / "cache" / fid)
+    assert status["validation"]["10.1234"]["valid"] == 3
+    assert "validate" in status["timings"]["stages"]
+
+    #without schemas the request fails instead of reporting every record as no_schema
+    monkeypatch.setattr(validation, "SCHEMA_FOLDER", tmp_path / "missing")
+    fid = jobs.submit_job("10.1234", cache=tmp_path / "cache", validate=True, coalesce_ttl=0)["fid"]
+    status = wait_for_folder(tmp_path / "cache" / fid)
+    assert status["status"] == jobs.FAILED
+    assert "No DataCite schemas" in status["error"]
@@ -0,0 +1,56 @@
+import sqlite3
+
+from app.doi_agency import xmlcache
+from app.doi_agency.xmlcache import XMLCache
+
+
+def accessed(path, doi):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT accessed FROM entries WHERE doi = ?", (doi,)).fetchone()[0]
+
+
+def test_reads_are_recorded_without_a_write_each(tmp_path, monkeypatch):
+    path = tmp_path / "cache.sqlite"
+    with XMLCache(path) as cache:
+        cache.put("10.1234/a", b"<a/>")
+        cache.put("10.1234/b", b"<b/>")
+        cache.commit()
+        before = accessed(path, "10.1234/a")
+
+        assert cache.get("10.1234/a").xml == b"<a/>"
+        assert not cache._db.in_transaction
+        assert accessed(path, "10.1234/a") == before
+
+        #the next write carries the last use, so eviction keeps the entry read last
+        assert cache.evict(max_bytes=4) == 1
+        assert "10.1234/a" in cache and "10.1234/b" not in cache
+        assert accessed(path, "10.1234/a") > before
+
+        monkeypatch.setattr(xmlcache, "ACCESS_FLUSH_SIZE", 1)
+        cache.get("10.1234/a")
+        assert not cache._accessed
+
+    cache.close()
+
+
+def test_writes_are_committed_in_batches(tmp_path, monkeypatch):
+    path = tmp_path / "cache.sqlite"
+    monkeypatch.setattr(xmlcache, "PUT_COMMIT_SIZE", 3)
+    with XMLCache(path) as cache:
+        cache.put("10.1234/a", b"<a/>")
+        cache.put("10.1234/b", b"<b/>")
+        assert cache._db.in_transaction
+        #the writing connection sees its own pending writes
+        assert cache.get("10.1234/b").xml == b"<b/>"
+        assert "10.1234/a" in cache and len(cache) == 2
+        with sqlite3.connect(path) as db:
+            assert db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0
+
+        cache.touch("10.1234/a")
+        assert not cache._db.in_transaction
+
+        cache.put("10.1234/c", b"<c/>")
+
+    #closing commits the rest
+    with sqlite3.connect(path) as db:
+        assert db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 3
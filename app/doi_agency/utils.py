@@ -1,7 +1,16 @@
 """Utils for doi_agency module."""
 
+import collections
 import csv
+import functools
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from logging import getLogger
+from typing import AsyncIterator, Callable, Iterable, Iterator, TypeVar
+
+import anyio
 
 #import xlsxwriter
 
@@ -18,6 +27,133 @@ from app.doi_agency.datacite import get_doi_list_cursor
 
 log = getLogger(__name__)
 
+T = TypeVar("T")
+
+ROUTER_THREADS = 8
+#forked children of a process with running threads can deadlock on locks those threads held
+PROCESS_START_METHOD = "forkserver"
+
+_limiter = None
+
+
+def set_router_threads(threads: int) -> None:
+    """Set the number of threads blocking router work may use at the same time.
+
+    Args:
+        threads (int): max number of threads
+    """
+    global _limiter
+    _limiter = anyio.CapacityLimiter(threads)
+
+
+def get_router_limiter() -> anyio.CapacityLimiter:
+    """Return the limiter bounding threads used by run_blocking and iterate_blocking.
+
+    Returns:
+        anyio.CapacityLimiter
+    """
+    if _limiter is None:
+        set_router_threads(ROUTER_THREADS)
+    return _limiter
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking function in a worker thread without blocking the event loop.
+
+    At most ROUTER_THREADS calls run at the same time, further calls wait, so
+    slow disk or network work cannot exhaust the threads other routes use.
+
+    Args:
+        func (Callable): blocking function
+        *args: positional arguments of func
+        **kwargs: keyword arguments of func
+
+    Returns:
+        return value of func
+    """
+    return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs),
+                                          limiter=get_router_limiter())
+
+
+async def iterate_blocking(iterator: Iterator[T]) -> AsyncIterator[T]:
+    """Yield the items of a blocking iterator, each step run by run_blocking.
+
+    Args:
+        iterator (Iterator): blocking iterator, e.g. a harvest generator
+
+    Returns:
+        AsyncIterator
+    """
+    iterator = iter(iterator)
+    done = object()
+    try:
+        while True:
+            item = await run_blocking(next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        #stop a harvest generator when the client goes away
+        if hasattr(iterator, "close"):
+            await run_blocking(iterator.close)
+
+
+def iter_batches(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """Yield lists of up to size consecutive items.
+
+    Args:
+        items (Iterable): items to batch
+        size (int): max number of items per batch
+
+    Returns:
+        Iterator[list]
+    """
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def iter_process_pool(func: Callable[[T], object],
+                      batches: Iterable[T],
+                      workers: int | None = None,
+                      initializer: Callable | None = None,
+                      initargs: tuple = ()) -> Iterator:
+    """Yield func(batch) of every batch in order, computed by worker processes.
+
+    At most two batches per worker are in flight, so batches is consumed as
+    results are taken and a generator of any length can be passed. With one
+    worker the batches are processed in this process. Worker processes are
+    started with PROCESS_START_METHOD rather than forked from this, usually
+    threaded, process.
+
+    Args:
+        func (Callable): picklable function, e.g. module level or functools.partial
+        batches (Iterable): arguments of func
+        workers (int | None): worker processes, default one per core
+        initializer (Callable | None): called once in every worker, e.g. to compile schemas
+        initargs (tuple): arguments of initializer
+
+    Returns:
+        Iterator
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for batch in batches:
+            yield func(batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs,
+                             mp_context=multiprocessing.get_context(PROCESS_START_METHOD)) as executor:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(executor.submit(func, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 
 def get_doi_agency(doi_agency_name: str) -> DOIAgency | None:
     """Return DOIAgency that corresponds to input DOI agency.
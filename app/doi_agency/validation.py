@@ -0,0 +1,324 @@
+"""DataCite schema validation of harvested XML records.
+
+Every record is validated against the DataCite kernel XSD of the schema
+version it declares in xsi:schemaLocation, or the newest local schema of its
+kernel namespace. Schemas are only read from the local schemas folder, never
+from the network: download_schema copies a version into it once, e.g. with
+make schemas, and validate_records refuses to run without any. Each worker process compiles a schema version once and
+validates records in batches, and the results are summarised per prefix.
+
+    python -m app.doi_agency.validation --download 4.5
+    python -m app.doi_agency.validation cache/xml
+"""
+
+import argparse
+import functools
+import json
+import pathlib
+import posixpath
+import re
+import sys
+import time
+import urllib.parse
+from logging import getLogger
+from typing import Iterable
+
+from lxml import etree as ET
+
+if __package__ in (None, ""):
+    sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+
+from app.doi_agency import client, metrics
+from app.doi_agency.utils import iter_batches, iter_process_pool
+
+log = getLogger(__name__)
+
+SCHEMA_FOLDER = pathlib.Path(__file__).resolve().parent / "schemas"
+SCHEMA_FILE = "metadata.xsd"
+SCHEMA_URL_TEMPLATE = "https://schema.datacite.org/meta/kernel-%s/metadata.xsd"
+XSI_SCHEMA_LOCATION = "{http://www.w3.org/2001/XMLSchema-instance}schemaLocation"
+XSD_NAMESPACE = "http://www.w3.org/2001/XMLSchema"
+BATCH_SIZE = 100
+#invalid records per prefix whose error messages are kept in the summary
+MAX_ERRORS = 100
+
+VALID = "valid"
+INVALID = "invalid"
+NO_SCHEMA = "no_schema"
+MALFORMED = "malformed"
+
+#compiled schemas of this process by (folder, version), None if not available
+_schemas = {}
+
+
+class SchemaError(Exception):
+    """No local DataCite schema is available to validate against."""
+
+
+def schema_version(doc) -> str | None:
+    """Return the DataCite schema version a record declares, e.g. "4.5".
+
+    Without a versioned xsi:schemaLocation the major version of the kernel
+    namespace is returned, e.g. "4".
+
+    Args:
+        doc (lxml element): root of a DataCite XML record
+
+    Returns:
+        str | None
+    """
+    match = re.search(r"kernel-(\d+(?:\.\d+)*)/", doc.get(XSI_SCHEMA_LOCATION, ""))
+    if match:
+        return match.group(1)
+    match = re.match(r"\{http://datacite\.org/schema/kernel-(\d+)\}", doc.tag)
+    return match.group(1) if match else None
+
+
+def _version_key(version: str) -> tuple:
+    return tuple(int(part) for part in version.split("."))
+
+
+def local_versions(folder=SCHEMA_FOLDER) -> list[str]:
+    """Return the schema versions in folder, oldest first.
+
+    Args:
+        folder (str): schema folder
+
+    Returns:
+        list[str]
+    """
+    versions = [p.parent.name[len("kernel-"):]
+                for p in pathlib.Path(folder).glob(f"kernel-*/{SCHEMA_FILE}")]
+    return sorted((v for v in versions if re.fullmatch(r"\d+(\.\d+)*", v)), key=_version_key)
+
+
+def schema_path(version: str, folder=SCHEMA_FOLDER) -> pathlib.Path | None:
+    """Return the local XSD of version, or of the newest local version with the same major version.
+
+    Args:
+        version (str): DataCite schema version, e.g. "4.5" or "4"
+        folder (str): schema folder
+
+    Returns:
+        pathlib.Path | None
+    """
+    path = pathlib.Path(folder) / f"kernel-{version}" / SCHEMA_FILE
+    if path.is_file():
+        return path
+    major = version.split(".")[0]
+    same_major = [v for v in local_versions(folder) if v.split(".")[0] == major]
+    if not same_major:
+        return None
+    return pathlib.Path(folder) / f"kernel-{same_major[-1]}" / SCHEMA_FILE
+
+
+def get_schema(version: str, folder=SCHEMA_FOLDER) -> ET.XMLSchema | None:
+    """Return the compiled schema of version, compiling it on first use in this process.
+
+    Args:
+        version (str): DataCite schema version
+        folder (str): schema folder
+
+    Returns:
+        lxml.etree.XMLSchema | None if no local schema matches version
+    """
+    key = (str(folder), version)
+    if key not in _schemas:
+        path = schema_path(version, folder)
+        schema = None
+        if path is not None:
+            try:
+                schema = ET.XMLSchema(ET.parse(str(path), ET.XMLParser(no_network=True)))
+            except (ET.XMLSchemaParseError, ET.XMLSyntaxError) as e:
+                log.error(f"Cannot compile schema {path}: {e}")
+        _schemas[key] = schema
+    return _schemas[key]
+
+
+def validate_record(xml: bytes, folder=SCHEMA_FOLDER) -> tuple[str, str | None, str, list[str]]:
+    """Validate a DataCite XML record against the schema of its declared version.
+
+    Args:
+        xml (bytes): DataCite XML record
+        folder (str): schema folder
+
+    Returns:
+        tuple of DOI, schema version, status (valid, invalid, no_schema or malformed) and error messages
+    """
+    try:
+        doc = ET.fromstring(xml)
+    except ET.XMLSyntaxError as e:
+        return "", None, MALFORMED, [str(e)]
+
+    doi = (doc.findtext("{*}identifier") or "").strip()
+    version = schema_version(doc)
+    schema = None if version is None else get_schema(version, folder)
+    if schema is None:
+        return doi, version, NO_SCHEMA, [f"no local schema for version {version}" if version
+                                         else "no DataCite kernel namespace"]
+    if schema.validate(doc):
+        return doi, version, VALID, []
+    return doi, version, INVALID, [f"line {e.line}: {e.message}" for e in schema.error_log]
+
+
+def _validate_batch(batch: list[tuple[str, bytes]], folder: str) -> tuple[list, float]:
+    """Validate (name, XML) records, return their results and the seconds taken."""
+    start = time.perf_counter()
+    results = [(name, *validate_record(xml, folder)) for name, xml in batch]
+    return results, time.perf_counter() - start
+
+
+def _init_worker(folder: str) -> None:
+    """Compile the local schemas once when a worker process starts."""
+    for version in local_versions(folder):
+        get_schema(version, folder)
+
+
+def doi_prefix(doi: str) -> str:
+    """Return the prefix of a DOI, "unknown" without DOI."""
+    return doi.split("/", 1)[0].lower() if doi else "unknown"
+
+
+def validate_records(records: Iterable[tuple[str, bytes]],
+                     folder=None,
+                     workers: int | None = None,
+                     batch_size: int = BATCH_SIZE) -> dict:
+    """Validate records in worker processes and summarise the results per prefix.
+
+    At most two batches per worker are in flight, so records are read as
+    they are needed.
+
+    Args:
+        records (Iterable[tuple[str, bytes]]): (name, XML) records, e.g. from
+            export.iter_folder_records or export.iter_store_records
+        folder (str): schema folder, default SCHEMA_FOLDER
+        workers (int | None): worker processes, default one per core, 1 validates in this process
+        batch_size (int): records per task
+
+    Returns:
+        dict by prefix with the count per status and schema version, and the
+        errors of up to MAX_ERRORS records that are not valid by DOI or name
+
+    Raises:
+        SchemaError: if there is no schema in folder
+    """
+    folder = str(SCHEMA_FOLDER if folder is None else folder)
+    if not local_versions(folder):
+        raise SchemaError(f"No DataCite schemas in {folder}, copy them with make schemas "
+                          f"or python -m app.doi_agency.validation --download <version>")
+    summary = {}
+    results = iter_process_pool(functools.partial(_validate_batch, folder=folder),
+                                iter_batches(records, batch_size),
+                                workers=workers, initializer=_init_worker, initargs=(folder,))
+    for batch, seconds in results:
+        metrics.observe_stage("validate", seconds)
+        for name, doi, version, status, errors in batch:
+            prefix = summary.setdefault(doi_prefix(doi), {
+                VALID: 0, INVALID: 0, NO_SCHEMA: 0, MALFORMED: 0, "versions": {}, "errors": {}})
+            prefix[status] += 1
+            if version is not None:
+                prefix["versions"][version] = prefix["versions"].get(version, 0) + 1
+            if errors and len(prefix["errors"]) < MAX_ERRORS:
+                prefix["errors"][doi or name] = errors
+
+    for prefix, counts in summary.items():
+        log.info(f"Validation of prefix {prefix}: {counts[VALID]} valid, {counts[INVALID]} invalid, "
+                 f"{counts[NO_SCHEMA]} without schema, {counts[MALFORMED]} malformed")
+    return summary
+
+
+def download_schema(version: str,
+                    folder=SCHEMA_FOLDER,
+                    url_template: str = SCHEMA_URL_TEMPLATE,
+                    headers: dict | None = None) -> pathlib.Path:
+    """Copy the XSD of a DataCite schema version and the files it includes into folder.
+
+    xs:include and xs:import locations are followed, so the copy validates
+    offline. Files at absolute URLs, e.g. the xml.xsd of the W3C, are saved
+    under remote/<host>/<path> and the locations pointing to them are
+    rewritten to the local copy.
+
+    Args:
+        version (str): DataCite schema version, e.g. "4.5"
+        folder (str): schema folder
+        url_template (str): URL template of the schema
+        headers (dict | None): request headers
+
+    Returns:
+        pathlib.Path of the local metadata.xsd
+    """
+    root = pathlib.Path(folder) / f"kernel-{version}"
+    #(local path relative to root, URL) of the files to copy
+    pending = [(SCHEMA_FILE, url_template % version)]
+    seen = {SCHEMA_FILE}
+    while pending:
+        name, url = pending.pop()
+        response = client.get(url, headers=headers)
+        response.raise_for_status()
+        content = response.content
+
+        doc = ET.fromstring(content)
+        rewritten = False
+        for element in doc.iter(f"{{{XSD_NAMESPACE}}}include", f"{{{XSD_NAMESPACE}}}import"):
+            location = element.get("schemaLocation")
+            if not location:
+                continue
+            if "://" in location:
+                parsed = urllib.parse.urlsplit(location)
+                included = posixpath.normpath(f"remote/{parsed.netloc}/{parsed.path.lstrip('/')}")
+                element.set("schemaLocation", posixpath.relpath(included, posixpath.dirname(name) or "."))
+                rewritten = True
+            else:
+                included = posixpath.normpath(posixpath.join(posixpath.dirname(name), location))
+            if included not in seen:
+                seen.add(included)
+                pending.append((included, urllib.parse.urljoin(url, location)))
+        if rewritten:
+            content = ET.tostring(doc, xml_declaration=True, encoding="UTF-8")
+
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+    log.info(f"Schema {version} saved to {root} ({len(seen)} files)")
+    return root / SCHEMA_FILE
+
+
+def main(argv=None):
+    from app.doi_agency.export import iter_folder_records, iter_store_records
+    from app.doi_agency.store import RecordStore, is_store_path
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("records", nargs="?", type=pathlib.Path,
+                        help="folder of XML records, or record store file, to validate")
+    parser.add_argument("--download", action="append", default=[], metavar="VERSION",
+                        help="copy a DataCite schema version into the schema folder, may be repeated")
+    parser.add_argument("--schemas", type=pathlib.Path, default=SCHEMA_FOLDER, help="schema folder")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes")
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="JSON file for the summary")
+    args = parser.parse_args(argv)
+
+    for version in args.download:
+        download_schema(version, args.schemas)
+    if args.records is None:
+        return None
+
+    try:
+        if is_store_path(args.records):
+            with RecordStore(args.records) as store:
+                summary = validate_records(iter_store_records(store), args.schemas, args.workers)
+        else:
+            summary = validate_records(iter_folder_records(args.records), args.schemas, args.workers)
+    except SchemaError as e:
+        parser.error(str(e))
+
+    for prefix, counts in summary.items():
+        print(prefix, {k: v for k, v in counts.items() if k != "errors"})
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
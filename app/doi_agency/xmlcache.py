@@ -0,0 +1,283 @@
+"""Persistent content-addressed cache of DataCite XML records.
+
+Each DOI entry keeps the DataCite updated timestamp, the ETag of the last
+response and the SHA-256 of its XML. The XML itself is stored once per hash,
+so unchanged or identical records are never stored twice. Harvests reuse an
+entry when its updated timestamp matches the one on a list page, when it was
+checked within the TTL, or when a conditional request returns 304. The last
+use of entries is recorded in memory and written with the next write, so
+reads do not cost a transaction each. Writes are committed in batches as
+well; other connections to the file see them after the next commit.
+"""
+
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from typing import NamedTuple
+
+log = getLogger(__name__)
+
+#reads whose last use is written in one transaction at the latest
+ACCESS_FLUSH_SIZE = 1000
+#writes committed in one transaction at the latest
+PUT_COMMIT_SIZE = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    xml BLOB NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    doi TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL REFERENCES blobs (sha256),
+    updated TEXT,
+    etag TEXT,
+    checked REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+
+class CacheEntry(NamedTuple):
+    """Cached record of a DOI."""
+
+    xml: bytes
+    sha256: str
+    updated: str | None
+    etag: str | None
+    checked: float
+
+
+class XMLCache:
+    """DOI keyed XML cache in a single SQLite file, shared between threads.
+
+    Args:
+        path (str): SQLite file, created if missing
+        ttl (float | None): seconds an entry is reused without revalidation,
+            None to always revalidate unless a list page timestamp matches
+        max_bytes (int | None): XML size evict() shrinks the cache to, None for no limit
+        max_age (float | None): seconds since last use after which evict() drops an entry
+    """
+
+    def __init__(self, path, ttl: float | None = None,
+                 max_bytes: int | None = None, max_age: float | None = None):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        #last use of entries read since the last write, by DOI
+        self._accessed = {}
+        #writes since the last commit
+        self._uncommitted = 0
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def get(self, doi: str) -> CacheEntry | None:
+        """Return the cached entry of doi and mark it as used, or None.
+
+        Args:
+            doi (str): full DOI string
+
+        Returns:
+            CacheEntry | None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT b.xml, e.sha256, e.updated, e.etag, e.checked "
+                "FROM entries e JOIN blobs b USING (sha256) WHERE e.doi = ?",
+                (doi.lower(),)).fetchone()
+            if row is None:
+                return None
+            self._accessed[doi.lower()] = time.time()
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+                self._commit()
+        return CacheEntry(*row)
+
+    def is_fresh(self, entry: CacheEntry | None, updated: str | None = None) -> bool:
+        """Return True if entry can be used without asking DataCite.
+
+        Args:
+            entry (CacheEntry | None): entry returned by get
+            updated (str | None): updated timestamp of the record on a list page
+
+        Returns:
+            bool
+        """
+        if entry is None:
+            return False
+        if updated is not None:
+            return entry.updated == updated
+        return self.ttl is not None and time.time() - entry.checked < self.ttl
+
+    def put(self, doi: str, xml: bytes, updated: str | None = None, etag: str | None = None) -> str:
+        """Insert or replace the entry of doi.
+
+        Args:
+            doi (str): full DOI string
+            xml (bytes): XML document
+            updated (str | None): DataCite updated timestamp of the record
+            etag (str | None): ETag of the response the record came from
+
+        Returns:
+            str: SHA-256 of xml
+        """
+        sha256 = hashlib.sha256(xml).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._flush_accessed()
+            self._db.execute("INSERT OR IGNORE INTO blobs (sha256, xml, size) VALUES (?, ?, ?)",
+                             (sha256, xml, len(xml)))
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (doi, sha256, updated, etag, checked, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (doi.lower(), sha256, updated, etag, now, now))
+            self._written()
+        return sha256
+
+    def touch(self, doi: str) -> None:
+        """Mark the entry of doi as revalidated now, e.g. after a 304 response.
+
+        Args:
+            doi (str): full DOI string
+        """
+        with self._lock:
+            self._flush_accessed()
+            self._db.execute("UPDATE entries SET checked = ? WHERE doi = ?",
+                             (time.time(), doi.lower()))
+            self._written()
+
+    def delete(self, doi: str) -> None:
+        """Remove the entry of doi if cached.
+
+        Args:
+            doi (str): full DOI string
+        """
+        with self._lock:
+            self._flush_accessed()
+            self._db.execute("DELETE FROM entries WHERE doi = ?", (doi.lower(),))
+            self._delete_orphans()
+            self._commit()
+
+    def count(self, doi_prefix: str | None = None) -> int:
+        """Return the number of cached DOIs, optionally only those of doi_prefix.
+
+        Args:
+            doi_prefix (str | None): DOI prefix for provider
+
+        Returns:
+            int
+        """
+        with self._lock:
+            if doi_prefix is None:
+                return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            prefix = doi_prefix.lower() + "/"
+            return self._db.execute("SELECT COUNT(*) FROM entries WHERE substr(doi, 1, ?) = ?",
+                                    (len(prefix), prefix)).fetchone()[0]
+
+    def size(self) -> int:
+        """Return the total size of the cached XML in bytes."""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, max_bytes: int | None = None, max_age: float | None = None) -> int:
+        """Drop entries unused for max_age, then least recently used ones above max_bytes.
+
+        Args:
+            max_bytes (int | None): size to shrink to, defaults to the cache setting
+            max_age (float | None): seconds since last use, defaults to the cache setting
+
+        Returns:
+            int: number of entries removed
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            self._flush_accessed()
+            removed = 0
+            if max_age is not None:
+                removed += self._db.execute("DELETE FROM entries WHERE accessed < ?",
+                                            (time.time() - max_age,)).rowcount
+                self._delete_orphans()
+
+            if max_bytes is not None:
+                size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+                rows = self._db.execute(
+                    "SELECT e.doi, b.size FROM entries e JOIN blobs b USING (sha256) "
+                    "ORDER BY e.accessed").fetchall()
+                drop = []
+                for doi, blob_size in rows:
+                    if size <= max_bytes:
+                        break
+                    drop.append((doi,))
+                    #shared blobs are only freed with their last entry, close enough for a limit
+                    size -= blob_size
+                self._db.executemany("DELETE FROM entries WHERE doi = ?", drop)
+                removed += len(drop)
+                self._delete_orphans()
+
+            self._commit()
+
+        if removed:
+            log.info(f"Evicted {removed} entries from XML cache {self.path}")
+        return removed
+
+    def commit(self) -> None:
+        """Commit the pending writes and last use of entries."""
+        with self._lock:
+            if self._flush_accessed() or self._uncommitted:
+                self._commit()
+
+    def close(self) -> None:
+        """Commit the pending writes and last use of entries and close the file."""
+        with self._lock:
+            if self._flush_accessed() or self._uncommitted:
+                self._commit()
+            self._db.close()
+
+    def _written(self) -> None:
+        """Count a write, commit once PUT_COMMIT_SIZE writes are pending."""
+        self._uncommitted += 1
+        if self._uncommitted >= PUT_COMMIT_SIZE:
+            self._commit()
+
+    def _commit(self) -> None:
+        self._db.commit()
+        self._uncommitted = 0
+
+    def _flush_accessed(self) -> bool:
+        """Write the pending last use of entries, return True if there was any."""
+        if not self._accessed:
+            return False
+        self._db.executemany("UPDATE entries SET accessed = ? WHERE doi = ?",
+                             [(accessed, doi) for doi, accessed in self._accessed.items()])
+        self._accessed = {}
+        return True
+
+    def _delete_orphans(self) -> None:
+        self._db.execute("DELETE FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM entries)")
+
+    def __contains__(self, doi: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE doi = ?",
+                                    (doi.lower(),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def __enter__(self) -> "XMLCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
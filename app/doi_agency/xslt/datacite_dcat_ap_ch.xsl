@@ -0,0 +1,150 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<!--
+  DataCite metadata (kernel-3 and kernel-4) to a DCAT-AP CH dcat:Dataset in RDF/XML.
+
+  Elements are matched by local name so records of any DataCite schema
+  version are converted. Used by app/doi_agency/dcat.py.
+-->
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns:dcat="http://www.w3.org/ns/dcat#"
+    xmlns:dct="http://purl.org/dc/terms/"
+    xmlns:foaf="http://xmlns.com/foaf/0.1/"
+    xmlns:vcard="http://www.w3.org/2006/vcard/ns#"
+    exclude-result-prefixes="xsl">
+
+  <xsl:output method="xml" encoding="UTF-8" indent="yes"/>
+
+  <xsl:variable name="xsd">http://www.w3.org/2001/XMLSchema#</xsl:variable>
+  <xsl:variable name="doi" select="normalize-space(/*[local-name()='resource']/*[local-name()='identifier'][@identifierType='DOI'])"/>
+  <xsl:variable name="landing-page" select="concat('https://doi.org/', $doi)"/>
+  <xsl:variable name="dates" select="/*/*[local-name()='dates']/*[local-name()='date']"/>
+  <xsl:variable name="publisher" select="normalize-space(/*/*[local-name()='publisher'])"/>
+
+  <xsl:template match="/">
+    <rdf:RDF>
+      <xsl:apply-templates select="*[local-name()='resource']"/>
+    </rdf:RDF>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='resource']">
+    <dcat:Dataset rdf:about="{$landing-page}">
+      <dct:identifier><xsl:value-of select="$doi"/></dct:identifier>
+      <xsl:apply-templates select="*[local-name()='titles']/*[local-name()='title'][not(@titleType)]"/>
+      <xsl:apply-templates select="*[local-name()='descriptions']/*[local-name()='description'][@descriptionType='Abstract']"/>
+      <dct:publisher>
+        <foaf:Organization>
+          <foaf:name><xsl:value-of select="$publisher"/></foaf:name>
+        </foaf:Organization>
+      </dct:publisher>
+      <xsl:call-template name="contact-point"/>
+      <xsl:apply-templates select="*[local-name()='creators']/*[local-name()='creator']"/>
+      <xsl:call-template name="issued"/>
+      <xsl:if test="$dates[@dateType='Updated']">
+        <dct:modified rdf:datatype="{$xsd}date"><xsl:value-of select="substring(normalize-space($dates[@dateType='Updated'][1]), 1, 10)"/></dct:modified>
+      </xsl:if>
+      <xsl:apply-templates select="*[local-name()='subjects']/*[local-name()='subject']"/>
+      <xsl:apply-templates select="*[local-name()='language']"/>
+      <dcat:landingPage rdf:resource="{$landing-page}"/>
+      <xsl:apply-templates select="*[local-name()='relatedIdentifiers']/*[local-name()='relatedIdentifier']"/>
+      <dcat:distribution>
+        <dcat:Distribution rdf:about="{$landing-page}#distribution">
+          <dcat:accessURL rdf:resource="{$landing-page}"/>
+          <xsl:call-template name="issued"/>
+          <xsl:apply-templates select="*[local-name()='rightsList']/*[local-name()='rights'][@rightsURI]"/>
+          <xsl:apply-templates select="*[local-name()='formats']/*[local-name()='format']"/>
+        </dcat:Distribution>
+      </dcat:distribution>
+    </dcat:Dataset>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='title']">
+    <dct:title>
+      <xsl:copy-of select="@xml:lang"/>
+      <xsl:value-of select="normalize-space()"/>
+    </dct:title>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='description']">
+    <dct:description>
+      <xsl:copy-of select="@xml:lang"/>
+      <xsl:value-of select="normalize-space()"/>
+    </dct:description>
+  </xsl:template>
+
+  <!-- contact persons of the record, the publisher otherwise (dcat:contactPoint is mandatory) -->
+  <xsl:template name="contact-point">
+    <xsl:variable name="contacts" select="*[local-name()='contributors']/*[local-name()='contributor'][@contributorType='ContactPerson']"/>
+    <xsl:choose>
+      <xsl:when test="$contacts">
+        <xsl:for-each select="$contacts">
+          <dcat:contactPoint>
+            <vcard:Individual>
+              <vcard:fn><xsl:value-of select="normalize-space(*[local-name()='contributorName'])"/></vcard:fn>
+            </vcard:Individual>
+          </dcat:contactPoint>
+        </xsl:for-each>
+      </xsl:when>
+      <xsl:otherwise>
+        <dcat:contactPoint>
+          <vcard:Organization>
+            <vcard:fn><xsl:value-of select="$publisher"/></vcard:fn>
+          </vcard:Organization>
+        </dcat:contactPoint>
+      </xsl:otherwise>
+    </xsl:choose>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='creator']">
+    <dct:creator>
+      <foaf:Agent>
+        <foaf:name><xsl:value-of select="normalize-space(*[local-name()='creatorName'])"/></foaf:name>
+      </foaf:Agent>
+    </dct:creator>
+  </xsl:template>
+
+  <!-- issued date, the publication year if the record has none -->
+  <xsl:template name="issued">
+    <xsl:choose>
+      <xsl:when test="$dates[@dateType='Issued']">
+        <dct:issued rdf:datatype="{$xsd}date"><xsl:value-of select="substring(normalize-space($dates[@dateType='Issued'][1]), 1, 10)"/></dct:issued>
+      </xsl:when>
+      <xsl:when test="/*/*[local-name()='publicationYear']">
+        <dct:issued rdf:datatype="{$xsd}gYear"><xsl:value-of select="normalize-space(/*/*[local-name()='publicationYear'])"/></dct:issued>
+      </xsl:when>
+    </xsl:choose>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='subject']">
+    <dcat:keyword>
+      <xsl:copy-of select="@xml:lang"/>
+      <xsl:value-of select="normalize-space()"/>
+    </dcat:keyword>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='language']">
+    <dct:language><xsl:value-of select="normalize-space()"/></dct:language>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='relatedIdentifier']">
+    <xsl:variable name="id" select="normalize-space()"/>
+    <xsl:choose>
+      <xsl:when test="@relatedIdentifierType='DOI'">
+        <dct:relation rdf:resource="https://doi.org/{$id}"/>
+      </xsl:when>
+      <xsl:when test="@relatedIdentifierType='URL'">
+        <dct:relation rdf:resource="{$id}"/>
+      </xsl:when>
+    </xsl:choose>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='rights']">
+    <dct:license rdf:resource="{normalize-space(@rightsURI)}"/>
+  </xsl:template>
+
+  <xsl:template match="*[local-name()='format']">
+    <dct:format><xsl:value-of select="normalize-space()"/></dct:format>
+  </xsl:template>
+
+</xsl:stylesheet>
@@ -4,7 +4,7 @@ import logging
 from typing import Callable
 
 from fastapi import APIRouter, HTTPException, Request, Response
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi.routing import APIRoute
 
 #from app.config import config_app
@@ -17,7 +17,7 @@ from app.config import config_app
 #from edna import api_edna
 #from external_doi import api_external_doi
 
-from app.doi_agency import doi_agency_router
+from app.doi_agency import doi_agency_router, metrics
 
 
 # Setup logging
@@ -56,6 +56,18 @@ api_router.include_router(doi_agency_router.router)
 error_router = APIRouter(route_class=RouteErrorHandler)
 
 
+@api_router.get("/health", tags=["health"])
+async def health():
+    """Return OK while the app accepts requests."""
+    return {"status": "ok"}
+
+
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Return harvest metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @api_router.get("/", include_in_schema=False)
 async def home():
     """Redirect home to docs."""